@@ -0,0 +1,306 @@
+"""Stand-in llama.cpp / OpenAI-compatible server for benchmarks.
+
+Serves:
+- POST /completion            llama.cpp style (``stream`` supported)
+- POST /v1/chat/completions   OpenAI style (``stream`` supported)
+- POST /tokenize, GET /props  llama.cpp helpers
+- POST /embedding             letter-frequency vectors (one text or a list)
+- POST /_options              update the options below at runtime
+- GET /_stats                 request count, prefill characters charged, 429s sent
+
+Latency, token rate, output size and error injection are configurable, so
+paste performance can be measured offline and without a GPU. Each slot
+remembers its last prompt: with ``cache_prompt`` only the part after the
+common prefix is charged prefill time (``prefill_chars_per_sec``), as in
+llama.cpp.
+
+Usage: python bench/fake_server.py --port 8080 --latency 0.2 --tokens-per-sec 300
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List
+
+DEFAULTS: Dict[str, Any] = {
+    "latency": 0.05,         # seconds before the first token (prefill)
+    "tokens_per_sec": 0.0,   # decode rate; 0 = unlimited
+    "chars_per_token": 4,
+    "output_chars": 2000,    # output size when not echoing
+    "echo": False,           # return the clipboard text from the prompt
+    "error_rate": 0.0,       # fraction of completion requests that fail
+    "error_status": 500,     # status used for injected errors (429 adds Retry-After)
+    "slots": 4,              # reported as total_slots in /props
+    "n_ctx": 8192,           # reported context size in /props
+    "prefill_chars_per_sec": 0.0,  # extra prefill time per uncached prompt char; 0 = off
+    "manifest_files": 3,     # files listed when a multi-file manifest is requested
+    "rpm": 0,                # provider-style limit on completions per minute (429 beyond); 0 = off
+}
+
+_TEXT_RE = re.compile(r"Text:\n(.*)\n\nInstruction:", re.S)
+
+
+class FakeModelServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, **options):
+        super().__init__(address, _Handler)
+        self.options = {**DEFAULTS, **options}
+        self.requests: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._slot_prompts: Dict[int, str] = {}
+        # One "GPU": simulated prefill of concurrent requests runs one at a time
+        self.gpu = threading.Lock()
+        self.prefill_chars = 0
+        self._next_slot = 0
+        self._window: List[float] = []  # completion times in the last minute (rpm)
+        self.throttled = 0
+        self.embedded = 0
+
+    def rate_limit(self) -> Dict[str, str] | None:
+        """Count a completion against ``rpm``; return x-ratelimit headers, or None when over the limit."""
+        rpm = int(self.options['rpm'])
+        if not rpm:
+            return {}
+        now = time.time()
+        with self._lock:
+            self._window = [t for t in self._window if t > now - 60]
+            reset = (self._window[0] + 60 - now) if self._window else 0.0
+            if len(self._window) >= rpm:
+                self.throttled += 1
+                return None
+            self._window.append(now)
+            return {"x-ratelimit-limit-requests": str(rpm),
+                    "x-ratelimit-remaining-requests": str(rpm - len(self._window)),
+                    "x-ratelimit-reset-requests": f"{reset:.2f}s"}
+
+    def claim_slot(self, prompt: str, id_slot: int | None, cache: bool) -> tuple[int, int]:
+        """Pick a slot (``id_slot`` or round robin); return ``(slot, cached_chars)``."""
+        with self._lock:
+            slots = max(1, int(self.options['slots']))
+            if id_slot is None or not 0 <= id_slot < slots:
+                id_slot = self._next_slot % slots
+                self._next_slot += 1
+            previous = self._slot_prompts.get(id_slot, '')
+            self._slot_prompts[id_slot] = prompt
+        if not cache:
+            return id_slot, 0
+        n = 0
+        for a, b in zip(previous, prompt):
+            if a != b:
+                break
+            n += 1
+        return id_slot, n
+
+    def record(self, path: str, body: Dict[str, Any]) -> None:
+        with self._lock:
+            self.requests.append({"path": path, "body": body, "time": time.time()})
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_server(port: int = 0, **options) -> FakeModelServer:
+    """Start a FakeModelServer on a background thread and return it."""
+    server = FakeModelServer(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, name='fake-model', daemon=True).start()
+    return server
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: FakeModelServer
+
+    def log_message(self, *args):
+        pass
+
+    # --- helpers ---
+    def _json(self, status: int, obj: Dict[str, Any], headers: Dict[str, str] | None = None) -> None:
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data: bytes) -> None:
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+
+    def _output_for(self, body: Dict[str, Any]) -> str:
+        opts = self.server.options
+        prompt = body.get('prompt') or ''.join(m.get('content', '') for m in body.get('messages', []))
+        if 'filename' in prompt.lower() and (body.get('n_predict') == 50 or body.get('max_tokens') == 50):
+            return 'benchmark_output.txt'
+        if opts['echo']:
+            m = _TEXT_RE.search(prompt)
+            text = m.group(1) if m else prompt
+        else:
+            text = ('lorem ipsum dolor sit amet ' * (opts['output_chars'] // 27 + 1))[:opts['output_chars']]
+        schema = body.get('json_schema') or ((body.get('response_format') or {}).get('json_schema') or {}).get('schema')
+        if schema and 'files' in (schema.get('properties') or {}):
+            return json.dumps({"files": [{"path": f"pkg/file_{i}.txt", "purpose": f"part {i}"}
+                                         for i in range(int(opts['manifest_files']))]})
+        if schema:
+            return json.dumps({"filename": "benchmark_output.txt", "content": text})
+        return text
+
+    # --- routes ---
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/props'):
+            opts = self.server.options
+            self._json(200, {"total_slots": opts['slots'],
+                             "default_generation_settings": {"n_ctx": opts['n_ctx']}})
+        elif self.path == '/_stats':
+            self._json(200, {"requests": len(self.server.requests), "prefill_chars": self.server.prefill_chars,
+                             "throttled": self.server.throttled, "embedded": self.server.embedded})
+        elif self.path.rstrip('/').endswith('/health'):
+            self._json(200, {"status": "ok"})
+        else:
+            self._json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._json(400, {"error": "bad json"})
+            return
+        if self.path == '/_options':
+            self.server.options.update(body)
+            if 'rpm' in body:
+                self.server._window.clear()
+            self._json(200, self.server.options)
+            return
+        self.server.record(self.path, body)
+        opts = self.server.options
+        if self.path.rstrip('/').endswith('/tokenize'):
+            content = body.get('content', '')
+            n = max(1, len(content) // opts['chars_per_token']) if content else 0
+            self._json(200, {"tokens": list(range(n))})
+            return
+        if self.path.rstrip('/').endswith('/embedding'):
+            content = body.get('content', '')
+            texts = content if isinstance(content, list) else [content]
+            vecs = [[float(t.lower().count(c)) for c in 'abcdefghijklmnopqrstuvwxyz '] for t in texts]
+            with self.server._lock:
+                self.server.embedded += len(texts)
+            if isinstance(content, list):
+                self._json(200, [{"index": i, "embedding": [v]} for i, v in enumerate(vecs)])
+            else:
+                self._json(200, {"embedding": vecs[0]})
+            return
+        if random.random() < opts['error_rate']:
+            status = int(opts['error_status'])
+            self._json(status, {"error": "injected failure"}, {"Retry-After": "1"} if status == 429 else None)
+            return
+        limit_headers = self.server.rate_limit()
+        if limit_headers is None:
+            self._json(429, {"error": "rate limited"}, {"Retry-After": "2"})
+            return
+
+        chat = 'messages' in body
+        text = self._output_for(body)
+        cpt = max(1, int(opts['chars_per_token']))
+        pieces = [text[i:i + cpt] for i in range(0, len(text), cpt)] or ['']
+        n_predict = body.get('n_predict')
+        if isinstance(n_predict, int) and n_predict == 0:
+            pieces = []
+        delay = 1.0 / opts['tokens_per_sec'] if opts['tokens_per_sec'] else 0.0
+        prompt = body.get('prompt') or json.dumps(body.get('messages', []))
+        slot, cached = self.server.claim_slot(prompt, body.get('id_slot'), bool(body.get('cache_prompt')))
+        usage = {"prompt_tokens": (len(prompt) - cached) // cpt, "completion_tokens": len(pieces)}
+        start = time.perf_counter()
+        time.sleep(opts['latency'])
+        rate = opts['prefill_chars_per_sec']
+        if rate:
+            with self.server.gpu:
+                self.server.prefill_chars += len(prompt) - cached
+                time.sleep((len(prompt) - cached) / rate)
+        prefill = time.perf_counter() - start
+
+        if not body.get('stream'):
+            if delay:
+                time.sleep(delay * len(pieces))
+            decode = time.perf_counter() - start - prefill
+            out = ''.join(pieces)
+            if chat:
+                self._json(200, {"choices": [{"message": {"role": "assistant", "content": out}, "finish_reason": "stop"}],
+                                 "usage": {**usage, "total_tokens": sum(usage.values())}}, limit_headers)
+            else:
+                self._json(200, {"content": out, "stop": True, "tokens_predicted": len(pieces),
+                                 "tokens_evaluated": usage["prompt_tokens"], "tokens_cached": cached // cpt,
+                                 "id_slot": slot,
+                                 "timings": _timings(usage, prefill, decode)}, limit_headers)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for k, v in limit_headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        try:
+            for piece in pieces:
+                if delay:
+                    time.sleep(delay)
+                event = {"choices": [{"delta": {"content": piece}}]} if chat else {"content": piece, "stop": False}
+                self._chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            decode = time.perf_counter() - start - prefill
+            if chat:
+                self._chunk(f"data: {json.dumps({'choices': [{'delta': {}, 'finish_reason': 'stop'}], 'usage': usage})}\n\n".encode('utf-8'))
+                self._chunk(b"data: [DONE]\n\n")
+            else:
+                final = {"content": "", "stop": True, "tokens_cached": cached // cpt, "id_slot": slot,
+                         "timings": _timings(usage, prefill, decode)}
+                self._chunk(f"data: {json.dumps(final)}\n\n".encode('utf-8'))
+            self._chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def _timings(usage: Dict[str, int], prefill: float, decode: float) -> Dict[str, float]:
+    """llama.cpp style timings block."""
+    return {
+        "prompt_n": usage["prompt_tokens"],
+        "prompt_ms": prefill * 1000,
+        "prompt_per_second": usage["prompt_tokens"] / prefill if prefill else 0.0,
+        "predicted_n": usage["completion_tokens"],
+        "predicted_ms": decode * 1000,
+        "predicted_per_second": usage["completion_tokens"] / decode if decode else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake llama.cpp / OpenAI server for benchmarks')
+    parser.add_argument('--port', type=int, default=8080, help='0 picks a free port (printed on startup)')
+    parser.add_argument('--latency', type=float, default=DEFAULTS['latency'])
+    parser.add_argument('--tokens-per-sec', type=float, default=DEFAULTS['tokens_per_sec'])
+    parser.add_argument('--output-chars', type=int, default=DEFAULTS['output_chars'])
+    parser.add_argument('--echo', action='store_true')
+    parser.add_argument('--error-rate', type=float, default=DEFAULTS['error_rate'])
+    parser.add_argument('--error-status', type=int, default=DEFAULTS['error_status'])
+    parser.add_argument('--slots', type=int, default=DEFAULTS['slots'])
+    parser.add_argument('--n-ctx', type=int, default=DEFAULTS['n_ctx'])
+    parser.add_argument('--prefill-chars-per-sec', type=float, default=DEFAULTS['prefill_chars_per_sec'])
+    parser.add_argument('--rpm', type=int, default=DEFAULTS['rpm'], help='429 beyond this many completions per minute')
+    args = parser.parse_args(argv)
+    server = FakeModelServer(('127.0.0.1', args.port), latency=args.latency, tokens_per_sec=args.tokens_per_sec,
+                             output_chars=args.output_chars, echo=args.echo, error_rate=args.error_rate,
+                             error_status=args.error_status, slots=args.slots, n_ctx=args.n_ctx,
+                             prefill_chars_per_sec=args.prefill_chars_per_sec, rpm=args.rpm)
+    print(f"Fake model server on {server.url} (/completion, /v1/chat/completions)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,415 @@
+"""End-to-end benchmarks for the paste pipeline against bench/fake_server.py.
+
+Runs offline on any OS without a GUI (pywebview is never imported):
+
+    python bench/run_bench.py --out bench_results.json
+    python bench/run_bench.py --only latency,throughput --runs 20
+
+Measures paste latency (buffered vs streamed, llama.cpp vs OpenAI),
+throughput under concurrency, peak Python memory against clipboard size
+config/history load/save cost against history size, and prefill work for
+several presets over one clipboard (fan-out vs independent pastes), and
+the cost of re-running a preset after a one-line edit with and without
+incremental mode. Results are written as
+JSON (with the git commit) so runs can be compared across commits.
+
+The ratelimit suite (batch against a provider-style requests/minute limit,
+with and without the client-side limiter) takes over a minute per mode,
+so it only runs when named in --only.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+BENCH_DIR = Path(tempfile.mkdtemp(prefix='bap-bench-'))
+
+# main.py resolves its config paths at import time: isolate them first
+os.environ['BAP_CONFIG'] = str(BENCH_DIR / 'conf.json')
+os.environ['XDG_CONFIG_HOME'] = str(BENCH_DIR / 'config')
+os.environ['APPDATA'] = str(BENCH_DIR / 'config')
+# Never touch (or block on) the real credential store
+os.environ.setdefault('PYTHON_KEYRING_BACKEND', 'keyring.backends.null.Keyring')
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import main  # noqa: E402
+
+SERVER_SCRIPT = Path(__file__).resolve().parent / 'fake_server.py'
+
+SUITES = ('latency', 'throughput', 'memory', 'config', 'fanout', 'incremental')
+EXTRA_SUITES = ('ratelimit',)
+
+
+class ServerProcess:
+    """fake_server.py in its own process, so its allocations and GIL time
+    don't pollute the measurements."""
+
+    def __init__(self, **options):
+        args = [sys.executable, str(SERVER_SCRIPT), '--port', '0']
+        for k, v in options.items():
+            args += [f"--{k.replace('_', '-')}", str(v)]
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
+        line = self.proc.stdout.readline()
+        self.url = line.split(' on ', 1)[1].split()[0]
+        self.options = self.set_options()
+
+    def set_options(self, **options) -> Dict[str, Any]:
+        return main._http().post(f"{self.url}/_options", json=options, timeout=5).json()
+
+    def shutdown(self) -> None:
+        self.proc.terminate()
+        self.proc.wait(timeout=5)
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    s = sorted(samples)
+
+    def pct(p: float) -> float:
+        return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+    return {
+        "n": len(s),
+        "mean_ms": round(statistics.fmean(s) * 1000, 2),
+        "p50_ms": round(pct(50) * 1000, 2),
+        "p95_ms": round(pct(95) * 1000, 2),
+        "max_ms": round(s[-1] * 1000, 2),
+    }
+
+
+def _configure(server, **ai) -> None:
+    """Point main.py at the fake server with the given ai settings."""
+    settings = {
+        **main.AI_DEFAULTS,
+        "local_url": f"{server.url}/completion",
+        "endpoint": f"{server.url}/v1/chat/completions",
+        "model": "fake-model",
+        "api_key": "bench",
+        "cache": False,
+        **ai,
+    }
+    main._apply_ai_settings(settings)
+
+
+def _forget_context() -> None:
+    """Drop main.py's cached n_ctx and token counts after changing the server's n_ctx."""
+    main._context_sizes.clear()
+    main._token_counts.clear()
+
+
+def _timed(fn: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench_latency(server, runs: int) -> Dict[str, Any]:
+    out_dir = BENCH_DIR / 'latency'
+    text = 'def f(x):\n    return x * 2\n' * 50
+    results: Dict[str, Any] = {}
+    for backend in ('local', 'openai'):
+        for stream in (False, True):
+            _configure(server, use_openai=backend == 'openai', stream=stream)
+            samples = [_timed(lambda: main.paste_to_dir('Paste as Python script', out_dir, text=text))
+                       for _ in range(runs)]
+            results[f"{backend}{'_stream' if stream else ''}"] = _summary(samples)
+    _configure(server, cache=True)
+    main._response_cache = None
+    main.paste_to_dir('Paste as Python script', out_dir, text=text)
+    samples = [_timed(lambda: main.paste_to_dir('Paste as Python script', out_dir, text=text))
+               for _ in range(runs)]
+    results["cache_hit"] = _summary(samples)
+    main._response_cache = None
+    return results
+
+
+def bench_throughput(server, items: int, levels: List[int]) -> Dict[str, Any]:
+    _configure(server)
+    in_dir = BENCH_DIR / 'inputs'
+    in_dir.mkdir(exist_ok=True)
+    inputs = []
+    for i in range(items):
+        p = in_dir / f'item{i}.txt'
+        p.write_text(f'snippet {i}\n' * 20, encoding='utf-8')
+        inputs.append(p)
+    results: Dict[str, Any] = {}
+    for jobs in levels:
+        out_dir = BENCH_DIR / f'throughput_{jobs}'
+        with open(os.devnull, 'w') as sink:
+            start = time.perf_counter()
+            failures = main.run_batch('Paste as plain text', inputs, out_dir, jobs=jobs, summary=sink)
+            elapsed = time.perf_counter() - start
+        results[f"jobs_{jobs}"] = {
+            "items": items,
+            "failures": failures,
+            "seconds": round(elapsed, 3),
+            "items_per_sec": round(items / elapsed, 2),
+        }
+    return results
+
+
+def bench_memory(server, sizes_kb: List[int]) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    # Echo the clipboard back at full speed: output size tracks input size
+    saved = dict(server.options)
+    server.set_options(echo=True, tokens_per_sec=0, chars_per_token=64,
+                       n_ctx=max(8192, max(sizes_kb) * 1024 // 16))
+    _forget_context()
+    try:
+        for stream in (False, True):
+            _configure(server, stream=stream)
+            for kb in sizes_kb:
+                text = ('x' * 99 + '\n') * (kb * 1024 // 100)
+                out_dir = BENCH_DIR / 'memory'
+                tracemalloc.start()
+                elapsed = _timed(lambda: main.paste_to_dir('Paste as plain text', out_dir, text=text))
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                results[f"{kb}kb{'_stream' if stream else ''}"] = {
+                    "clipboard_bytes": len(text),
+                    "peak_mb": round(peak / 1024 / 1024, 2),
+                    "peak_vs_input": round(peak / len(text), 2),
+                    "seconds": round(elapsed, 3),
+                }
+    finally:
+        server.set_options(**saved)
+        _forget_context()
+    return results
+
+
+def bench_config(sizes: List[int], runs: int) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    conf = Path(os.environ['BAP_CONFIG'])
+    for n in sizes:
+        data = {
+            "settings": {"save_history": True},
+            "ai": {},
+            "options": [{"icon": "{}", "color": "#2563eb", "title": f"Saved prompt number {i}", "desc": "Saved prompt"}
+                        for i in range(n)],
+        }
+        conf.write_text(json.dumps(data, indent=2) + "\n", encoding='utf-8')
+        # Fresh history store per size; the first load migrates conf.json into it
+        main._history_store = None
+        for f in main._app_config_dir().glob('history.db*'):
+            f.unlink()
+        migrate = _timed(main.API(conf, BENCH_DIR)._load)
+        first_page = []
+        load = []
+        save = []
+        toggle = []
+        for r in range(runs):
+            # What the palette needs before the window opens, then the full index
+            first_page.append(_timed(lambda: main.API(conf, BENCH_DIR).initial_options(50)))
+            api = main.API(conf, BENCH_DIR)
+            load.append(_timed(api._load))
+            save.append(_timed(lambda: api.save_prompt(f"new prompt {n}-{r}")))
+            toggle.append(_timed(lambda: api.set_save_history(r % 2 == 0)))
+        results[f"options_{n}"] = {
+            "file_kb": round(conf.stat().st_size / 1024, 1),
+            "migrate_ms": round(migrate * 1000, 2),
+            "first_page": _summary(first_page),
+            "load": _summary(load),
+            "save_prompt": _summary(save),
+            "set_save_history": _summary(toggle),
+        }
+    return results
+
+
+def bench_fanout(server, presets: int, clipboard_kb: int) -> Dict[str, Any]:
+    """Several presets over one clipboard: independent concurrent pastes vs paste_many."""
+    results: Dict[str, Any] = {}
+    saved = dict(server.options)
+    # Charge prefill per uncached prompt char (serialized, like one GPU).
+    # The whole clipboard goes into each request, so the context must hold it.
+    server.set_options(prefill_chars_per_sec=500_000, output_chars=300, tokens_per_sec=0,
+                       n_ctx=max(8192, clipboard_kb * 1024 // 2))
+    _forget_context()
+    text = ('some clipboard line of text\n' * (clipboard_kb * 1024 // 28))
+    instructions = [f'Paste as format {i}' for i in range(presets)]
+    try:
+        _configure(server)
+        main._slot_count = None
+        for mode in ('independent', 'fanout', 'fanout_all_slots'):
+            # Fresh slots: new clipboard contents per mode
+            text = text[1:] + text[0]
+            before = _stats(server)
+            start = time.perf_counter()
+            if mode == 'independent':
+                main.LOCAL_SAMPLING['cache_prompt'] = False
+                try:
+                    with ThreadPoolExecutor(max_workers=presets) as pool:
+                        list(pool.map(lambda ins: main.paste_to_dir(ins, BENCH_DIR / 'fanout', text=text, unique=True),
+                                      instructions))
+                finally:
+                    main.LOCAL_SAMPLING['cache_prompt'] = True
+            else:
+                _configure(server, fanout_workers=presets if mode == 'fanout_all_slots' else 0)
+                main.paste_many(instructions, BENCH_DIR / 'fanout', text=text)
+            elapsed = time.perf_counter() - start
+            after = _stats(server)
+            results[mode] = {
+                "presets": presets,
+                "clipboard_bytes": len(text),
+                "seconds": round(elapsed, 3),
+                "prefill_chars": after["prefill_chars"] - before["prefill_chars"],
+                "prefill_vs_one": round((after["prefill_chars"] - before["prefill_chars"]) / len(text), 2),
+            }
+    finally:
+        server.set_options(**saved)
+        _forget_context()
+    return results
+
+
+def bench_incremental(server, clipboard_kb: int) -> Dict[str, Any]:
+    """Paste a clipboard, edit one line in the middle and paste again: whole vs incremental."""
+    results: Dict[str, Any] = {}
+    saved = dict(server.options)
+    server.set_options(prefill_chars_per_sec=500_000, echo=True, tokens_per_sec=0, n_ctx=131072)
+    # Earlier suites leave main.py with the old n_ctx cached
+    _forget_context()
+    paras = [f'paragraph {i}\n' + f'line of text number {i}\n' * (1 + i % 5) + '\n'
+             for i in range(clipboard_kb * 1024 // 80)]
+    try:
+        for mode in ('whole', 'incremental'):
+            # Distinct text per mode so neither run sees the other's cache entries
+            text = ''.join(f'{mode} {p}' for p in paras)
+            middle = f'{mode} paragraph {len(paras) // 2}\n'
+            edited = text.replace(middle, middle.rstrip('\n') + ' (edited)\n', 1)
+            _configure(server, cache=True, incremental=mode == 'incremental')
+            runs = {}
+            for run, clip in (('first', text), ('after_edit', edited)):
+                before = _stats(server)
+                start = time.perf_counter()
+                main.paste_to_dir('Paste as markdown', BENCH_DIR / 'incremental', text=clip, unique=True)
+                elapsed = time.perf_counter() - start
+                after = _stats(server)
+                runs[run] = {
+                    "seconds": round(elapsed, 3),
+                    "requests": after["requests"] - before["requests"],
+                    "prefill_chars": after["prefill_chars"] - before["prefill_chars"],
+                }
+            runs["clipboard_bytes"] = len(text)
+            runs["rerun_vs_first"] = round(runs["after_edit"]["prefill_chars"] / max(1, runs["first"]["prefill_chars"]), 3)
+            results[mode] = runs
+    finally:
+        server.set_options(**saved)
+        _forget_context()
+    return results
+
+
+def bench_ratelimit(server, rpm: int, items: int) -> Dict[str, Any]:
+    """Batch over an OpenAI-style endpoint limited to *rpm*: retries alone vs the client-side limiter."""
+    results: Dict[str, Any] = {}
+    saved = dict(server.options)
+    host = server.url.split('//', 1)[1]
+    inputs = []
+    in_dir = BENCH_DIR / 'ratelimit_inputs'
+    in_dir.mkdir(exist_ok=True)
+    for i in range(items):
+        p = in_dir / f'item{i}.txt'
+        p.write_text(f'snippet {i}\n', encoding='utf-8')
+        inputs.append(p)
+    try:
+        for mode in ('retries_only', 'client_limiter'):
+            # Setting rpm starts a fresh server-side window
+            server.set_options(rpm=rpm, output_chars=50, tokens_per_sec=0)
+            limits = {host: {"rpm": rpm}} if mode == 'client_limiter' else {}
+            _configure(server, use_openai=True, filename_mode='combined', rate_limits=limits, failover='off')
+            before = _stats(server)
+            with open(os.devnull, 'w') as sink:
+                start = time.perf_counter()
+                failures = main.run_batch('Paste as plain text', inputs, BENCH_DIR / f'ratelimit_{mode}', jobs=8,
+                                          summary=sink)
+                elapsed = time.perf_counter() - start
+            after = _stats(server)
+            results[mode] = {
+                "items": items,
+                "rpm": rpm,
+                "failures": failures,
+                "http_429": after["throttled"] - before["throttled"],
+                "seconds": round(elapsed, 3),
+            }
+    finally:
+        server.set_options(rpm=0, **{k: saved[k] for k in ('output_chars', 'tokens_per_sec')})
+    return results
+
+
+def _stats(server) -> Dict[str, Any]:
+    return main._http().get(f"{server.url}/_stats", timeout=5).json()
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='BetterAdvancedPaste benchmarks')
+    parser.add_argument('--out', default='bench_results.json', help='Where to write the JSON results')
+    parser.add_argument('--only', help=f"Comma-separated subset of: {', '.join(SUITES + EXTRA_SUITES)}")
+    parser.add_argument('--runs', type=int, default=10, help='Repetitions for latency/config timings')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake server time to first token (s)')
+    parser.add_argument('--tokens-per-sec', type=float, default=2000, help='Fake server decode rate')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of failing completions')
+    parser.add_argument('--items', type=int, default=32, help='Inputs for the throughput run')
+    parser.add_argument('--concurrency', default='1,4,8', help='Job counts for the throughput run')
+    parser.add_argument('--sizes-kb', default='16,256,2048', help='Clipboard sizes for the memory run')
+    parser.add_argument('--options', default='100,1000,10000', help='History sizes for the config run')
+    parser.add_argument('--presets', type=int, default=4, help='Presets for the fan-out run')
+    parser.add_argument('--fanout-kb', type=int, default=256, help='Clipboard size for the fan-out run')
+    parser.add_argument('--incremental-kb', type=int, default=64, help='Clipboard size for the incremental run')
+    parser.add_argument('--rpm', type=int, default=60, help='Server-side requests/minute for the ratelimit run')
+    args = parser.parse_args(argv)
+
+    suites = [s.strip() for s in args.only.split(',')] if args.only else list(SUITES)
+    server = ServerProcess(latency=args.latency, tokens_per_sec=args.tokens_per_sec, error_rate=args.error_rate)
+    main.clipboard_text = ''
+    report: Dict[str, Any] = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "server": server.options,
+        "results": {},
+    }
+    try:
+        if 'latency' in suites:
+            report["results"]["latency"] = bench_latency(server, args.runs)
+        if 'throughput' in suites:
+            levels = [int(x) for x in args.concurrency.split(',')]
+            report["results"]["throughput"] = bench_throughput(server, args.items, levels)
+        if 'memory' in suites:
+            sizes = [int(x) for x in args.sizes_kb.split(',')]
+            report["results"]["memory"] = bench_memory(server, sizes)
+        if 'config' in suites:
+            sizes = [int(x) for x in args.options.split(',')]
+            report["results"]["config"] = bench_config(sizes, args.runs)
+        if 'fanout' in suites:
+            report["results"]["fanout"] = bench_fanout(server, args.presets, args.fanout_kb)
+        if 'incremental' in suites:
+            report["results"]["incremental"] = bench_incremental(server, args.incremental_kb)
+        if 'ratelimit' in suites:
+            report["results"]["ratelimit"] = bench_ratelimit(server, args.rpm, args.rpm + args.rpm // 2)
+    finally:
+        server.shutdown()
+    Path(args.out).write_text(json.dumps(report, indent=2) + "\n", encoding='utf-8')
+    print(json.dumps(report["results"], indent=2))
+    print(f"Results written to {args.out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
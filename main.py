@@ -1,19 +1,548 @@
+import time
+_T0 = time.perf_counter()
+_T0_WALL = time.time()
 import json
 from typing import List, Dict, Any
-import webview
 from pathlib import Path
-import requests
-import pyperclip
 import sys
 import argparse
 import getpass
-import keyring
 import os
+import random
+import re
+import tempfile
+import hashlib
+import shutil
+import heapq
+import difflib
+import math
+import socket
+import statistics
+import threading
+import atexit
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+# webview, requests, keyring and pyperclip are imported on first use so that
+# --help, the daemon client and error paths don't pay for them.
+
+# (phase, start offset, duration) in seconds since _T0, for --profile-startup
+STARTUP_PHASES: List[tuple[str, float, float]] = []
+
+
+@contextmanager
+def _phase(name: str, **attrs):
+    """Record the wall time of a phase.
+
+    Inside a paste trace (see _trace) it becomes a span of that trace;
+    otherwise it is a startup phase. Yields the span attributes, which the
+    body may extend.
+    """
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        end = time.perf_counter()
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, start, end, attrs)
+        else:
+            STARTUP_PHASES.append((name, start - _T0, end - start))
+
+
+class PasteTrace:
+    """Timing spans of one paste, exported as a JSONL record (and optionally OTLP)."""
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs: Dict[str, Any] = attrs
+        self.trace_id = os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.status = 'ok'
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.end: float | None = None
+        self.spans: List[Dict[str, Any]] = []
+
+    def add(self, name: str, start: float, end: float, attrs: Dict[str, Any] | None = None) -> None:
+        self.spans.append({"name": name, "start": start, "end": end, "attrs": dict(attrs or {})})
+
+    def record(self) -> Dict[str, Any]:
+        end = self.end or time.perf_counter()
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "time": self.wall_start,
+            "status": self.status,
+            "duration_ms": round((end - self.start) * 1000, 2),
+            "attrs": self.attrs,
+            "spans": [{
+                "name": sp["name"],
+                "offset_ms": round((sp["start"] - self.start) * 1000, 2),
+                "duration_ms": round((sp["end"] - sp["start"]) * 1000, 2),
+                **({"attrs": sp["attrs"]} if sp["attrs"] else {}),
+            } for sp in sorted(self.spans, key=lambda sp: sp["start"])],
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        """Compact per-phase totals for the UI."""
+        totals: Dict[str, float] = {}
+        for sp in self.spans:
+            totals[sp["name"]] = totals.get(sp["name"], 0.0) + (sp["end"] - sp["start"]) * 1000
+        end = self.end or time.perf_counter()
+        return {
+            "total_ms": round((end - self.start) * 1000, 1),
+            "phases": [[name, round(ms, 1)] for name, ms in totals.items()],
+        }
+
+    def otlp(self) -> Dict[str, Any]:
+        """OTLP/HTTP JSON payload (resourceSpans) for this trace."""
+        def ns(t: float) -> str:
+            return str(int((self.wall_start + (t - self.start)) * 1e9))
+
+        def attrs(d: Dict[str, Any]) -> List[Dict[str, Any]]:
+            out = []
+            for k, v in d.items():
+                if isinstance(v, bool):
+                    val = {"boolValue": v}
+                elif isinstance(v, int):
+                    val = {"intValue": str(v)}
+                elif isinstance(v, float):
+                    val = {"doubleValue": v}
+                else:
+                    val = {"stringValue": str(v)}
+                out.append({"key": k, "value": val})
+            return out
+
+        end = self.end or time.perf_counter()
+        spans = [{
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": ns(self.start),
+            "endTimeUnixNano": ns(end),
+            "attributes": attrs(self.attrs),
+            "status": {"code": 2 if self.status == 'error' else 1},
+        }]
+        for sp in self.spans:
+            spans.append({
+                "traceId": self.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": self.span_id,
+                "name": sp["name"],
+                "kind": 1,
+                "startTimeUnixNano": ns(sp["start"]),
+                "endTimeUnixNano": ns(sp["end"]),
+                "attributes": attrs(sp["attrs"]),
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": attrs({"service.name": "BetterAdvancedPaste"})},
+            "scopeSpans": [{"scope": {"name": "BetterAdvancedPaste"}, "spans": spans}],
+        }]}
+
+
+_current_trace: ContextVar[PasteTrace | None] = ContextVar('bap_trace', default=None)
+_trace_logger = None
+
+
+def _trace_log():
+    """JSONL logger writing to traces/trace.jsonl in the config dir, rotated by size."""
+    global _trace_logger
+    if _trace_logger is None:
+        import logging
+        from logging.handlers import RotatingFileHandler
+        path = _app_config_dir() / 'traces' / 'trace.jsonl'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        handler = RotatingFileHandler(
+            str(path), encoding='utf-8', backupCount=3,
+            maxBytes=int(float(AI_SETTINGS.get('trace_max_mb', 5)) * 1024 * 1024))
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger = logging.getLogger('BetterAdvancedPaste.trace')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(handler)
+        _trace_logger = logger
+    return _trace_logger
+
+
+def _export_trace(trace: PasteTrace) -> None:
+    if not AI_SETTINGS.get('trace', True):
+        return
+    try:
+        _trace_log().info(json.dumps(trace.record(), ensure_ascii=False, default=str))
+    except Exception as e:
+        print(f"Failed to write trace: {e}")
+    endpoint = AI_SETTINGS.get('trace_otlp_endpoint')
+    if endpoint:
+        def _send():
+            try:
+                _http().post(endpoint, json=trace.otlp(), timeout=5)
+            except Exception as e:
+                print(f"Failed to export trace: {e}")
+        _get_executor().submit(_send)
+
+
+@contextmanager
+def _trace(name: str, **attrs):
+    """Collect the _phase spans of one paste and export them when done."""
+    trace = PasteTrace(name, **attrs)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.status = 'error'
+        trace.attrs.setdefault('error', str(e))
+        raise
+    finally:
+        trace.end = time.perf_counter()
+        _current_trace.reset(token)
+        _export_trace(trace)
+
+
+class MetricsStore:
+    """Per-request latency/throughput records in metrics/YYYY-MM.jsonl in the config dir.
+
+    One short-keyed JSON line per model request (see _record_request), so a
+    month of heavy use stays in the low megabytes. Files not written to for
+    ``metrics_keep_days`` are deleted when the store is opened.
+    """
+
+    def __init__(self, root: Path, keep_days: float = 90):
+        self.root = root
+        self._lock = threading.Lock()
+        cutoff = time.time() - keep_days * 86400
+        for path in root.glob('*.jsonl') if root.exists() else []:
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def append(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, separators=(',', ':'), ensure_ascii=False, default=str) + '\n'
+        path = self.root / time.strftime('%Y-%m.jsonl', time.localtime(record.get('t', time.time())))
+        with self._lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            # One write per line in append mode: concurrent processes don't interleave
+            with open(path, 'a', encoding='utf-8') as fh:
+                fh.write(line)
+
+    def records(self, since: float = 0.0) -> List[Dict[str, Any]]:
+        out = []
+        for path in sorted(self.root.glob('*.jsonl')) if self.root.exists() else []:
+            with open(path, encoding='utf-8', errors='replace') as fh:
+                for line in fh:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    if isinstance(rec, dict) and rec.get('t', 0) >= since:
+                        out.append(rec)
+        return out
+
+
+_metrics_store: MetricsStore | None = None
+
+
+def _get_metrics_store() -> MetricsStore | None:
+    """Shared metrics store, or None when ``metrics`` is off."""
+    global _metrics_store
+    if not AI_SETTINGS.get('metrics', True):
+        return None
+    if _metrics_store is None:
+        _metrics_store = MetricsStore(_app_config_dir() / 'metrics',
+                                      float(AI_SETTINGS.get('metrics_keep_days', 90)))
+    return _metrics_store
+
+
+def _usage_metrics(body: Dict[str, Any], ttfb_ms: float | None, total_ms: float, stream: bool) -> Dict[str, Any]:
+    """Token counts and rates from llama.cpp ``timings`` or OpenAI ``usage``."""
+    out: Dict[str, Any] = {}
+    timings = body.get('timings')
+    if isinstance(timings, dict):
+        out['pt'] = body.get('tokens_evaluated', timings.get('prompt_n'))
+        out['ct'] = timings.get('predicted_n')
+        out['pc'] = body.get('tokens_cached')
+        if timings.get('prompt_per_second'):
+            out['pps'] = round(float(timings['prompt_per_second']), 1)
+        if timings.get('predicted_per_second'):
+            out['dps'] = round(float(timings['predicted_per_second']), 1)
+    usage = body.get('usage')
+    if isinstance(usage, dict):
+        out.setdefault('pt', usage.get('prompt_tokens'))
+        out.setdefault('ct', usage.get('completion_tokens'))
+        details = usage.get('prompt_tokens_details')
+        if isinstance(details, dict) and details.get('cached_tokens'):
+            out.setdefault('pc', details['cached_tokens'])
+    if out.get('ct') is None and body.get('pieces'):
+        out['ct'] = body['pieces']  # streamed deltas, about one token each
+    if 'dps' not in out and out.get('ct') and stream and ttfb_ms is not None and total_ms > ttfb_ms:
+        # OpenAI reports no rates; after the first token a stream is all decode
+        out['dps'] = round(out['ct'] / ((total_ms - ttfb_ms) / 1000), 1)
+    return out
+
+
+def _request_outcome(exc: BaseException) -> str:
+    job = _current_job.get()
+    if isinstance(exc, PasteCancelled) or (job is not None and job.cancelled.is_set()):
+        return 'cancelled'
+    status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    return f'http_{status}' if status else 'error'
+
+
+def _record_request(kind: str, openai: bool, url: str | None, instruction: str | None, input_chars: int | None,
+                    start: float, ttfb_ms: float | None, outcome: str, stream: bool = False,
+                    body: Dict[str, Any] | None = None) -> None:
+    """Append one model request to the metrics store; never raises.
+
+    *kind* is ``paste`` (a whole paste), ``part`` (chunk, segment, file or
+    manifest of one) or ``filename``. The preset is the first line of the
+    instruction, or of the current trace's instruction.
+    """
+    try:
+        store = _get_metrics_store()
+        if store is None:
+            return
+        body = body if isinstance(body, dict) else {}
+        if instruction is None:
+            trace = _current_trace.get()
+            instruction = trace.attrs.get('instruction') if trace is not None else None
+        total_ms = (time.perf_counter() - start) * 1000
+        record = {
+            "t": round(time.time(), 3),
+            "k": kind,
+            "b": 'openai' if openai else 'local',
+            "u": url,
+            "m": body.get('model') or (OPENAI_MODEL if openai else None),
+            "p": str(instruction).strip().split('\n', 1)[0][:80] if instruction else None,
+            "in": input_chars,
+            "s": 1 if stream else None,
+            "o": outcome,
+            "ttfb": round(ttfb_ms, 1) if ttfb_ms is not None else None,
+            "ms": round(total_ms, 1),
+        }
+        if outcome == 'ok':
+            record.update(_usage_metrics(body, ttfb_ms, total_ms, stream))
+        store.append({k: v for k, v in record.items() if v is not None})
+    except Exception as e:
+        print(f"Failed to record request metrics: {e}")
+
+
+# Upper bounds (chars) of the input size buckets in the --stats report
+STATS_SIZE_BUCKETS = ((1024, '<1K'), (4096, '1-4K'), (16384, '4-16K'), (65536, '16-64K'))
+
+
+def _percentile(sorted_values: List[float], p: float) -> float | None:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def _size_bucket(rec: Dict[str, Any]) -> str | None:
+    size = rec.get('in')
+    if size is None:
+        return None
+    for limit, label in STATS_SIZE_BUCKETS:
+        if size < limit:
+            return label
+    return '64K+'
+
+
+def report_stats(days: float | None = None) -> str:
+    """Text report of the metrics store: p50/p95/p99 per backend, preset, input size and request kind."""
+    text = _format_stats(days)
+    try:
+        # The windowed exe has no console to print to; the file is what it shows
+        path = _app_config_dir() / 'stats_report.txt'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text + "\n", encoding='utf-8')
+        text += f"\n\nReport written to {path}"
+    except Exception as e:
+        print(f"Failed to save stats report: {e}")
+    return text
+
+
+def _format_stats(days: float | None) -> str:
+    _ensure_ai_settings()
+    root = _app_config_dir() / 'metrics'
+    since = time.time() - days * 86400 if days else 0.0
+    records = MetricsStore(root, float(AI_SETTINGS.get('metrics_keep_days', 90))).records(since)
+    if not records:
+        return f"No request metrics recorded yet ({root})"
+    first = time.strftime('%Y-%m-%d', time.localtime(min(r.get('t', 0) for r in records)))
+    lines = [f"{len(records)} requests since {first} ({root})"]
+    sections = (
+        ('backend', lambda r: f"{r.get('b')} {r.get('m') or r.get('u') or ''}".strip()),
+        ('preset', lambda r: r.get('p') if r.get('k') != 'filename' else None),
+        ('input size', lambda r: _size_bucket(r) if r.get('k') != 'filename' else None),
+        ('kind', lambda r: r.get('k')),
+    )
+    header = (f"{'n':>6} {'err%':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttfb50':>7} {'ttfb95':>7} "
+              f"{'prefill t/s':>11} {'decode t/s':>10}")
+
+    def fmt(v: float | None, width: int) -> str:
+        return f"{v:>{width}.0f}" if v is not None else f"{'-':>{width}}"
+
+    for title, key in sections:
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        for r in records:
+            name = key(r)
+            if name is not None:
+                groups.setdefault(name, []).append(r)
+        if not groups:
+            continue
+        width = min(40, max(len(title) + 3, *(len(n) for n in groups)))
+        lines += ['', f"{'By ' + title:<{width}} {header}"]
+        order = [label for _, label in STATS_SIZE_BUCKETS] + ['64K+'] if title == 'input size' else None
+        names = sorted(groups, key=(lambda n: order.index(n)) if order else (lambda n: -len(groups[n])))
+        for name in names:
+            rows = groups[name]
+            ok = [r for r in rows if r.get('o') == 'ok']
+            ms = sorted(r['ms'] for r in ok if 'ms' in r)
+            ttfb = sorted(r['ttfb'] for r in ok if 'ttfb' in r)
+            pps = sorted(r['pps'] for r in ok if 'pps' in r)
+            dps = sorted(r['dps'] for r in ok if 'dps' in r)
+            label = name if len(name) <= width else name[:width - 1] + '…'
+            lines.append(
+                f"{label:<{width}} {len(rows):>6} {100 * (len(rows) - len(ok)) / len(rows):>5.1f} "
+                f"{fmt(_percentile(ms, 50), 8)} {fmt(_percentile(ms, 95), 8)} {fmt(_percentile(ms, 99), 8)} "
+                f"{fmt(_percentile(ttfb, 50), 7)} {fmt(_percentile(ttfb, 95), 7)} "
+                f"{fmt(_percentile(pps, 50), 11)} {fmt(_percentile(dps, 50), 10)}")
+    return "\n".join(lines)
+
+
+def report_startup(save: bool = True) -> str:
+    """Format the recorded startup phases (and save them as JSON in the config dir)."""
+    lines = [f"{'phase':<28}{'start ms':>10}{'took ms':>10}"]
+    for name, start, took in sorted(STARTUP_PHASES, key=lambda p: p[1]):
+        lines.append(f"{name:<28}{start * 1000:>10.1f}{took * 1000:>10.1f}")
+    lines.append(f"{'total':<28}{'':>10}{(time.perf_counter() - _T0) * 1000:>10.1f}")
+    text = "\n".join(lines)
+    if save:
+        try:
+            path = _app_config_dir() / 'startup_profile.json'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps([
+                {"phase": n, "start_ms": round(st * 1000, 2), "took_ms": round(t * 1000, 2)}
+                for n, st, t in STARTUP_PHASES
+            ], indent=2) + "\n", encoding='utf-8')
+        except Exception as e:
+            print(f"Failed to save startup profile: {e}")
+    return text
+
 # Defaults (will be overridden by conf.json ai section if present)
 AI_DEFAULTS = {
     "use_openai": False,
-    "local_url": "http://127.0.0.1:8080/completion"
+    "local_url": "http://127.0.0.1:8080/completion",
+    "stream": False,
+    # How the output filename is obtained:
+    #   "followup" - second request after generation, with the output as context
+    #   "combined" - one structured (JSON schema) generation returning both
+    #   "parallel" - concurrent request built from the instruction alone
+    "filename_mode": "followup",
+    # Infer the filename locally (format from the instruction and content,
+    # name from the main class/function or heading) and only ask the model
+    # when unsure; applies to "followup" and chunked pastes
+    "filename_detect": True,
+    # Response cache under the app config dir (LRU by size, plus max age)
+    "cache": True,
+    "cache_max_mb": 200,
+    "cache_max_age_days": 30,
+    # Map-reduce over clipboard chunks: "off" or "auto" (when the clipboard is
+    # larger than chunk_chars)
+    "chunking": "off",
+    "chunk_chars": 6000,
+    # Parallel chunk requests; 0 = llama.cpp slot count from /props (OpenAI: 4)
+    "chunk_workers": 0,
+    # Combine chunk outputs with a final request: "auto" (summary-like
+    # instructions only), true or false
+    "chunk_reduce": "auto",
+    # Re-run only what changed: clipboards over twice segment_chars are split
+    # into content-defined segments whose outputs are cached per instruction,
+    # so after a small edit only the edited segments go to the model (needs
+    # "cache"; like chunking, each segment is converted on its own)
+    "incremental": False,
+    "segment_chars": 2000,
+    # Per-paste timing spans: traces/trace.jsonl in the config dir (rotated at
+    # trace_max_mb), optionally POSTed as OTLP/HTTP JSON to trace_otlp_endpoint
+    # (e.g. "http://127.0.0.1:4318/v1/traces"); trace_show keeps the palette
+    # open briefly with the timing summary after a successful paste
+    "trace": True,
+    "trace_max_mb": 5,
+    "trace_otlp_endpoint": "",
+    "trace_show": False,
+    # Every model request (backend, model, tokens, prefill/decode tokens/s,
+    # TTFB, latency, outcome) is appended to metrics/YYYY-MM.jsonl in the
+    # config dir for main.py --stats; months untouched this long are deleted
+    "metrics": True,
+    "metrics_keep_days": 90,
+    # Seconds; 0 disables. read_timeout is the longest silence between bytes
+    # (a buffered llama.cpp response only starts once generation is done);
+    # total_timeout cancels the whole paste, aborting its requests
+    "connect_timeout": 10,
+    "read_timeout": 300,
+    "total_timeout": 600,
+    # Output tokens per request (n_predict / max_tokens) are sized from the
+    # input and instruction (see _preflight) and capped here; 0 = 2048 for
+    # OpenAI, 4096 for llama.cpp, which is also capped by what is left of the
+    # chosen server's n_ctx from /props.
+    # context_tokens is the OpenAI model's window (0 = unknown, not checked)
+    "max_output_tokens": 0,
+    "context_tokens": 0,
+    # Concurrent lanes when several presets run on one clipboard; each lane
+    # evaluates the clipboard once. 0 = one per local server (OpenAI: 4)
+    "fanout_workers": 0,
+    # Palette jobs run on queue_workers threads; at most queue_max may be
+    # queued or running at once (the "Stay open" palette queues one per Enter)
+    "queue_workers": 2,
+    "queue_max": 16,
+    # Extra llama.cpp servers, load-balanced together with local_url
+    "local_urls": [],
+    # Retry a failed request on the next endpoint: "pool" (other servers of
+    # the same backend), "local" (OpenAI may also fall back to local), "all"
+    # (local may also fall back to OpenAI) or "off"
+    "failover": "pool",
+    # Skip an endpoint for breaker_cooldown_s after this many failures in a row
+    "breaker_failures": 3,
+    "breaker_cooldown_s": 30,
+    # Race a second endpoint when the first hasn't answered after
+    # hedge_after_ms (0 = that endpoint's recent p95); first answer wins
+    "hedge": False,
+    "hedge_after_ms": 0,
+    # Retries after 429/5xx/dropped connections: exponential backoff from
+    # retry_base_ms with jitter, or the server's Retry-After, at most
+    # retry_max_s per wait
+    "retries": 3,
+    "retry_base_ms": 500,
+    "retry_max_s": 30,
+    # Client-side limits per endpoint URL (or host), shared by all jobs:
+    # {"api.groq.com": {"rpm": 30, "tpm": 6000}}
+    "rate_limits": {},
+    # llama.cpp only: evaluate system prompt + clipboard as soon as the
+    # palette opens, and start generating the highlighted preset before
+    # Enter (a wrong guess is cancelled when the selection changes)
+    "speculative_prefill": False,
+    "speculative_generate": False,
+    # Rank presets and saved prompts by embedding similarity to the clipboard
+    # when the palette opens (needs numpy). embedding_url "" = /embedding on
+    # the local_url server (started with --embedding), or /embeddings next to
+    # endpoint with the OpenAI backend (embedding_model)
+    "recommend": False,
+    "recommend_top_k": 5,
+    "embedding_url": "",
+    "embedding_model": "text-embedding-3-small",
 }
+# AI_SETTINGS that shape the generated text; part of the response cache key
+OUTPUT_SETTINGS = ('max_output_tokens', 'context_tokens', 'chunking', 'chunk_chars', 'chunk_reduce',
+                   'incremental', 'segment_chars')
+# Streaming mode keeps only this much of the generated text in memory; it is
+# the context sent along with the filename suggestion request.
+FILENAME_CONTEXT_CHARS = 4000
+# Longest conversation (estimated tokens) the local filename followup re-sends
+# to continue on the same slot; beyond it only the output head is sent
+FOLLOWUP_CONTINUE_TOKENS = 4096
 
 def _resource_path(name: str) -> Path:
     """Return absolute path to a bundled resource (handles PyInstaller/Nuitka)."""
@@ -58,182 +587,3109 @@ def _resolve_config_path() -> Path:
     return _app_config_dir() / 'conf.json'
 
 
-CONFIG_PATH = _resolve_config_path()
+CONFIG_PATH = _resolve_config_path()
+
+# Keyring identifiers
+SERVICE_NAME = "BetterAdvancedPaste"
+USERNAME = getpass.getuser()
+
+def load_ai_settings() -> Dict[str, Any]:
+    data: Dict[str, Any] = {}
+    if CONFIG_PATH.exists():
+        try:
+            data = json.loads(CONFIG_PATH.read_text(encoding='utf-8'))
+        except Exception as e:
+            print(f"Failed to parse conf.json: {e}")
+    ai = data.get('ai') if isinstance(data, dict) else {}
+    if not isinstance(ai, dict):
+        ai = {}
+    merged = {**AI_DEFAULTS, **{k: v for k, v in ai.items() if v is not None}}
+    return merged
+
+def _apply_ai_settings(settings: Dict[str, Any]) -> None:
+    """Bind the module-level AI settings (also used by the daemon to reload conf.json)."""
+    global AI_SETTINGS, USE_OPENAI, OPENAI_API_KEY, OPENAI_MODEL, OPENAI_ENDPOINT, LOCAL_URL, STREAM, FILENAME_MODE
+    global _ai_settings_loaded
+    _ai_settings_loaded = True
+    AI_SETTINGS = settings
+    USE_OPENAI = bool(AI_SETTINGS.get('use_openai'))
+    OPENAI_API_KEY = AI_SETTINGS.get('api_key')
+    OPENAI_MODEL = AI_SETTINGS.get('model')
+    OPENAI_ENDPOINT = AI_SETTINGS.get('endpoint')
+    LOCAL_URL = AI_SETTINGS.get('local_url')
+    STREAM = bool(AI_SETTINGS.get('stream'))
+    FILENAME_MODE = str(AI_SETTINGS.get('filename_mode') or 'followup').lower()
+
+
+AI_SETTINGS: Dict[str, Any] = {}
+USE_OPENAI: bool = False
+OPENAI_API_KEY: str = None
+OPENAI_MODEL: str = None
+OPENAI_ENDPOINT: str = None
+LOCAL_URL: str = None
+STREAM: bool = False
+FILENAME_MODE: str = 'followup'
+_ai_settings_loaded = False
+
+
+def _ensure_ai_settings() -> None:
+    """Load the ai section of conf.json on first use."""
+    if not _ai_settings_loaded:
+        with _phase('config load'):
+            _apply_ai_settings(load_ai_settings())
+
+
+clipboard_text: str | None = None
+
+
+def _get_clipboard() -> str:
+    """Clipboard text captured for this paste (read on first use)."""
+    if clipboard_text is None:
+        return _refresh_clipboard()
+    return clipboard_text
+
+
+def _refresh_clipboard() -> str:
+    """Re-read the clipboard (the daemon serves many pastes from one process)."""
+    global clipboard_text
+    with _phase('clipboard read'):
+        with _phase('import pyperclip'):
+            import pyperclip
+        clipboard_text = pyperclip.paste()
+    return clipboard_text
+
+
+_http_session = None
+
+
+def _http():
+    """Shared requests.Session so connections to the AI endpoint are kept alive."""
+    global _http_session
+    if _http_session is None:
+        with _phase('import requests'):
+            import requests
+        _http_session = requests.Session()
+        # Enough pooled keep-alive connections for every worker and hedge
+        # (the default of 10 would close and reopen the extra ones)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32)
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+        _track_connections(_http_session)
+    return _http_session
+
+
+def _get_keyring_token() -> str | None:
+    try:
+        import keyring
+        return keyring.get_password(SERVICE_NAME, USERNAME)
+    except Exception:
+        return None
+
+
+def _set_keyring_token(value: str | None) -> None:
+    import keyring
+    try:
+        if value:
+            keyring.set_password(SERVICE_NAME, USERNAME, value)
+        else:
+            # empty/None deletes
+            try:
+                keyring.delete_password(SERVICE_NAME, USERNAME)
+            except Exception:
+                pass
+    except Exception as e:
+        raise e
+
+
+# The keyring token is resolved once on a background thread and kept in
+# memory; set_api_token is the only writer, so it updates the copy directly.
+# Secret Service / Credential Manager lookups can take hundreds of ms or
+# block on an unlock prompt, which must not happen inside a paste.
+KEYRING_WAIT_S = 15.0
+KEYRING_STATS: Dict[str, Any] = {"resolve_ms": None}
+_token_lock = threading.Lock()
+_token_ready = threading.Event()
+_token_thread: threading.Thread | None = None
+_token_value: str | None = None
+
+
+def prefetch_api_token() -> None:
+    """Start resolving the keyring token in the background (no-op if already started)."""
+    global _token_thread
+    with _token_lock:
+        if _token_thread is not None or _token_ready.is_set():
+            return
+        _token_thread = threading.Thread(target=_resolve_api_token, name='bap-keyring', daemon=True)
+        _token_thread.start()
+
+
+def _resolve_api_token() -> None:
+    global _token_value
+    with _phase('keyring token') as attrs:
+        start = time.perf_counter()
+        value = _get_keyring_token()
+        KEYRING_STATS['resolve_ms'] = attrs['ms'] = round((time.perf_counter() - start) * 1000, 1)
+    with _token_lock:
+        # set_api_token may have stored a newer value meanwhile
+        if not _token_ready.is_set():
+            _token_value = value
+            _token_ready.set()
+
+
+def _cached_api_token(wait: float = KEYRING_WAIT_S) -> str | None:
+    """Keyring token from memory; waits for the prefetch only if it hasn't finished."""
+    if not _token_ready.is_set():
+        prefetch_api_token()
+        if not _token_ready.wait(wait):
+            print(f"Keyring lookup still pending after {wait:.0f}s; using the configured key.")
+            return None
+    return _token_value
+
+
+def _store_api_token(value: str | None) -> None:
+    global _token_value
+    _set_keyring_token(value)
+    with _token_lock:
+        _token_value = value
+        _token_ready.set()
+
+
+def _extract_text(rj: Dict[str, Any]) -> str | None:
+    """Pull the generated text out of a llama.cpp or OpenAI style response body."""
+    if "content" in rj:
+        content = rj["content"]
+        if isinstance(content, list):
+            return "".join([c.get("text","") for c in content])
+        return str(content)
+    if "choices" in rj and rj["choices"]:
+        # OpenAI style
+        choice = rj["choices"][0]
+        return choice.get("text") or choice.get("message", {}).get("content", "")
+    return None
+
+
+def _extract_delta(event: Dict[str, Any]) -> str:
+    """Pull the text fragment out of one streamed (SSE) event."""
+    if "content" in event:
+        # llama.cpp /completion
+        return str(event.get("content") or "")
+    choices = event.get("choices") or []
+    if choices:
+        choice = choices[0]
+        delta = choice.get("delta") or {}
+        return delta.get("content") or choice.get("text") or ""
+    return ""
+
+
+def _iter_stream(response):
+    """Yield decoded JSON events from a server-sent events response."""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            break
+        try:
+            yield json.loads(payload)
+        except ValueError:
+            continue
+
+
+def _stream_completion(response, sink, on_progress=None, meta=None) -> str:
+    """Write streamed tokens to *sink* as they arrive.
+
+    Returns the leading FILENAME_CONTEXT_CHARS of the output, which is all the
+    filename suggestion needs; the full text is never held in memory. The
+    llama.cpp slot that served the request, the time of the first token and
+    the ``timings``/``usage`` blocks are stored in *meta* if given.
+    """
+    head = ""
+    nbytes = 0
+    tokens = 0
+    last_report = 0.0
+    job = _current_job.get()
+    for event in _iter_stream(response):
+        if job is not None and job.cancelled.is_set():
+            break
+        piece = _extract_delta(event)
+        if piece:
+            if tokens == 0 and meta is not None:
+                meta["first_token"] = time.perf_counter()
+            sink.write(piece)
+            if len(head) < FILENAME_CONTEXT_CHARS:
+                head += piece[:FILENAME_CONTEXT_CHARS - len(head)]
+            nbytes += len(piece.encode('utf-8'))
+            tokens += 1
+            now = time.monotonic()
+            if on_progress and now - last_report >= 0.1:
+                last_report = now
+                on_progress({"bytes": nbytes, "tokens": tokens})
+        if meta is not None:
+            for key in ("id_slot", "timings", "tokens_cached", "tokens_evaluated", "model"):
+                if key in event:
+                    meta[key] = event[key]
+            if event.get("usage"):
+                meta["usage"] = event["usage"]
+        if event.get("stop") is True:
+            break
+    if meta is not None:
+        meta["pieces"] = tokens
+    _check_cancelled()
+    if on_progress:
+        on_progress({"bytes": nbytes, "tokens": tokens, "done": True})
+    return head
+
+
+SYSTEM_PROMPT = "You are a helpful AI that edits text according to user instructions."
+FILENAME_PROMPT = "Suggest a good filename for this script (just the filename, no extra text). The name and extension should be based on the format you were asked to convert the text to, \n STRICTLY EXTENSION BASED ON INSTRUCTION(else file will be not accessible), ALSO NAME BASED ON INSTRUCTION."
+DEFAULT_FILENAME = "advanced_paste_output.txt"
+OPENAI_SAMPLING = {"temperature": 0, "max_tokens": 2048}
+# cache_prompt keeps the evaluated prompt in the slot's KV cache, so a later
+# request with the same prefix (same clipboard, another preset) skips it
+LOCAL_SAMPLING = {"n_predict": -1, "temperature": 0, "top_k": 40, "top_p": 0.95, "repeat_penalty": 1.1,
+                  "cache_prompt": True}
+OPENAI_STOP = ["<|user|>", "<|system|>", "</s>","<|assistant|>"]
+LOCAL_STOP = ["<|user|>", "<|system|>", "</s>","</<|assistant|>","<|assistant|>"]
+
+# Structured output used by filename_mode "combined"; filename comes first so
+# the model commits to the format before writing the content.
+COMBINED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "filename": {"type": "string"},
+        "content": {"type": "string"},
+    },
+    "required": ["filename", "content"],
+    "additionalProperties": False,
+}
+
+class PasteCancelled(RuntimeError):
+    """Raised inside a job that was cancelled or ran past total_timeout."""
+
+
+JOB_ACTIVE = ('queued', 'running')
+
+
+class Job:
+    """One paste running on the API worker pool (see API.start_job).
+
+    Requests made while the job is current tag their HTTP connection with it,
+    so cancel() can shut those sockets down: a blocked read returns at once
+    and llama.cpp sees the disconnect and frees the slot.
+    """
+
+    def __init__(self, instruction: str, total_timeout: float = 0, parent: 'Job | None' = None):
+        self.id = os.urandom(6).hex()
+        self.instruction = instruction
+        self.status = 'running'
+        self.progress: Dict[str, Any] = {}
+        self.result: Dict[str, Any] | None = None
+        self.started = time.time()
+        self.reason: str | None = None
+        self.cancelled = threading.Event()
+        self._conns: set = set()
+        self._lock = threading.Lock()
+        self._timer: threading.Timer | None = None
+        self._children: List[Job] = []
+        if parent is not None:
+            # Sub-requests (e.g. hedged attempts) are cancelled with their paste
+            with parent._lock:
+                parent._children.append(self)
+            if parent.cancelled.is_set():
+                self.cancel(parent.reason or "Cancelled")
+        if total_timeout and total_timeout > 0:
+            self._timer = threading.Timer(total_timeout, self.cancel, (f"Timed out after {total_timeout:g}s",))
+            self._timer.daemon = True
+
+    def run(self, fn, *args, **kwargs):
+        """Call *fn* with this job as the current job (and its timeout armed)."""
+        token = _current_job.set(self)
+        if self._timer:
+            self._timer.start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if self._timer:
+                self._timer.cancel()
+            _current_job.reset(token)
+
+    def attach(self, conn) -> None:
+        with self._lock:
+            self._conns.add(conn)
+
+    def cancel(self, reason: str = "Cancelled") -> bool:
+        if self.cancelled.is_set() or self.status not in JOB_ACTIVE:
+            return False
+        self.reason = reason
+        self.cancelled.set()
+        with self._lock:
+            conns = list(self._conns)
+            children = list(self._children)
+        for child in children:
+            child.cancel(reason)
+        for conn in conns:
+            # Pooled connections may have moved on to another job since
+            if getattr(conn, 'bap_job', None) is not self:
+                continue
+            sock = getattr(conn, 'sock', None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"id": self.id, "status": self.status, "progress": dict(self.progress), "result": self.result}
+
+
+_current_job: ContextVar[Job | None] = ContextVar('bap_job', default=None)
+
+
+def _check_cancelled() -> None:
+    """Raise PasteCancelled if the current job was cancelled (or timed out)."""
+    job = _current_job.get()
+    if job is not None and job.cancelled.is_set():
+        raise PasteCancelled(job.reason or "Cancelled")
+
+
+def _track_connections(session) -> None:
+    """Tag each pooled connection with the job whose request it is carrying."""
+    def tracked(pool_cls):
+        class Connection(pool_cls.ConnectionCls):
+            def request(self, *args, **kwargs):
+                self.bap_job = job = _current_job.get()
+                if job is not None:
+                    job.attach(self)
+                return super().request(*args, **kwargs)
+        return type(pool_cls.__name__, (pool_cls,), {'ConnectionCls': Connection})
+
+    for adapter in session.adapters.values():
+        manager = getattr(adapter, 'poolmanager', None)
+        if manager is not None:
+            manager.pool_classes_by_scheme = {scheme: tracked(cls)
+                                              for scheme, cls in manager.pool_classes_by_scheme.items()}
+
+
+def _timeouts() -> tuple[float | None, float | None]:
+    """``(connect, read)`` timeouts for AI requests from the ai section; 0 disables."""
+    def value(name: str) -> float | None:
+        try:
+            seconds = float(AI_SETTINGS.get(name) or 0)
+        except (TypeError, ValueError):
+            seconds = float(AI_DEFAULTS[name])
+        return seconds if seconds > 0 else None
+    return value('connect_timeout'), value('read_timeout')
+
+
+def _total_timeout() -> float:
+    try:
+        return max(0.0, float(AI_SETTINGS.get('total_timeout') or 0))
+    except (TypeError, ValueError):
+        return float(AI_DEFAULTS['total_timeout'])
+
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Shared worker pool for background AI requests."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='bap')
+    return _executor
+
+
+def _resolve_backend() -> tuple[bool, str | None]:
+    """Return ``(use_openai, api_key)`` for the backend askAI will talk to."""
+    _ensure_ai_settings()
+    # Resolve API key: prefer keyring token if set, else config/env
+    with _phase('key resolution') as attrs:
+        attrs['cached'] = _token_ready.is_set()
+        openai_key_effective = _cached_api_token() or OPENAI_API_KEY
+        attrs['keyring_ms'] = KEYRING_STATS['resolve_ms']
+    # If OpenAI selected but no key, silently fallback to local if available
+    effective_use_openai = USE_OPENAI and bool(openai_key_effective)
+    if USE_OPENAI and not openai_key_effective:
+        print("No API key present; falling back to local model endpoint.")
+        effective_use_openai = False
+    return effective_use_openai, openai_key_effective
+
+
+# Backends (True = OpenAI) that answered the completions of the current paste.
+# The router may fail over to the other backend, which the cache key must reflect.
+_answered_by: ContextVar[set | None] = ContextVar('bap_answered_by', default=None)
+
+
+@contextmanager
+def _track_backends():
+    """Collect into the yielded set which backends answer askAI calls in this block."""
+    outer = _answered_by.get()
+    used: set = set()
+    token = _answered_by.set(used)
+    try:
+        yield used
+    finally:
+        _answered_by.reset(token)
+        if outer is not None:
+            outer.update(used)
+
+
+class Endpoint:
+    """One model server the router can send a completion to, with its health."""
+
+    def __init__(self, url: str, openai: bool):
+        self.url = url
+        self.openai = openai
+        self.key: str | None = None
+        self.latencies: deque = deque(maxlen=64)  # seconds to response headers
+        self.failures = 0  # consecutive
+        self.requests = 0
+        self.errors = 0
+        self.inflight = 0
+        self.open_until = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{'openai' if self.openai else 'local'}:{self.url}"
+
+    def is_open(self, now: float | None = None) -> bool:
+        return self.open_until > (now or time.monotonic())
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < 10:
+            return None
+        s = sorted(self.latencies)
+        return s[int(0.95 * (len(s) - 1))]
+
+    def stats(self) -> Dict[str, Any]:
+        s = sorted(self.latencies)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "inflight": self.inflight,
+            "circuit_open": self.is_open(),
+            "p50_ms": round(s[len(s) // 2] * 1000, 1) if s else None,
+            "p95_ms": round(self.p95() * 1000, 1) if self.p95() is not None else None,
+        }
+
+
+# Statuses worth retrying: rate limited, or the server is (briefly) unwell
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+    """Client-side token buckets for one endpoint: requests and tokens per minute.
+
+    Shared by every job, so concurrent pastes and batch workers together
+    stay under the provider's limits instead of finding them with 429s.
+    A response reporting nothing left (``x-ratelimit-remaining-*: 0``)
+    pauses the endpoint until the reported reset.
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        # Nothing accrues while paused (_stamp is then in the future)
+        elapsed = max(0.0, now - self._stamp)
+        self._stamp = max(self._stamp, now)
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int) -> float:
+        """Block until a request of about *tokens* may go out; returns the seconds waited."""
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                # A request bigger than the whole budget waits for a full bucket
+                need = min(tokens, self.tpm) if self.tpm else 0
+                delay = max(self._paused_until - now,
+                            (1 - self._requests) * 60 / self.rpm if self.rpm else 0.0,
+                            (need - self._tokens) * 60 / self.tpm if self.tpm else 0.0)
+                if delay <= 0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= need
+                    return now - start
+            _sleep(min(delay, 1.0))
+
+    def pause(self, seconds: float) -> None:
+        """Send nothing for *seconds*, then refill from empty (the provider's window restarts)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._stamp = max(self._stamp, self._paused_until)
+            self._requests = min(self._requests, 0.0)
+
+    def observe(self, headers) -> None:
+        """Follow the provider's ``x-ratelimit-remaining-*`` / ``x-ratelimit-reset-*`` headers."""
+        for kind in ('requests', 'tokens'):
+            remaining = _header_number(headers.get(f'x-ratelimit-remaining-{kind}'))
+            if remaining is None:
+                continue
+            with self._lock:
+                if kind == 'requests' and self.rpm:
+                    self._requests = min(self._requests, remaining)
+                elif kind == 'tokens' and self.tpm:
+                    self._tokens = min(self._tokens, remaining)
+            if remaining <= 0:
+                reset = _parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                self.pause(reset if reset is not None else 1.0)
+
+
+_rate_limiters: Dict[tuple[str, float, float], RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def _rate_limiter(url: str) -> RateLimiter | None:
+    """The shared limiter for *url* from ``rate_limits`` (keyed by URL or host), if any."""
+    limits = AI_SETTINGS.get('rate_limits') or {}
+    if not isinstance(limits, dict) or not limits:
+        return None
+    from urllib.parse import urlsplit
+    conf = limits.get(url) or limits.get(urlsplit(url).netloc)
+    if not isinstance(conf, dict):
+        return None
+    try:
+        rpm = max(0.0, float(conf.get('rpm') or 0))
+        tpm = max(0.0, float(conf.get('tpm') or 0))
+    except (TypeError, ValueError):
+        return None
+    if not rpm and not tpm:
+        return None
+    # Keyed by the limits too, so editing conf.json starts a fresh bucket
+    key = (url, rpm, tpm)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(rpm, tpm)
+        return _rate_limiters[key]
+
+
+def _header_number(value: str | None) -> float | None:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _parse_duration(value: str | None) -> float | None:
+    """Seconds in a reset header: ``"20"``, ``"1.5s"``, ``"250ms"``, ``"6m0s"``, ``"1h2m"``."""
+    if not value:
+        return None
+    seconds = _header_number(value)
+    if seconds is not None:
+        return seconds
+    units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value.strip())
+    if not parts:
+        return None
+    return sum(float(n) * units[u] for n, u in parts)
+
+
+def _retry_after(headers) -> float | None:
+    """Server-requested wait from ``Retry-After`` (seconds or HTTP date) or the rate-limit resets."""
+    value = headers.get('retry-after')
+    if value:
+        seconds = _header_number(value)
+        if seconds is None:
+            try:
+                from email.utils import parsedate_to_datetime
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                seconds = None
+        if seconds is not None:
+            return max(0.0, seconds)
+    resets = [_parse_duration(headers.get(f'x-ratelimit-reset-{kind}')) for kind in ('requests', 'tokens')]
+    resets = [r for r in resets if r is not None]
+    return max(resets) if resets else None
+
+
+def _retry_delay(attempt: int, headers=None) -> float:
+    """Seconds before retry *attempt* (1-based): the server's hint, else exponential backoff with jitter."""
+    cap = float(AI_SETTINGS.get('retry_max_s') or 30)
+    hint = _retry_after(headers) if headers is not None else None
+    if hint is not None:
+        return min(hint, cap)
+    backoff = min(cap, float(AI_SETTINGS.get('retry_base_ms') or 500) / 1000 * 2 ** (attempt - 1))
+    # Half fixed, half random: spread out retries from concurrent jobs
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+def _sleep(seconds: float) -> None:
+    """Sleep, waking up early with PasteCancelled if the current job is cancelled."""
+    job = _current_job.get()
+    if job is None:
+        time.sleep(seconds)
+    elif job.cancelled.wait(seconds):
+        raise PasteCancelled(job.reason or "Cancelled")
+
+
+def _estimate_request_tokens(data: Dict[str, Any]) -> int:
+    """Tokens a request counts against a TPM limit: prompt (estimated) plus the output cap."""
+    text = data.get('prompt') or ''.join(str(m.get('content', '')) for m in data.get('messages') or [])
+    output = data.get('max_tokens') or data.get('n_predict') or 0
+    return len(text) // 4 + 1 + max(0, int(output))
+
+
+def _post(url: str, data: Dict[str, Any], headers: Dict[str, str] | None = None, stream: bool = False,
+          failover: bool = False):
+    """POST to a model endpoint through its rate limiter, retrying 429/5xx and dropped connections.
+
+    Up to ``retries`` retries with exponential backoff and jitter, or after
+    the wait the server asks for (``Retry-After``, ``x-ratelimit-reset-*``).
+    With *failover* (the router has another endpoint to try) only 429s are
+    retried; an unreachable or failing server is left at once. The last
+    response is returned whatever its status.
+    """
+    import requests
+    limiter = _rate_limiter(url)
+    tokens = _estimate_request_tokens(data) if limiter else 0
+    try:
+        retries = max(0, int(AI_SETTINGS.get('retries', 3)))
+    except (TypeError, ValueError):
+        retries = 3
+    attempt = 0
+    while True:
+        attempt += 1
+        _check_cancelled()
+        if limiter:
+            with _phase('throttle', tokens=tokens):
+                limiter.acquire(tokens)
+        try:
+            response = _http().post(url, json=data, headers=headers, stream=stream, timeout=_timeouts())
+        except requests.ConnectionError as e:
+            _check_cancelled()
+            if attempt > retries or failover:
+                raise
+            delay, reason = _retry_delay(attempt), type(e).__name__
+        else:
+            if limiter:
+                limiter.observe(response.headers)
+            if (response.status_code not in RETRY_STATUSES or attempt > retries
+                    or (failover and response.status_code != 429)):
+                return response
+            delay, reason = _retry_delay(attempt, response.headers), f"HTTP {response.status_code}"
+            if limiter and response.status_code == 429:
+                limiter.pause(delay)
+            response.close()
+        print(f"[retry] {url}: {reason}; retry {attempt}/{retries} in {delay:.1f}s")
+        with _phase('retry wait', attempt=attempt, reason=reason):
+            _sleep(delay)
+
+
+class BackendRouter:
+    """Picks, fails over between and optionally hedges across model endpoints.
+
+    Candidates are the OpenAI endpoint (when selected and a key is set) and
+    the pool of local servers (``local_url`` plus ``local_urls``), ordered by
+    preference, load and health. An endpoint failing ``breaker_failures``
+    times in a row is skipped for ``breaker_cooldown_s`` (then tried again).
+    """
+
+    HEDGE_LOST = "Lost the hedge"
+
+    def __init__(self):
+        self._endpoints: Dict[tuple[bool, str], Endpoint] = {}
+        self._lock = threading.Lock()
+        self._rr = 0
+        self._pool: ThreadPoolExecutor | None = None
+
+    def _endpoint(self, url: str, openai: bool) -> Endpoint:
+        with self._lock:
+            ep = self._endpoints.get((openai, url))
+            if ep is None:
+                ep = self._endpoints[(openai, url)] = Endpoint(url, openai)
+            return ep
+
+    def local_pool(self) -> List[Endpoint]:
+        extra = AI_SETTINGS.get('local_urls') or []
+        if isinstance(extra, str):
+            extra = [extra]
+        urls = [u for u in dict.fromkeys([LOCAL_URL, *extra]) if u]
+        return [self._endpoint(u, False) for u in urls]
+
+    def candidates(self, use_openai: bool, api_key: str | None) -> List[Endpoint]:
+        """Endpoints to try in order for one request."""
+        mode = str(AI_SETTINGS.get('failover', 'pool')).lower()
+        now = time.monotonic()
+        with self._lock:
+            self._rr += 1
+            rr = self._rr
+        local = self.local_pool()
+        position = {id(ep): (i + rr) % len(local) for i, ep in enumerate(local)}
+        # Least busy first, then fastest; rotate ties so idle servers share load
+        local.sort(key=lambda ep: (ep.is_open(now), ep.inflight,
+                                   round(statistics.median(ep.latencies), 1) if ep.latencies else 0.0,
+                                   position[id(ep)]))
+        remote: List[Endpoint] = []
+        if api_key and OPENAI_ENDPOINT:
+            ep = self._endpoint(OPENAI_ENDPOINT, True)
+            ep.key = api_key
+            remote = [ep]
+        if use_openai:
+            order = remote + (local if mode in ('local', 'all') else [])
+        else:
+            order = local + (remote if mode == 'all' else [])
+        if mode == 'off':
+            order = order[:1]
+        # Open breakers go last: still tried when nothing else is left
+        return sorted(order, key=lambda ep: ep.is_open(now))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            endpoints = list(self._endpoints.values())
+        return {ep.name: ep.stats() for ep in endpoints}
+
+    def _record(self, ep: Endpoint, ok: bool, seconds: float = 0.0) -> None:
+        with self._lock:
+            ep.requests += 1
+            if ok:
+                ep.failures = 0
+                ep.open_until = 0.0
+                ep.latencies.append(seconds)
+                return
+            ep.errors += 1
+            ep.failures += 1
+            threshold = int(AI_SETTINGS.get('breaker_failures') or 3)
+            if ep.failures >= threshold:
+                ep.open_until = time.monotonic() + float(AI_SETTINGS.get('breaker_cooldown_s') or 30)
+                print(f"[router] {ep.name} failed {ep.failures}x; skipping it for now")
+
+    def _attempt(self, ep: Endpoint, build, stream: bool, failover: bool = False):
+        url, data, headers = build(ep)
+        with self._lock:
+            ep.inflight += 1
+        start = time.perf_counter()
+        try:
+            _check_cancelled()
+            # A dead server isn't worth waiting for while another endpoint is left
+            response = _post(url, data, headers, stream=stream, failover=failover)
+            if response.status_code == 429 or response.status_code >= 500:
+                response.close()
+                response.raise_for_status()
+        except Exception as e:
+            job = _current_job.get()
+            if job is not None and job.cancelled.is_set():
+                # Aborted by us, not the endpoint's fault; a lost hedge still
+                # tells us it was at least this slow
+                if job.reason == self.HEDGE_LOST:
+                    with self._lock:
+                        ep.latencies.append(time.perf_counter() - start)
+                raise PasteCancelled(job.reason or "Cancelled") from e
+            self._record(ep, False)
+            raise
+        finally:
+            with self._lock:
+                ep.inflight -= 1
+        # 4xx (bad key, bad request) is a configuration problem, not ill health
+        self._record(ep, True, response.elapsed.total_seconds())
+        return ep, response
+
+    def _hedge_delay(self, ep: Endpoint) -> float | None:
+        if not AI_SETTINGS.get('hedge'):
+            return None
+        fixed = float(AI_SETTINGS.get('hedge_after_ms') or 0)
+        if fixed > 0:
+            return fixed / 1000
+        return ep.p95()
+
+    def send(self, use_openai: bool, api_key: str | None, build, stream: bool = False):
+        """POST the request made by ``build(endpoint) -> (url, data, headers)``.
+
+        Returns ``(endpoint, response)`` from the first endpoint that answers;
+        raises the last error if every candidate fails.
+        """
+        order = self.candidates(use_openai, api_key)
+        if not order:
+            raise RuntimeError("No AI endpoint configured")
+        delay = self._hedge_delay(order[0]) if len(order) > 1 else None
+        if delay is None:
+            error: Exception | None = None
+            for i, ep in enumerate(order):
+                try:
+                    return self._attempt(ep, build, stream, failover=i < len(order) - 1)
+                except PasteCancelled:
+                    raise
+                except Exception as e:
+                    error = e
+                    if len(order) > 1:
+                        print(f"[router] {ep.name} failed ({e}); trying the next endpoint")
+            raise error
+        return self._send_hedged(order, build, stream, delay)
+
+    def _send_hedged(self, order: List[Endpoint], build, stream: bool, delay: float):
+        """Start on order[0]; if it hasn't answered after *delay*, race order[1]."""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='bap-hedge')
+        parent = _current_job.get()
+        running: Dict[Any, Job] = {}
+        pending = list(order)
+        error: Exception | None = None
+
+        def launch():
+            ep = pending.pop(0)
+            job = Job(f"{ep.name}", parent=parent)
+            fut = self._pool.submit(copy_context().run, job.run, self._attempt, ep, build, stream, bool(pending))
+            running[fut] = job
+
+        launch()
+        done, _ = wait(running, timeout=delay)
+        if not done and pending:
+            print(f"[router] no answer after {delay * 1000:.0f} ms; hedging to {pending[0].name}")
+            launch()
+        try:
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    running.pop(fut)
+                    try:
+                        return fut.result()
+                    except PasteCancelled:
+                        _check_cancelled()
+                    except Exception as e:
+                        error = e
+                if not running and pending:
+                    launch()
+            _check_cancelled()
+            raise error or RuntimeError("All endpoints failed")
+        finally:
+            # Abort the loser; a response that arrives anyway is closed unread
+            for fut, job in running.items():
+                job.cancel(self.HEDGE_LOST)
+                fut.add_done_callback(lambda f: f.exception() is None and f.result()[1].close())
+
+
+_backend_router: BackendRouter | None = None
+
+
+def _router() -> BackendRouter:
+    global _backend_router
+    if _backend_router is None:
+        _backend_router = BackendRouter()
+    return _backend_router
+
+
+def _request_filename(use_openai: bool, api_key: str | None, messages_chat: List[Dict[str, str]] | None = None,
+                      prompt: str | None = None, url: str | None = None, slot: int | None = None) -> str:
+    """Best-effort filename request; returns DEFAULT_FILENAME on any failure."""
+    with _phase('filename'):
+        return _request_filename_inner(use_openai, api_key, messages_chat, prompt, url, slot)
+
+
+def _request_filename_inner(use_openai: bool, api_key: str | None, messages_chat: List[Dict[str, str]] | None,
+                            prompt: str | None, url: str | None = None, slot: int | None = None) -> str:
+    try:
+        if use_openai:
+            data = {
+                "model": OPENAI_MODEL,
+                "messages": messages_chat,
+                "temperature": 0,
+                "max_tokens": 50,
+                "stop": OPENAI_STOP
+            }
+            request_url = url or OPENAI_ENDPOINT
+            headers = {"Authorization": f"Bearer {api_key}" if api_key else "",
+                       "Content-Type": "application/json",}
+        else:
+            data = {
+                "prompt": prompt,
+                "n_predict": 50,
+                "temperature": 0,
+                "stop": LOCAL_STOP,
+                "cache_prompt": True,
+            }
+            if slot is not None:
+                data["id_slot"] = slot
+            request_url = url or LOCAL_URL
+            headers = {}
+        _check_cancelled()
+        start = time.perf_counter()
+        try:
+            response = _post(request_url, data, headers)
+        except Exception as e:
+            _record_request('filename', use_openai, request_url, None, None, start, None, _request_outcome(e))
+            raise
+        rj = response.json() if response.status_code == 200 else None
+        _record_request('filename', use_openai, request_url, None, None, start,
+                        response.elapsed.total_seconds() * 1000,
+                        'ok' if rj is not None else f'http_{response.status_code}', body=rj)
+        if rj is not None:
+            return _extract_text(rj) or DEFAULT_FILENAME
+    except Exception:
+        # keep default filename on any error
+        pass
+    return DEFAULT_FILENAME
+
+
+def _filename_from_instruction(use_openai: bool, api_key: str | None, p1: str, instruction: str, sample: str = "") -> str:
+    """Ask for a filename from the instruction (and an optional output *sample*)
+    rather than the whole output; used by filename_mode "parallel" and chunking."""
+    ask = f"The user asked for their clipboard text to be converted with this instruction:\n{instruction}\n\n"
+    if sample:
+        ask += f"The output begins with:\n{sample}\n\n"
+    ask += FILENAME_PROMPT
+    if use_openai:
+        return _request_filename(use_openai, api_key, messages_chat=[
+            {"role": "system", "content": p1},
+            {"role": "user", "content": ask},
+        ])
+    return _request_filename(use_openai, api_key, prompt=f"<|system|>\n{p1}\n<|user|>\n{ask}\n<|assistant|>\n")
+
+
+# --- Local filename detection (skips the filename request when confident) ---
+# Format words in an instruction, most specific first
+INSTRUCTION_FORMATS = [
+    (r'type ?script|\bts\b', 'ts'), (r'java ?script|\bjs\b|node\.?js', 'js'), (r'\bjson\b', 'json'),
+    (r'\bya?ml\b', 'yaml'), (r'\btoml\b', 'toml'), (r'\bcsv\b|comma.separated', 'csv'),
+    (r'\btsv\b|tab.separated', 'tsv'), (r'\bhtml\b|web ?page', 'html'), (r'\bcss\b', 'css'),
+    (r'\bxml\b', 'xml'), (r'mark ?down|\bmd\b', 'md'), (r'\bsql\b', 'sql'), (r'python|\bpy\b', 'py'),
+    (r'power ?shell|\bps1\b', 'ps1'), (r'\bbash\b|shell script|\bzsh\b|\bsh\b', 'sh'),
+    (r'c\+\+|\bcpp\b', 'cpp'), (r'c#|c sharp|csharp', 'cs'), (r'\bjava\b', 'java'), (r'\bkotlin\b', 'kt'),
+    (r'\bgolang\b|\bgo (?:code|program|file|source)|\bin go\b', 'go'), (r'\brust\b', 'rs'),
+    (r'\bruby\b', 'rb'), (r'\bphp\b', 'php'), (r'\bswift\b', 'swift'), (r'\blatex\b|\btex\b', 'tex'),
+    (r'\blua\b', 'lua'), (r'\bhaskell\b', 'hs'), (r'\bscala\b', 'scala'), (r'\bdart\b', 'dart'),
+    (r'\bperl\b', 'pl'), (r'\belixir\b', 'ex'), (r'\bini\b', 'ini'), (r'\bdockerfile\b', 'Dockerfile'), (r'\bmakefile\b', 'Makefile'),
+    (r'plain ?text|\btxt\b|\btext\b', 'txt'),
+]
+# Code-fence / shebang language names
+LANGUAGE_EXTS = {
+    'python': 'py', 'py': 'py', 'python3': 'py', 'javascript': 'js', 'js': 'js', 'node': 'js',
+    'typescript': 'ts', 'ts': 'ts', 'json': 'json', 'yaml': 'yaml', 'yml': 'yaml', 'toml': 'toml',
+    'csv': 'csv', 'html': 'html', 'css': 'css', 'xml': 'xml', 'markdown': 'md', 'md': 'md', 'sql': 'sql',
+    'bash': 'sh', 'sh': 'sh', 'shell': 'sh', 'zsh': 'sh', 'powershell': 'ps1', 'ps1': 'ps1',
+    'cpp': 'cpp', 'c++': 'cpp', 'c': 'c', 'csharp': 'cs', 'cs': 'cs', 'java': 'java', 'kotlin': 'kt',
+    'go': 'go', 'golang': 'go', 'rust': 'rs', 'rs': 'rs', 'ruby': 'rb', 'rb': 'rb', 'perl': 'pl',
+    'php': 'php', 'swift': 'swift', 'latex': 'tex', 'tex': 'tex', 'ini': 'ini',
+}
+# Keyword-frequency tables: (pattern, weight) per extension
+CODE_KEYWORDS: Dict[str, List[tuple[str, float]]] = {
+    'py': [(r'^\s*def \w+\(.*\):', 3), (r'^\s*(?:from [\w.]+ )?import \w', 2), (r'\bself\b', 1),
+           (r'^\s*elif\b', 2), (r'\bNone\b', 1), (r'^\s*class \w+(?:\(.*\))?:', 3), (r'print\(', 1)],
+    'js': [(r'\bfunction\b', 2), (r'\bconst \w+ =', 2), (r'\blet \w+', 1), (r'=>', 1), (r'console\.log', 2),
+           (r'require\(', 2), (r'module\.exports', 3)],
+    'ts': [(r'\binterface \w+', 3), (r':\s*(?:string|number|boolean)\b', 3), (r'\bexport (?:type|interface)\b', 3),
+           (r'\bconst \w+:\s*\w', 2)],
+    'java': [(r'\bpublic (?:final )?class\b', 3), (r'static void main', 3), (r'System\.out', 3),
+             (r'\bprivate (?:final )?\w+ \w+;', 2), (r'^\s*import java\.', 3)],
+    'cs': [(r'^\s*using System', 3), (r'\bnamespace \w+', 2), (r'Console\.Write', 3), (r'\{ get; set; \}', 3)],
+    'cpp': [(r'#include <\w+>', 2), (r'std::', 3), (r'\bcout\b', 2), (r'\btemplate\s*<', 2)],
+    'c': [(r'#include <\w+\.h>', 3), (r'\bprintf\(', 2), (r'\bmalloc\(', 2), (r'int main\(', 1)],
+    'go': [(r'^package \w+', 3), (r'\bfunc \w*\(', 3), (r':=', 1), (r'\bfmt\.', 3)],
+    'rs': [(r'\bfn \w+', 3), (r'\blet mut\b', 3), (r'\bimpl\b', 2), (r'println!', 3), (r'\bpub fn\b', 2)],
+    'rb': [(r'^\s*def \w+[^:]*$', 2), (r'^\s*end$', 2), (r'\bputs\b', 2), (r'\bdo \|', 3), (r"^\s*require '", 2)],
+    'php': [(r'<\?php', 5), (r'\$\w+\s*=', 1), (r'\becho\b', 1), (r'->\w+\(', 1)],
+    'sql': [(r'\bSELECT\b', 2), (r'\bFROM\b', 1), (r'\bWHERE\b', 1), (r'\bCREATE TABLE\b', 3),
+            (r'\bINSERT INTO\b', 3), (r'\bJOIN\b', 1)],
+    'sh': [(r'^\s*(?:if|while) \[', 2), (r'^\s*fi$', 3), (r'^\s*done$', 2), (r'\$\(', 1), (r'^\s*export \w+=', 2),
+           (r'^\s*echo ', 1)],
+    'ps1': [(r'\b(?:Get|Set|New|Write)-\w+', 3), (r'\$_\b', 2), (r'\bparam\(', 2)],
+    'css': [(r'^[.#]?[\w-]+(?:[ ,>:.#][\w-]+)*\s*\{', 2), (r'^\s*[\w-]+:\s*[^;{]+;\s*$', 1)],
+}
+FILENAME_STOPWORDS = {
+    'paste', 'as', 'convert', 'converted', 'to', 'into', 'a', 'an', 'the', 'in', 'format', 'formatted', 'file',
+    'this', 'it', 'please', 'make', 'turn', 'write', 'rewrite', 'create', 'generate', 'output', 'text', 'plain',
+    'script', 'code', 'program', 'from', 'with', 'and', 'of', 'for', 'my', 'me', 'clipboard', 'that',
+    'fix', 'clean', 'cleanup', 'tidy', 'improve', 'refactor', 'reformat', 'correct', 'edit', 'update', 'up',
+    'summarize', 'summarise', 'summary', 'tldr', 'explain', 'translate', 'rephrase', 'shorten', 'simplify',
+}
+# Name for instructions that are only a verb ("summarize this")
+FILENAME_VERB_NOUNS = {'summarize': 'summary', 'summarise': 'summary', 'tldr': 'summary', 'explain': 'explanation',
+                       'translate': 'translation', 'rephrase': 'rephrased', 'simplify': 'simplified'}
+# Below this the filename request is still made
+FILENAME_DETECT_MIN = 0.6
+# A format named right after one of these ("to yaml", "as python", "write a
+# bash script") is the output format; other mentions ("explain this java
+# code") name the input. Fillers between cue and format are skipped.
+FORMAT_TARGET_CUES = {'to', 'into', 'as', 'in', 'write', 'make', 'create', 'generate', 'produce', 'build', 'output', 'save'}
+FORMAT_FILLERS = {'a', 'an', 'the', 'valid', 'proper', 'simple', 'small', 'single', 'new', 'clean', 'pretty',
+                  'nice', 'idiomatic', 'modern', 'well', 'formatted', 'plain'}
+
+_compiled_patterns: Dict[str, Any] = {}
+
+
+def _rx(pattern: str):
+    rx = _compiled_patterns.get(pattern)
+    if rx is None:
+        rx = _compiled_patterns[pattern] = re.compile(pattern, re.I | re.M)
+    return rx
+
+
+def _instruction_formats(instruction: str) -> List[tuple[int, int, str]]:
+    """Every format named in *instruction* as ``(start, end, ext)``, in order.
+
+    Earlier INSTRUCTION_FORMATS entries win overlaps ("powershell script" is ps1, not sh).
+    """
+    found: List[tuple[int, int, str]] = []
+    for pattern, ext in INSTRUCTION_FORMATS:
+        for m in _rx(pattern).finditer(instruction):
+            if not any(m.start() < end and start < m.end() for start, end, _ in found):
+                found.append((m.start(), m.end(), ext))
+    return sorted(found)
+
+
+def _instruction_ext(instruction: str) -> str | None:
+    """The output format the instruction asks for, or None if it names none.
+
+    Only formats after a FORMAT_TARGET_CUES word count, or one that opens
+    the instruction as "<format>" or "<format> script ...", so "convert this
+    json to yaml" is yaml and "explain this java code" names no output format.
+    """
+    for start, end, ext in _instruction_formats(instruction):
+        words = re.findall(r'[\w#+]+', instruction[:start].lower())
+        while words and words[-1] in FORMAT_FILLERS:
+            words.pop()
+        if words:
+            if words[-1] in FORMAT_TARGET_CUES:
+                return ext
+        elif re.match(r'\W*(?:$|(?:script|program|function|class|module|snippet)s?\b)', instruction[end:], re.I):
+            return ext
+    return None
+
+
+def _content_ext(content: str) -> tuple[str | None, float]:
+    """Guess the format of *content*: ``(ext, confidence 0..1)``."""
+    head = content.lstrip()[:4000]
+    if not head:
+        return None, 0.0
+    first = head.split('\n', 1)[0].strip()
+    if first.startswith('#!'):
+        for name in re.split(r'[/\s]+', first[2:]):
+            if name.rstrip('0123456789.') in LANGUAGE_EXTS:
+                return LANGUAGE_EXTS[name.rstrip('0123456789.')], 0.95
+    if first.startswith('```') and first[3:].strip().lower() in LANGUAGE_EXTS:
+        return LANGUAGE_EXTS[first[3:].strip().lower()], 0.9
+    if head[0] in '{[':
+        try:
+            json.loads(content)
+            return 'json', 0.95
+        except ValueError:
+            pass
+    lowered = head[:200].lower()
+    if lowered.startswith('<!doctype html') or lowered.startswith('<html'):
+        return 'html', 0.95
+    if lowered.startswith('<?xml'):
+        return 'xml', 0.95
+    if lowered.startswith('<?php'):
+        return 'php', 0.95
+    lines = [l for l in head.splitlines() if l.strip()][:50]
+    # Delimited tables: the same (non-zero) number of separators on every line
+    for sep, ext in ((',', 'csv'), ('\t', 'tsv')):
+        counts = {l.count(sep) for l in lines}
+        if len(lines) >= 3 and len(counts) == 1 and counts.pop() >= 1:
+            return ext, 0.85
+    scores = {ext: sum(weight * len(_rx(p).findall(head)) for p, weight in table)
+              for ext, table in CODE_KEYWORDS.items()}
+    best = max(scores, key=scores.get)
+    ranked = sorted(scores.values(), reverse=True)
+    if ranked[0] >= 4:
+        # Confident when the best language clearly beats the runner-up
+        return best, min(0.9, 0.5 + 0.4 * (ranked[0] - ranked[1]) / ranked[0])
+    if head.startswith('<') and re.search(r'</\w+>\s*$', head):
+        return 'xml', 0.6
+    # Block YAML: key lines, "- item" sequence lines and "---"; a top-level
+    # key tells it apart from a Markdown bullet list
+    yaml_lines = sum(1 for l in lines if re.match(r'\s*(?:(?:- )?[\w"\'-]+:(?: |$)|- \S|-$|---\s*$)', l))
+    top_keys = any(re.match(r'[\w"\'-]+:(?: |$)', l) for l in lines)
+    if len(lines) >= 2 and top_keys and yaml_lines / len(lines) >= 0.8:
+        return 'yaml', 0.8
+    markdown = sum(1 for l in lines if re.match(r'\s*(?:#{1,6} |[-*+] |\d+\. |```|\|.*\|$|> )', l))
+    if lines and markdown / len(lines) >= 0.3:
+        return 'md', 0.7
+    if ranked[0] == 0 and not re.search(r'[{};]', head):
+        return 'txt', 0.75
+    return None, 0.0
+
+
+def _slug(words: str, sep: str = '_') -> str:
+    return sep.join(re.findall(r'[a-z0-9]+', words.lower()))[:48].strip(sep)
+
+
+def _salient_name(ext: str, content: str) -> str | None:
+    """Name from the content: main class / function, package, heading or title."""
+    head = content[:8000]
+    if ext == 'java' or ext == 'kt':
+        # Case-sensitive declaration at a line start, so prose ("that class") never matches
+        m = re.search(r'^\s*(?:(?:public|private|protected|internal|open|abstract|final|sealed|data)\s+)*'
+                      r'class ([A-Z]\w*)', head, re.M)
+        return m.group(1) if m else None  # Java needs the class name as is
+    patterns = {
+        'py': [r'^class (\w+)', r'^def (?!main\b)(\w+)'],
+        'js': [r'^(?:export )?(?:default )?class (\w+)', r'^(?:export )?(?:async )?function (\w+)',
+               r'^(?:export )?const (\w+) = (?:async )?\('],
+        'ts': [r'^(?:export )?(?:default )?class (\w+)', r'^(?:export )?interface (\w+)',
+               r'^(?:export )?(?:async )?function (\w+)'],
+        'cs': [r'\bclass (\w+)'], 'cpp': [r'^class (\w+)', r'^\w[\w:<>]* (?!main\b)(\w+)\('],
+        'go': [r'^package (?!main\b)(\w+)', r'^func (?!main\b)(\w+)'], 'rs': [r'^(?:pub )?struct (\w+)', r'^(?:pub )?fn (?!main\b)(\w+)'],
+        'rb': [r'^class (\w+)', r'^def (\w+)'], 'php': [r'\bclass (\w+)', r'\bfunction (\w+)'],
+        'sql': [r'CREATE TABLE (?:IF NOT EXISTS )?[`"\[]?(\w+)', r'\bFROM [`"\[]?(\w+)'],
+        'sh': [r'^(\w+)\s*\(\)\s*\{'], 'ps1': [r'^function ([\w-]+)'],
+        'md': [r'^#{1,2} (.+)$'], 'html': [r'<title>([^<]+)</title>', r'<h1[^>]*>([^<]+)</h1>'],
+    }
+    if ext in ('c', 'cpp', 'go', 'rs') and _rx(r'^\s*(?:int |fn |func )main\(').search(head):
+        return 'main'
+    for pattern in patterns.get(ext, []):
+        m = _rx(pattern).search(head)
+        if m:
+            name = m.group(1)
+            # CamelCase -> snake_case
+            name = re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', name)
+            return _slug(name, '-' if ext == 'ps1' else '_') or None
+    return None
+
+
+def _detect_filename(instruction: str, content: str) -> tuple[str, float]:
+    """Filename for *content* without a model call: ``(filename, confidence 0..1)``.
+
+    The extension is the format the instruction asks for ("as python"),
+    else the content's (shebang, code fence, JSON/HTML/CSV/YAML/Markdown
+    signatures, keyword frequencies); the name from the main class or
+    function, heading or title, else from the instruction's remaining words.
+    """
+    asked = _instruction_ext(instruction)
+    seen, seen_conf = _content_ext(content)
+    if asked in ('Dockerfile', 'Makefile'):
+        return asked, 0.9
+    if asked:
+        # What the user asked for beats a guess from the content
+        ext, conf = asked, 0.95 if seen == asked else 0.75
+    else:
+        ext, conf = seen, seen_conf
+        if not _instruction_formats(instruction) and \
+                _rx(r'\b(?:script|code|program|function|class|module)\b').search(instruction):
+            # Code in a language we have no table for would be saved as .txt
+            conf *= 0.6
+    if not ext:
+        return DEFAULT_FILENAME, 0.0
+    name = _salient_name(ext, content)
+    if not name:
+        words = [w for w in re.findall(r'[a-z0-9]+', instruction.lower())
+                 if w not in FILENAME_STOPWORDS and not _instruction_formats(w)]
+        verbs = [FILENAME_VERB_NOUNS[w] for w in re.findall(r'[a-z]+', instruction.lower()) if w in FILENAME_VERB_NOUNS]
+        # Prose and tables: the opening words (or column names) say what it is
+        lead = ''
+        if ext in ('txt', 'md', 'csv', 'tsv') and not verbs:
+            first = next((l for l in content.splitlines() if l.strip()), '')
+            lead = ' '.join([w for w in re.findall(r'[A-Za-z]{3,}', first)][:3])
+        name = _slug(' '.join(words[:5])) or (verbs[0] if verbs else _slug(lead) or 'pasted')
+        conf *= 0.9
+    return f"{name}.{ext}", conf
+
+
+def _local_filename(instruction: str, content: str) -> str | None:
+    """The detected filename when ``filename_detect`` is on and it is confident enough."""
+    if not AI_SETTINGS.get('filename_detect', True):
+        return None
+    with _phase('filename detect') as span:
+        filename, confidence = _detect_filename(instruction, content)
+        span.update(filename=filename, confidence=round(confidence, 2))
+    return filename if confidence >= FILENAME_DETECT_MIN else None
+
+
+def _split_combined(x: str) -> tuple[str, str]:
+    """Parse a filename_mode "combined" response into ``(content, filename)``."""
+    try:
+        obj = json.loads(x)
+    except ValueError:
+        raise RuntimeError("AI response was not valid structured JSON")
+    if not isinstance(obj, dict) or not isinstance(obj.get("content"), str):
+        raise RuntimeError("AI response missing expected fields")
+    return obj["content"], str(obj.get("filename") or DEFAULT_FILENAME)
+
+
+PROMPT_HEADER = """
+System message:
+You're clipboard assistant(meant to paste the clipboard text as per user instruction), you are supposed to convert text to output text as per instruction and give just output not your thoughts, or explanation or title, or formatting, just direct plaintext output, else you may harm the system
+Edit the following text according to the instruction:
+
+Text:
+"""
+
+
+def _user_prompt(text: str, instruction: str) -> str:
+    # The instruction goes last: everything before it depends only on the
+    # clipboard, so several presets over one clipboard share a cached prefix
+    return f"{PROMPT_HEADER}{text}\n\nInstruction:\n{instruction}\n"
+
+
+def _local_prompt(system: str, user: str) -> str:
+    return f"""<|system|>
+{system}
+<|user|>
+{user}
+<|assistant|>
+"""
+
+
+class ContextOverflow(RuntimeError):
+    """The prompt plus a minimal output doesn't fit the model's context."""
+
+    def __init__(self, message: str, fit_chars: int):
+        super().__init__(message)
+        self.fit_chars = fit_chars  # clipboard chars per request that would fit
+
+
+# Output budget = input tokens x ratio + BUDGET_BASE, capped by
+# max_output_tokens and (llama.cpp) by what is left of the context.
+# Open-ended instructions (GENERATE_PATTERN) and structured output get the
+# cap itself: a one-line description can ask for a long script.
+BUDGET_BASE = 256
+BUDGET_RATIO = 1.5          # conversions: output about as long as the input
+BUDGET_RATIO_REDUCE = 0.5   # summary-like instructions (REDUCE_KEYWORDS)
+GENERATE_PATTERN = r'\b(?:write|generate|create|make|build|compose|draft|expand|elaborate|implement|scaffold|continue|extend)\b'
+MIN_OUTPUT_TOKENS = 256
+# When max_output_tokens is 0 (or invalid): the fixed limits used before budgeting
+DEFAULT_OUTPUT_TOKENS = 4096
+DEFAULT_OPENAI_OUTPUT_TOKENS = 2048
+
+_token_counts: "OrderedDict[tuple[str, str], int]" = OrderedDict()
+_context_sizes: Dict[str, int | None] = {}
+
+
+def _count_tokens(text: str, use_openai: bool, url: str | None) -> tuple[int, bool]:
+    """Return ``(tokens, exact)`` for *text*; cached per text hash and endpoint.
+
+    llama.cpp counts come from its /tokenize endpoint; OpenAI counts use
+    tiktoken when it is installed. Otherwise (or on error) it is estimated.
+    """
+    key = (url or OPENAI_MODEL or '', hashlib.sha256(text.encode('utf-8', 'replace')).hexdigest())
+    if key in _token_counts:
+        _token_counts.move_to_end(key)
+        return _token_counts[key], True
+    count = None
+    try:
+        if use_openai:
+            import tiktoken
+            try:
+                enc = tiktoken.encoding_for_model(OPENAI_MODEL or '')
+            except KeyError:
+                enc = tiktoken.get_encoding('cl100k_base')
+            count = len(enc.encode(text, disallowed_special=()))
+        elif url:
+            from urllib.parse import urljoin
+            r = _http().post(urljoin(url, '/tokenize'), json={"content": text}, timeout=_timeouts())
+            if r.status_code == 200:
+                count = len(r.json().get('tokens') or [])
+    except Exception:
+        count = None
+    if count is None:
+        # Rough: ~4 chars per token for English and code
+        return len(text) // 4 + 1, False
+    _token_counts[key] = count
+    while len(_token_counts) > 64:
+        _token_counts.popitem(last=False)
+    return count, True
+
+
+def _context_size(use_openai: bool, url: str | None) -> int | None:
+    """Context window in tokens: llama.cpp /props (per slot), else the configured one."""
+    if use_openai or not url:
+        try:
+            return int(AI_SETTINGS.get('context_tokens') or 0) or None
+        except (TypeError, ValueError):
+            return None
+    if url not in _context_sizes:
+        n_ctx = None
+        try:
+            from urllib.parse import urljoin
+            r = _http().get(urljoin(url, '/props'), timeout=5)
+            if r.status_code == 200:
+                props = r.json()
+                n_ctx = int((props.get('default_generation_settings') or {}).get('n_ctx') or props.get('n_ctx') or 0) or None
+        except Exception:
+            pass
+        _context_sizes[url] = n_ctx
+    return _context_sizes[url]
+
+
+def _fit_chars(n_ctx: int, overhead_tokens: int, reduce: bool, chars_per_token: float) -> int:
+    """Clipboard chars per request that leave room for the expected output."""
+    ratio = BUDGET_RATIO_REDUCE if reduce else BUDGET_RATIO
+    fit_tokens = (n_ctx - overhead_tokens - BUDGET_BASE) / (1 + ratio)
+    return max(500, int(fit_tokens * chars_per_token * 0.9))
+
+
+def _chunk_fit(instruction: str, text: str) -> int | None:
+    """Chunk size in chars that fits the local model's context, if it is known."""
+    use_openai, _ = _resolve_backend()
+    url = OPENAI_ENDPOINT if use_openai else LOCAL_URL
+    urls = [url] if use_openai else [ep.url for ep in _router().local_pool()] or [url]
+    # Any server of the pool may get a chunk, so size for the smallest context
+    sizes = [n for n in (_context_size(use_openai, u) for u in urls) if n]
+    if not sizes:
+        return None
+    n_ctx = min(sizes)
+    tokens, _ = _count_tokens(text, use_openai, url)
+    overhead = len(SYSTEM_PROMPT + _user_prompt('', instruction)) // 3 + 1
+    reduce = any(k in instruction.lower() for k in REDUCE_KEYWORDS)
+    return _fit_chars(n_ctx, overhead, reduce, len(text) / max(1, tokens))
+
+
+def _preflight(use_openai: bool, url: str | None, text: str, instruction: str, overhead: str,
+               open_ended: bool = False) -> int:
+    """Return the output token budget for one request, or raise ContextOverflow.
+
+    *overhead* is the prompt without the clipboard text (system prompt,
+    template, instruction); it is small and only estimated. *open_ended*
+    output (structured JSON) is not sized from the input.
+    """
+    with _phase('preflight') as span:
+        n_ctx = _context_size(use_openai, url)
+        if n_ctx and len(text) + len(overhead) + MIN_OUTPUT_TOKENS < n_ctx // 2:
+            # Fits even at one token per char: an estimate is enough to size the output
+            text_tokens, exact = len(text) // 4 + 1, False
+        else:
+            text_tokens, exact = _count_tokens(text, use_openai, url)
+        prompt_tokens = text_tokens + len(overhead) // 3 + 1
+        reduce = any(k in instruction.lower() for k in REDUCE_KEYWORDS)
+        default = DEFAULT_OPENAI_OUTPUT_TOKENS if use_openai else DEFAULT_OUTPUT_TOKENS
+        try:
+            cap = int(AI_SETTINGS.get('max_output_tokens') or default)
+        except (TypeError, ValueError):
+            cap = default
+        if reduce:
+            budget = min(cap, int(text_tokens * BUDGET_RATIO_REDUCE) + BUDGET_BASE)
+        elif open_ended or _rx(GENERATE_PATTERN).search(instruction):
+            budget = cap
+        else:
+            budget = min(cap, int(text_tokens * BUDGET_RATIO) + BUDGET_BASE)
+        span.update(url=url, prompt_tokens=prompt_tokens, exact=exact, n_ctx=n_ctx)
+        if n_ctx:
+            room = n_ctx - prompt_tokens
+            if room < MIN_OUTPUT_TOKENS:
+                raise ContextOverflow(
+                    f"Clipboard is about {prompt_tokens} tokens but the model context is {n_ctx}; "
+                    f"enable chunking (\"chunking\": \"auto\") or use a larger context",
+                    _fit_chars(n_ctx, prompt_tokens - text_tokens, reduce, len(text) / max(1, text_tokens)))
+            budget = min(budget, room)
+        span['budget'] = budget
+    return budget
+
+
+def askAI(instruction, sink=None, on_progress=None, text=None, suggest_filename=True, slot=None, schema=None):
+    """Run *instruction* over the clipboard and return ``(content, filename)``.
+
+    When streaming is enabled in conf.json and a writable text *sink* is given,
+    the output is written to it incrementally and ``content`` holds only the
+    leading part used for the filename suggestion. *on_progress* receives
+    ``{"bytes": ..., "tokens": ...}`` updates while streaming.
+
+    *text* replaces the clipboard as input. With ``suggest_filename=False``
+    only the content is generated and DEFAULT_FILENAME is returned. *slot*
+    pins a llama.cpp request to that server slot (``id_slot``). *schema*
+    constrains the output to that JSON schema; the JSON text is returned
+    unparsed (no filename, no streaming).
+    """
+    _ensure_ai_settings()
+    _check_cancelled()
+    if text is None:
+        text = _get_clipboard()
+    if suggest_filename and _should_chunk(text):
+        return _ask_chunked(instruction, text, sink, on_progress)
+    p1=SYSTEM_PROMPT
+    p2=_user_prompt(text, instruction)
+    combined = suggest_filename and schema is None and FILENAME_MODE == "combined"
+    if combined:
+        schema = COMBINED_SCHEMA
+        p2 += """
+Respond with a JSON object with two fields: "filename" (a good filename whose name and extension are STRICTLY based on the instruction) and "content" (the output text).
+"""
+    
+    effective_use_openai, openai_key_effective = _resolve_backend()
+    # Size the output and check the context before any expensive request,
+    # per endpoint the router may pick: pool servers can have different n_ctx
+    primary = (OPENAI_ENDPOINT if effective_use_openai else LOCAL_URL)
+    overhead = p1 + p2.replace(text, '', 1)
+    budgets: Dict[str, int] = {}
+    open_ended = schema is not None and not combined  # e.g. a multi-file manifest
+    overflow: ContextOverflow | None = None
+    pool = [primary] if effective_use_openai else [ep.url for ep in _router().local_pool()] or [primary]
+    try:
+        for url in pool:
+            try:
+                budgets[url] = _preflight(effective_use_openai, url, text, instruction, overhead, open_ended)
+            except ContextOverflow as e:
+                overflow = e
+        if not budgets:
+            raise overflow
+    except ContextOverflow as e:
+        if suggest_filename and str(AI_SETTINGS.get('chunking') or 'off').lower() != 'off':
+            print(f"{e}; splitting into chunks of {e.fit_chars} chars")
+            return _ask_chunked(instruction, text, sink, on_progress, max_chars=e.fit_chars)
+        raise
+    # Structured output has to be parsed as a whole, so it is never streamed
+    streaming = STREAM and sink is not None and schema is None
+    messages_chat = [
+        {"role": "system", "content": p1},
+        {"role": "user", "content": p2},
+    ]
+
+    prompt = _local_prompt(p1, p2)
+
+    def _build(ep: Endpoint):
+        """Request for *ep*: chat completion for OpenAI, raw prompt for llama.cpp."""
+        if ep.url not in budgets:
+            # Failover to the other backend; a ContextOverflow here moves the router on
+            budgets[ep.url] = _preflight(ep.openai, ep.url, text, instruction, overhead, open_ended)
+        budget = budgets[ep.url]
+        if ep.openai:
+            data = {
+                "model": OPENAI_MODEL,
+                "messages": messages_chat,
+                **OPENAI_SAMPLING,
+                "max_tokens": budget,
+                "stop": OPENAI_STOP
+            }
+            if schema is not None:
+                data["response_format"] = {
+                    "type": "json_schema",
+                    "json_schema": {"name": "paste_output", "schema": schema, "strict": True},
+                }
+            headers = {"Authorization": f"Bearer {ep.key}" if ep.key else "",
+                       "Content-Type": "application/json",}
+        else:
+            data = {
+                "prompt": prompt,
+                **LOCAL_SAMPLING,
+                "n_predict": budget,
+                "stop": LOCAL_STOP,
+            }
+            if schema is not None:
+                data["json_schema"] = schema
+            if slot is not None:
+                data["id_slot"] = slot
+            headers = {}
+        if streaming:
+            data["stream"] = True
+            if ep.openai:
+                # token counts for the metrics store arrive in a final chunk
+                data["stream_options"] = {"include_usage": True}
+        return ep.url, data, headers
+
+    # Filename from the instruction alone can run alongside the generation
+    filename_future = None
+    if suggest_filename and FILENAME_MODE == "parallel":
+        filename_future = _get_executor().submit(
+            copy_context().run, _filename_from_instruction, effective_use_openai, openai_key_effective, p1, instruction)
+
+    meta: Dict[str, Any] = {}
+    kind = 'paste' if suggest_filename else 'part'
+    ep = None
+    start = time.perf_counter()
+    # Primary completion request: must succeed (on some endpoint) or we fail the action
+    try:
+        with _phase('request', stream=streaming) as span:
+            ep, response = _router().send(effective_use_openai, openai_key_effective, _build, stream=streaming)
+            span['url'] = ep.url
+            # elapsed stops when the response headers arrive
+            span['ttfb_ms'] = round(response.elapsed.total_seconds() * 1000, 2)
+            span['status_code'] = response.status_code
+        response.raise_for_status()
+    except Exception as e:
+        _record_request(kind, ep.openai if ep else effective_use_openai, ep.url if ep else primary, instruction,
+                        len(text), start, None, _request_outcome(e), streaming)
+        _check_cancelled()
+        # Make OpenAI auth/malformed key errors bubble up to stop shutdown
+        raise RuntimeError(f"AI request failed: {e}")
+    answered = _answered_by.get()
+    if answered is not None:
+        answered.add(ep.openai)
+
+    body: Dict[str, Any] = meta
+    try:
+        if streaming:
+            try:
+                with _phase('stream'):
+                    x = _stream_completion(response, sink, on_progress, meta)
+            except PasteCancelled:
+                raise
+            except Exception as e:
+                _check_cancelled()
+                raise RuntimeError(f"AI stream failed: {e}")
+            finally:
+                response.close()
+        else:
+            with _phase('parse'):
+                try:
+                    rj = response.json()
+                except Exception:
+                    _check_cancelled()
+                    raise RuntimeError("AI response was not JSON")
+                x = _extract_text(rj)
+                if isinstance(rj, dict):
+                    body = rj
+                    if "id_slot" in rj:
+                        meta["id_slot"] = rj["id_slot"]
+    except BaseException as e:
+        _record_request(kind, ep.openai, ep.url, instruction, len(text), start, None, _request_outcome(e), streaming)
+        raise
+    # Streams: time to the first token; buffered: time to the response headers
+    ttfb = ((meta["first_token"] - start) * 1000 if "first_token" in meta
+            else response.elapsed.total_seconds() * 1000)
+    _record_request(kind, ep.openai, ep.url, instruction, len(text), start, ttfb,
+                    'ok' if x is not None else 'error', streaming, body)
+    if x is None:
+        raise RuntimeError("AI response missing expected fields")
+
+    if combined:
+        x, filename = _split_combined(x)
+        if not (x or "").strip():
+            raise RuntimeError("AI returned empty result")
+        if sink is not None and STREAM:
+            # Caller expects the output in the sink when streaming is on
+            sink.write(x)
+        return x, filename
+
+    if not (x or "").strip():
+        raise RuntimeError("AI returned empty result")
+    if not suggest_filename:
+        return x, DEFAULT_FILENAME
+    if filename_future is not None:
+        return x, filename_future.result()
+    detected = _local_filename(instruction, x)
+    if detected:
+        return x, detected
+    # Secondary filename suggestion on the endpoint that produced the output:
+    # best-effort; failures fall back to default
+    if ep.openai:
+        messages_chat += [{"role": "assistant", "content": x}]
+        messages_chat += [{"role": "user", "content": FILENAME_PROMPT}]
+        return x, _request_filename(True, ep.key, messages_chat=messages_chat, url=ep.url)
+    # Continue the same conversation on the same slot: the prompt and output
+    # are still in its KV cache, so only the filename question is evaluated.
+    # That re-sends the whole conversation, which a cache miss (evicted slot)
+    # evaluates again, so large ones get only the output, on any slot.
+    prompt2 = f"{prompt}{x}\n<|user|>\n{FILENAME_PROMPT}\n<|assistant|>\n"
+    served = meta.get("id_slot", slot)
+    limit = FOLLOWUP_CONTINUE_TOKENS
+    n_ctx = _context_size(False, ep.url)
+    if n_ctx:
+        limit = min(limit, n_ctx // 2)
+    if served is None or len(prompt2) // 4 > limit:
+        prompt2 = f"<|assistant|>{x[:FILENAME_CONTEXT_CHARS]}\n<|user|>\n{FILENAME_PROMPT}\n<|assistant|>\n"
+        served = None
+    return x, _request_filename(False, None, prompt=prompt2, url=ep.url, slot=served)
+
+REDUCE_KEYWORDS = ('summar', 'tl;dr', 'tldr', 'overview', 'abstract', 'key points', 'gist', 'digest')
+
+
+def _should_chunk(text: str) -> bool:
+    mode = str(AI_SETTINGS.get('chunking') or 'off').lower()
+    if mode == 'auto' and len(text) > _chunk_chars():
+        return True
+    return bool(AI_SETTINGS.get('incremental')) and len(text) > 2 * _segment_chars()
+
+
+def _chunk_chars() -> int:
+    try:
+        return max(500, int(AI_SETTINGS.get('chunk_chars') or 6000))
+    except (TypeError, ValueError):
+        return 6000
+
+
+def _split_blocks(text: str) -> List[str]:
+    """Split text into paragraphs, keeping fenced code blocks whole.
+
+    Blocks keep their trailing blank lines so ``"".join(blocks) == text``.
+    """
+    blocks: List[str] = []
+    current: List[str] = []
+    in_fence = False
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith('```') or stripped.startswith('~~~'):
+            in_fence = not in_fence
+        current.append(line)
+        if not in_fence and not stripped and any(l.strip() for l in current):
+            blocks.append(''.join(current))
+            current = []
+    if current:
+        blocks.append(''.join(current))
+    return blocks
+
+
+def _split_pieces(text: str, max_chars: int) -> List[str]:
+    """Paragraphs/code blocks; blocks over *max_chars* split into lines, longer lines cut hard."""
+    pieces: List[str] = []
+    for block in _split_blocks(text):
+        if len(block) <= max_chars:
+            pieces.append(block)
+            continue
+        for line in block.splitlines(keepends=True):
+            while len(line) > max_chars:
+                pieces.append(line[:max_chars])
+                line = line[max_chars:]
+            if line:
+                pieces.append(line)
+    return pieces
+
+
+def split_chunks(text: str, max_chars: int) -> List[str]:
+    """Pack paragraphs/code blocks into chunks of at most *max_chars*.
+
+    Oversized blocks fall back to line boundaries, and oversized lines are
+    cut hard. Joining the chunks gives back *text*.
+    """
+    chunks: List[str] = []
+    current = ''
+    for piece in _split_pieces(text, max_chars):
+        if current and len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ''
+        current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _segment_chars() -> int:
+    try:
+        return max(200, int(AI_SETTINGS.get('segment_chars') or 2000))
+    except (TypeError, ValueError):
+        return 2000
+
+
+def _segment_boundary(piece: str, target: int) -> bool:
+    """Content-defined cut, decided by the piece alone: about one per *target* chars of text."""
+    h = int.from_bytes(hashlib.blake2b(piece.encode('utf-8', 'replace'), digest_size=4).digest(), 'big')
+    return h < len(piece) / target * 2 ** 32
+
+
+def split_segments(text: str, target: int, max_chars: int) -> List[str]:
+    """Split *text* into segments of about *target* chars at content-defined boundaries.
+
+    A segment ends after a piece (paragraph, or line of a long block) that
+    passes _segment_boundary once it holds a quarter of *target*, or before
+    it would exceed twice *target* (and *max_chars*). Unlike split_chunks, where one inserted line
+    shifts every later chunk, an edit only changes the segments around it;
+    the rest come out identical, so their outputs can be reused.
+    """
+    segments: List[str] = []
+    current = ''
+    limit = min(2 * target, max_chars)
+    for piece in _split_pieces(text, min(target, max_chars)):
+        if current and len(current) + len(piece) > limit:
+            segments.append(current)
+            current = ''
+        current += piece
+        if len(current) >= target // 4 and _segment_boundary(piece, target):
+            segments.append(current)
+            current = ''
+    if current:
+        segments.append(current)
+    return segments
+
+
+def _stitch(parts: List[str]) -> str:
+    """Join chunk outputs in order, keeping each on its own line(s)."""
+    out = ''
+    for part in parts:
+        if out and not out.endswith('\n'):
+            out += '\n'
+        out += part
+    return out
+
+
+_slot_count: int | None = None
+_server_slot_counts: Dict[str, int] = {}
+
+
+def _server_slots(url: str) -> int:
+    """llama.cpp ``total_slots`` of one server from /props (1 when unknown); cached."""
+    if url not in _server_slot_counts:
+        from urllib.parse import urljoin
+        slots = 1
+        try:
+            r = _http().get(urljoin(url, '/props'), timeout=5)
+            if r.status_code == 200:
+                slots = max(1, int(r.json().get('total_slots') or 1))
+        except Exception:
+            pass
+        _server_slot_counts[url] = slots
+    return _server_slot_counts[url]
+
+
+def _chunk_workers(use_openai: bool) -> int:
+    """Parallel chunk requests: configured, else llama.cpp slot count (whole pool), else 4."""
+    global _slot_count
+    try:
+        configured = int(AI_SETTINGS.get('chunk_workers') or 0)
+    except (TypeError, ValueError):
+        configured = 0
+    if configured > 0:
+        return configured
+    if use_openai:
+        return 4
+    if _slot_count is None:
+        # Slots across the whole local pool (local_url + local_urls)
+        _slot_count = max(1, sum(_server_slots(ep.url) for ep in _router().local_pool()))
+    return _slot_count
+
+
+def _wants_reduce(instruction: str) -> bool:
+    setting = AI_SETTINGS.get('chunk_reduce', 'auto')
+    if isinstance(setting, bool):
+        return setting
+    if str(setting).lower() in ('true', 'on', 'yes'):
+        return True
+    if str(setting).lower() in ('false', 'off', 'no'):
+        return False
+    low = instruction.lower()
+    return any(k in low for k in REDUCE_KEYWORDS)
+
+
+# Reduce rounds before giving up on partial results that do not shrink
+MAX_REDUCE_ROUNDS = 4
+REDUCE_INSTRUCTION = "\n\nThe text above is the concatenation of partial results produced from consecutive parts of a larger input. Merge them into a single coherent output that follows the instruction, without repeating content."
+
+
+def _ask_chunked(instruction: str, text: str, sink=None, on_progress=None, max_chars: int | None = None):
+    """Map *instruction* over chunks of *text* in parallel, stitch, optionally reduce.
+
+    Chunk results are written to *sink* in input order as soon as each one
+    (and all before it) has finished, so streaming callers still see early
+    output.
+    """
+    max_chars = min(max_chars or _chunk_fit(instruction, text) or _chunk_chars(), _chunk_chars())
+    segments = _get_segment_cache() if AI_SETTINGS.get('incremental') else None
+    if segments:
+        chunks = split_segments(text, _segment_chars(), max_chars)
+    else:
+        chunks = split_chunks(text, max_chars)
+    use_openai, api_key = _resolve_backend()
+    reduce = _wants_reduce(instruction)
+    workers = min(len(chunks), _chunk_workers(use_openai))
+    print(f"[chunked] {len(chunks)} chunks, {workers} workers, reduce={reduce}")
+    if segments:
+        base = ResponseCache.key(instruction, '', use_openai)
+        keys = [_digest(base + _digest(c)) for c in chunks]
+        previous = _segment_state(segments, base)
+        cached = [segments.get_text(k) for k in keys]
+        with _phase('segment diff', segments=len(chunks)) as attrs:
+            matcher = difflib.SequenceMatcher(None, previous.get('segments') or [], keys, autojunk=False)
+            attrs['changed'] = sum(j2 - j1 for op, _, _, j1, j2 in matcher.get_opcodes() if op != 'equal')
+            attrs['reused'] = sum(c is not None for c in cached)
+        print(f"[incremental] {attrs['changed']} of {len(chunks)} segments changed since the last run, "
+              f"{attrs['reused']} reused from cache")
+    else:
+        keys, cached, previous = [], [None] * len(chunks), {}
+
+    def _map(i: int, chunk: str) -> str:
+        if cached[i] is not None:
+            return cached[i]
+        with _track_backends() as answered:
+            out = askAI(instruction, text=chunk, suggest_filename=False)[0]
+        # Segment keys assume the primary backend; skip outputs a failover produced
+        if segments and answered == {use_openai}:
+            segments.put_text(keys[i], out)
+        return out
+
+    stream_out = sink is not None and STREAM
+    parts: List[str] = []
+    tail = ''
+    nbytes = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bap-chunk') as pool:
+        futures = [pool.submit(copy_context().run, _map, i, c) for i, c in enumerate(chunks)]
+        for i, fut in enumerate(futures):
+            part = fut.result()
+            parts.append(part)
+            if stream_out and not reduce:
+                piece = part if not tail or tail.endswith('\n') else '\n' + part
+                sink.write(piece)
+                tail = piece[-1:] or tail
+                nbytes += len(piece.encode('utf-8'))
+            if on_progress:
+                on_progress({"chunks": len(chunks), "chunks_done": i + 1, "bytes": nbytes, "tokens": 0})
+
+    if reduce:
+        merged = _stitch(parts)
+        # Keep reducing groups of partials until they fit a single request
+        rounds = 0
+        while len(merged) > max_chars and len(parts) > 1:
+            if rounds == MAX_REDUCE_ROUNDS:
+                raise RuntimeError(f"Partial results still exceed one request after {rounds} reduce rounds")
+            groups = split_chunks(merged, max_chars)
+            with ThreadPoolExecutor(max_workers=min(len(groups), workers), thread_name_prefix='bap-chunk') as pool:
+                futures = [pool.submit(copy_context().run, askAI, instruction + REDUCE_INSTRUCTION,
+                                       text=g, suggest_filename=False) for g in groups]
+                reduced = [f.result()[0] for f in futures]
+            rounds += 1
+            stitched = _stitch(reduced)
+            # The model echoing or expanding its input would otherwise loop forever
+            if len(reduced) >= len(parts) and len(stitched) >= len(merged):
+                raise RuntimeError("Reducing the partial results made no progress (output did not shrink)")
+            parts, merged = reduced, stitched
+        content = askAI(instruction + REDUCE_INSTRUCTION, text=merged, suggest_filename=False)[0]
+        if stream_out:
+            sink.write(content)
+    else:
+        content = _stitch(parts)
+
+    filename = _local_filename(instruction, content)
+    if not filename and any(c is not None for c in cached):
+        filename = previous.get('filename')  # mostly the same output as last time
+    if not filename:
+        filename = _filename_from_instruction(
+            use_openai, api_key, SYSTEM_PROMPT, instruction, sample=content[:FILENAME_CONTEXT_CHARS // 4])
+    if segments:
+        _save_segment_state(segments, base, {"segments": keys, "filename": filename})
+    return (content[:FILENAME_CONTEXT_CHARS] if stream_out else content), filename
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of AI outputs.
+
+    Each entry is ``<key>.out`` (the generated text) plus ``<key>.json`` (the
+    filename and creation time). The .out mtime is bumped on every hit, so
+    eviction by oldest mtime is LRU; entries older than *max_age* seconds are
+    dropped regardless.
+    """
+
+    # Hit/miss counters are merged into stats.json at most this often
+    STATS_FLUSH_SECONDS = 5.0
+
+    def __init__(self, root: Path, max_bytes: int, max_age: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._stats_path = root / 'stats.json'
+        self._lock = threading.Lock()
+        self._pending: Dict[str, int] = {}
+        self._flushed = time.monotonic()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def key(instruction: str, text: str | None = None, use_openai: bool | None = None) -> str:
+        """Hash everything that determines the output of askAI(instruction, text=text).
+
+        Pass the already resolved *use_openai* to skip the backend (keyring) lookup.
+        """
+        if use_openai is None:
+            use_openai, _ = _resolve_backend()
+        parts = {
+            "clipboard": _get_clipboard() if text is None else text,
+            "instruction": instruction,
+            "backend": "openai" if use_openai else "local",
+            "model": OPENAI_MODEL if use_openai else None,
+            "endpoint": OPENAI_ENDPOINT if use_openai else [ep.url for ep in _router().local_pool()],
+            "sampling": OPENAI_SAMPLING if use_openai else LOCAL_SAMPLING,
+            "filename_mode": FILENAME_MODE,
+            # Settings that change what gets generated (length, chunk boundaries)
+            "output": {k: AI_SETTINGS.get(k) for k in OUTPUT_SETTINGS},
+        }
+        blob = json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        return hashlib.sha256(blob).hexdigest()
+
+    def get(self, key: str) -> tuple[Path, str] | None:
+        """Return ``(content_path, filename)`` for a fresh entry, counting the hit/miss."""
+        out = self.root / f"{key}.out"
+        meta = self.root / f"{key}.json"
+        try:
+            info = json.loads(meta.read_text(encoding='utf-8'))
+            if time.time() - float(info.get('created', 0)) > self.max_age:
+                raise FileNotFoundError(key)
+            os.utime(out)  # mark as recently used
+            self._count('hits')
+            return out, str(info.get('filename') or DEFAULT_FILENAME)
+        except Exception:
+            self._count('misses')
+            return None
+
+    def has(self, key: str) -> bool:
+        """Whether a fresh entry exists, without counting it or marking it used."""
+        try:
+            info = json.loads((self.root / f"{key}.json").read_text(encoding='utf-8'))
+        except Exception:
+            return False
+        return time.time() - float(info.get('created', 0)) <= self.max_age and (self.root / f"{key}.out").exists()
+
+    def get_text(self, key: str) -> str | None:
+        """Like get, but returns the cached text itself."""
+        hit = self.get(key)
+        if hit is None:
+            return None
+        try:
+            return hit[0].read_text(encoding='utf-8')
+        except OSError:
+            return None
+
+    def put_file(self, key: str, src: Path, filename: str) -> None:
+        """Copy a finished output file into the cache."""
+        self._put(key, filename, lambda tmp: shutil.copyfile(src, tmp))
+
+    def put_text(self, key: str, content: str, filename: str = DEFAULT_FILENAME) -> None:
+        """Store generated text (the per-segment outputs of incremental mode)."""
+        self._put(key, filename, lambda tmp: Path(tmp).write_text(content, encoding='utf-8'))
+
+    def _put(self, key: str, filename: str, write) -> None:
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix='.part', dir=str(self.root))
+            os.close(fd)
+            write(tmp)
+            os.replace(tmp, self.root / f"{key}.out")
+            meta = {"filename": filename, "created": time.time()}
+            (self.root / f"{key}.json").write_text(json.dumps(meta), encoding='utf-8')
+            self._evict()
+        except Exception as e:
+            print(f"Failed to write cache entry: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        self.flush()
+        try:
+            data = json.loads(self._stats_path.read_text(encoding='utf-8'))
+        except Exception:
+            data = {}
+        entries = list(self.root.glob('*.out')) if self.root.exists() else []
+        return {
+            "hits": int(data.get('hits', 0)),
+            "misses": int(data.get('misses', 0)),
+            "entries": len(entries),
+            "bytes": sum(p.stat().st_size for p in entries),
+        }
+
+    def _count(self, field: str) -> None:
+        with self._lock:
+            self._pending[field] = self._pending.get(field, 0) + 1
+            due = time.monotonic() - self._flushed >= self.STATS_FLUSH_SECONDS
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        """Add the pending hit/miss counts to stats.json (locked, so other processes' counts survive)."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.monotonic()
+        if not pending:
+            return
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with _file_lock(self._stats_path.with_name('stats.json.lock')):
+                try:
+                    data = json.loads(self._stats_path.read_text(encoding='utf-8'))
+                except Exception:
+                    data = {}
+                for field, n in pending.items():
+                    data[field] = int(data.get(field, 0)) + n
+                _atomic_write_text(self._stats_path, json.dumps(data))
+        except Exception:
+            pass
+
+    def _evict(self) -> None:
+        now = time.time()
+        entries = []
+        for out in self.root.glob('*.out'):
+            try:
+                st = out.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, out))
+        entries.sort()  # oldest (least recently used) first
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, out in entries:
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                break
+            for p in (out, out.with_suffix('.json')):
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+            total -= size
+
+
+_response_cache: ResponseCache | None = None
+
+
+def _get_response_cache() -> ResponseCache | None:
+    """Shared response cache, or None when disabled in conf.json."""
+    global _response_cache
+    _ensure_ai_settings()
+    if not AI_SETTINGS.get('cache'):
+        return None
+    if _response_cache is None:
+        _response_cache = ResponseCache(
+            _app_config_dir() / 'cache',
+            max_bytes=int(float(AI_SETTINGS.get('cache_max_mb', 200)) * 1024 * 1024),
+            max_age=float(AI_SETTINGS.get('cache_max_age_days', 30)) * 86400,
+        )
+    return _response_cache
+
+
+_segment_cache: ResponseCache | None = None
+
+
+def _flush_caches() -> None:
+    """Write pending hit/miss counts now (os._exit skips the atexit flush)."""
+    for cache in (_response_cache, _segment_cache):
+        if cache is not None:
+            cache.flush()
+
+
+def _get_segment_cache() -> ResponseCache | None:
+    """Per-segment outputs of incremental mode (cache/segments); None when the cache is disabled."""
+    global _segment_cache
+    cache = _get_response_cache()
+    if cache is None:
+        return None
+    if _segment_cache is None:
+        _segment_cache = ResponseCache(cache.root / 'segments', cache.max_bytes, cache.max_age)
+    return _segment_cache
+
+
+def _segment_state(cache: ResponseCache, base: str) -> Dict[str, Any]:
+    """Segment keys and filename of the last incremental run of one instruction (see _ask_chunked)."""
+    try:
+        return json.loads((cache.root / 'last' / f'{base}.json').read_text(encoding='utf-8'))
+    except Exception:
+        return {}
+
+
+def _save_segment_state(cache: ResponseCache, base: str, state: Dict[str, Any]) -> None:
+    try:
+        (cache.root / 'last').mkdir(parents=True, exist_ok=True)
+        _atomic_write_text(cache.root / 'last' / f'{base}.json', json.dumps(state))
+    except Exception as e:
+        print(f"Failed to save segment state: {e}")
+
+
+UNSAFE_FILENAME_CHARS = '<>:"/\\|?*'
+
+
+def _sanitize_filename(name: str) -> str:
+    name = (name or '').strip().replace('\r','').replace('\n','')
+    for ch in UNSAFE_FILENAME_CHARS:
+        name = name.replace(ch, '_')
+    if not name:
+        name = 'advanced_paste_output'
+    if '.' not in name:
+        name += '.txt'
+    return name
+
+
+def _unique_path(path: Path) -> Path:
+    """Reserve *path*, or ``name (2).ext`` etc. if it already exists.
+
+    The name is claimed by creating an empty file, so concurrent batch
+    workers never pick the same one.
+    """
+    n = 2
+    candidate = path
+    while True:
+        try:
+            os.close(os.open(str(candidate), os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            return candidate
+        except FileExistsError:
+            candidate = path.with_name(f"{path.stem} ({n}){path.suffix}")
+            n += 1
+
+
+def _output_path(output_dir: Path, filename_raw: str, unique: bool) -> tuple[Path, str]:
+    # Last point before anything is written: a cancelled paste leaves no file
+    _check_cancelled()
+    with _phase('sanitize'):
+        filename = _sanitize_filename(filename_raw)
+        path = output_dir / filename
+        if unique:
+            path = _unique_path(path)
+    return path, path.name
+
+
+# --- Speculative work while the palette is open ---
+_spec_lock = threading.Lock()
+# Last warm-up prefill: {"digest", "url", "slot", "done": Event, "job"}
+_prefilled: Dict[str, Any] = {}
+# Running guess for the highlighted preset: {"key", "job", "future"}
+_speculative: Dict[str, Any] = {}
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8', 'replace')).hexdigest()
+
+
+def _prefill_prompt(text: str) -> str:
+    """The llama.cpp prompt up to (not including) the instruction; shared by every preset."""
+    full = _local_prompt(SYSTEM_PROMPT, _user_prompt(text, '\0'))
+    return full[:full.rindex('\0')]
+
+
+def speculative_prefill(text: str | None = None) -> None:
+    """Warm llama.cpp's KV cache with the system prompt and clipboard in the background.
+
+    Sends the prompt prefix every preset shares with ``n_predict: 0`` and
+    ``cache_prompt``, so once an instruction is picked only the instruction
+    itself is left to evaluate. Enabled by ``speculative_prefill``; local
+    backend only.
+    """
+    _ensure_ai_settings()
+    if not AI_SETTINGS.get('speculative_prefill'):
+        return
+    done = threading.Event()
+    job = Job('prefill', _total_timeout())
+    with _spec_lock:
+        previous = dict(_prefilled)
+        _prefilled.clear()
+        _prefilled.update(digest=None, url=None, slot=None, done=done, job=job)
+    if previous.get('job') is not None:
+        previous['job'].cancel("Clipboard changed")
+
+    def _run() -> None:
+        try:
+            with _trace('prefill', source='speculative') as trace:
+                try:
+                    job.run(_prefill, text if text is not None else _get_clipboard(), done)
+                except PasteCancelled:
+                    trace.status = 'cancelled'
+        except Exception as e:
+            print(f"Speculative prefill failed: {e}")
+        finally:
+            job.status = 'done'
+            done.set()
+
+    threading.Thread(target=_run, name='bap-prefill', daemon=True).start()
+
+
+def _prefill(text: str, done: threading.Event) -> None:
+    use_openai, _ = _resolve_backend()
+    if use_openai or not text.strip() or _should_chunk(text):
+        return
+    ep = _router().candidates(False, None)[0]
+    n_ctx = _context_size(False, ep.url)
+    if n_ctx and len(text) // 4 > n_ctx:
+        return  # would not fit anyway; the paste gets chunked or rejected
+    start = time.perf_counter()
+    data = {"prompt": _prefill_prompt(text), **LOCAL_SAMPLING, "n_predict": 0, "cache_prompt": True}
+    r = _http().post(ep.url, json=data, timeout=_timeouts())
+    r.raise_for_status()
+    slot = r.json().get('id_slot')
+    with _spec_lock:
+        if _prefilled.get('done') is done:
+            _prefilled.update(digest=_digest(text), url=ep.url, slot=slot)
+    print(f"[speculative] prefilled {len(text)} chars on {ep.url} (slot {slot}) "
+          f"in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+
+def _warm_slot(text: str | None, wait: bool = False) -> int | None:
+    """Slot holding the prefilled *text*, or None to send the request normally.
+
+    A prefill still in flight is cancelled, so a slow prefill never delays
+    the paste it was meant to speed up; background requests (speculative
+    generation) *wait* for it instead. Only meaningful with a single local
+    server (slot ids are per server).
+    """
+    with _spec_lock:
+        state = dict(_prefilled)
+    if not state or len(_router().local_pool()) != 1:
+        return None
+    done = state['done']
+    if wait:
+        while not done.wait(0.05):
+            _check_cancelled()
+    elif not done.is_set():
+        # Frees the slot; llama.cpp keeps whatever part of the prompt it had cached
+        state['job'].cancel("Paste started before the prefill finished")
+        return None
+    if text is None:
+        text = _get_clipboard()
+    with _spec_lock:
+        if _prefilled.get('done') is not done or _prefilled.get('digest') != _digest(text):
+            return None
+        return _prefilled.get('slot')
+
+
+def speculate(instruction: str, text: str | None = None) -> None:
+    """Start generating *instruction* in the background, replacing any earlier guess.
+
+    A paste of the same instruction and clipboard then picks up the result
+    (see _speculative_result). Enabled by ``speculative_generate``; local
+    backend only, since a wrong guess costs GPU time rather than money.
+    """
+    _ensure_ai_settings()
+    if not AI_SETTINGS.get('speculative_generate') or _resolve_backend()[0]:
+        return
+    if text is None:
+        text = _get_clipboard()
+    cache = _get_response_cache()
+    if cache and cache.has(cache.key(instruction, text, use_openai=False)):
+        return
+    key = (instruction, _digest(text))
+    with _spec_lock:
+        if _speculative.get('key') == key:
+            return
+        previous = _speculative.get('job')
+        job = Job(instruction, _total_timeout())
+        future = Future()
+        _speculative.clear()
+        _speculative.update(key=key, job=job, future=future)
+    if previous is not None:
+        previous.cancel("Selection changed")
+
+    def _generate() -> tuple[str, str]:
+        with _trace('speculate', instruction=instruction, source='speculative') as trace:
+            try:
+                return askAI(instruction, text=text, slot=_warm_slot(text, wait=True))
+            except PasteCancelled:
+                trace.status = 'cancelled'
+                raise
+
+    def _run() -> None:
+        try:
+            future.set_result(job.run(_generate))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            job.status = 'done'
+
+    threading.Thread(target=_run, name='bap-speculate', daemon=True).start()
+
+
+def cancel_speculation() -> None:
+    """Drop the running guess and prefill (e.g. the palette was closed)."""
+    with _spec_lock:
+        jobs = [s.get('job') for s in (_speculative, _prefilled)]
+        _speculative.clear()
+    for job in jobs:
+        if job is not None:
+            job.cancel("Palette closed")
+
+
+def _speculative_result(instruction: str, text: str | None) -> tuple[str, str] | None:
+    """``(content, filename)`` of a guess for this paste, or None; other guesses are dropped."""
+    with _spec_lock:
+        state = dict(_speculative)
+        _speculative.clear()
+    if not state:
+        return None
+    job, future = state['job'], state['future']
+    if state['key'] != (instruction, _digest(text if text is not None else _get_clipboard())):
+        job.cancel("Selection changed")
+        return None
+    with _phase('speculation') as span:
+        span['ready'] = future.done()
+        try:
+            while not wait([future], timeout=0.05).done:
+                _check_cancelled()
+        except PasteCancelled:
+            job.cancel("Cancelled")
+            raise
+        try:
+            content, filename = future.result()
+        except Exception as e:
+            span['error'] = str(e)
+            return None  # generate normally
+    return content, filename
+
+
+def paste_to_dir(instruction: str, output_dir: Path, text: str | None = None, no_cache: bool = False,
+                 on_progress=None, unique: bool = False, slot: int | None = None) -> Dict[str, Any]:
+    """Run *instruction* over *text* (default: clipboard) and save the result in *output_dir*.
+
+    Serves from the response cache when possible and streams into a temp
+    file when streaming is enabled. With *unique* an existing file of the
+    same name is kept and a numbered name is used instead.
+    Returns ``{"file", "filename", "cached"}``; raises on failure.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # no_cache skips the lookup but still refreshes the stored entry
+    cache = _get_response_cache()
+    use_openai = _resolve_backend()[0] if cache else False
+    with _phase('cache lookup') as span:
+        key = cache.key(instruction, text, use_openai) if cache else None
+        hit = cache.get(key) if cache and not no_cache else None
+        span['hit'] = bool(hit)
+    guess = None if hit else _speculative_result(instruction, text)
+    if guess is None and not hit and slot is None:
+        slot = _warm_slot(text)
+    with _track_backends() as answered:
+        if hit:
+            src, filename_raw = hit
+            path, filename = _output_path(output_dir, filename_raw, unique)
+            with _phase('write'):
+                shutil.copyfile(src, path)
+        elif guess is not None:
+            content, filename_raw = guess
+            path, filename = _output_path(output_dir, filename_raw, unique)
+            with _phase('write', bytes=len(content)):
+                path.write_text(content, encoding='utf-8')
+        elif STREAM:
+            fd, tmp = tempfile.mkstemp(prefix='.bap-', suffix='.part', dir=str(output_dir))
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                    _, filename_raw = askAI(instruction, sink=fh, on_progress=on_progress, text=text, slot=slot)
+                path, filename = _output_path(output_dir, filename_raw, unique)
+                with _phase('write'):
+                    os.replace(tmp, path)
+            except Exception:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                raise
+        else:
+            content, filename_raw = askAI(instruction, text=text, slot=slot)
+            path, filename = _output_path(output_dir, filename_raw, unique)
+            with _phase('write', bytes=len(content)):
+                path.write_text(content, encoding='utf-8')
+    if cache and not hit:
+        # After a failover the output belongs to the backend that answered
+        if answered and answered != {use_openai}:
+            key = cache.key(instruction, text, answered.pop()) if len(answered) == 1 else None
+        if key:
+            with _phase('cache store'):
+                cache.put_file(key, path, filename)
+    return {"file": str(path), "filename": filename, "cached": bool(hit)}
+
+
+def _fanout_lanes(use_openai: bool) -> int:
+    try:
+        configured = int(AI_SETTINGS.get('fanout_workers') or 0)
+    except (TypeError, ValueError):
+        configured = 0
+    if configured > 0:
+        return configured
+    # Slots don't share KV cache, so every extra lane re-evaluates the clipboard
+    return 4 if use_openai else len(_router().local_pool())
+
+
+def _lane_slot(lane: int, warm: int | None) -> int:
+    if warm is None:
+        return lane
+    return warm if lane == 0 else 0 if lane == warm else lane
+
+
+def paste_many(instructions: List[str], output_dir: Path, text: str | None = None, no_cache: bool = False,
+               on_progress=None) -> List[Dict[str, Any]]:
+    """Apply several *instructions* to one clipboard, writing one file per instruction.
+
+    Work is split into lanes that run concurrently; each lane runs its
+    presets back to back on one llama.cpp slot, so the shared
+    system+clipboard prefix is evaluated once per lane and then reused from
+    the slot's KV cache. By default there is one lane per local server
+    (prefix evaluated once per server); ``fanout_workers`` buys parallel
+    decoding with one extra prefill per lane. Returns one result per
+    instruction, in order, each with ``instruction`` and ``status`` (and
+    ``error`` on failure).
+    """
+    _ensure_ai_settings()
+    if text is None:
+        text = _get_clipboard()
+    use_openai, _ = _resolve_backend()
+    lanes = max(1, min(len(instructions), _fanout_lanes(use_openai)))
+    # Slot ids only mean something on a single server; a pool is balanced by the router
+    pin = not use_openai and len(_router().local_pool()) == 1
+    if pin:
+        # More lanes than slots would send id_slot values the server rejects
+        lanes = min(lanes, _server_slots(_router().local_pool()[0].url))
+    # Lane 0 takes the slot the palette already prefilled with this clipboard
+    warm = _warm_slot(text) if pin else None
+    results: List[Dict[str, Any] | None] = [None] * len(instructions)
+    done = 0
+    lock = threading.Lock()
+
+    def _lane(lane: int) -> None:
+        nonlocal done
+        for i in range(lane, len(instructions), lanes):
+            instruction = instructions[i]
+            with _phase('preset', instruction=instruction, lane=lane):
+                try:
+                    result = paste_to_dir(instruction, output_dir, text=text, no_cache=no_cache, unique=True,
+                                          slot=_lane_slot(lane, warm) if pin else None)
+                    results[i] = {"instruction": instruction, "status": "ok", **result}
+                except PasteCancelled:
+                    raise
+                except Exception as e:
+                    results[i] = {"instruction": instruction, "status": "error", "error": str(e)}
+            with lock:
+                done += 1
+                if on_progress:
+                    on_progress({"presets": len(instructions), "presets_done": done})
+
+    print(f"[fan-out] {len(instructions)} presets, {lanes} lanes")
+    with ThreadPoolExecutor(max_workers=lanes, thread_name_prefix='bap-fanout') as pool:
+        for fut in [pool.submit(copy_context().run, _lane, lane) for lane in range(lanes)]:
+            fut.result()
+    return results
+
+
+# Multi-file mode: a manifest request, then one request per file
+MANIFEST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "files": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"path": {"type": "string"}, "purpose": {"type": "string"}},
+                "required": ["path", "purpose"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["files"],
+    "additionalProperties": False,
+}
+MANIFEST_INSTRUCTION = """Do not write the files yet. Only list the files the instruction above asks for, as JSON:
+{"files": [{"path": "relative/path.ext", "purpose": "one line describing the file"}]}
+Use relative paths with extensions; subdirectories are allowed."""
+MAX_MANIFEST_FILES = 20
+
+
+def _sanitize_relpath(raw: str) -> str:
+    """Sanitize a manifest path: every part like a filename, no drive, root or '..'."""
+    parts = [p.strip().rstrip('.') for p in (raw or '').replace('\\', '/').split('/')]
+    parts = [p for p in parts if p and p != '..']
+    if not parts:
+        return _sanitize_filename('')
+    dirs = [''.join('_' if ch in UNSAFE_FILENAME_CHARS else ch for ch in p) for p in parts[:-1]]
+    return '/'.join(dirs + [_sanitize_filename(parts[-1])])
+
+
+def _manifest(instruction: str, text: str) -> List[Dict[str, str]]:
+    """Ask which files *instruction* should produce: ``[{"path", "purpose"}]``."""
+    with _phase('manifest') as span:
+        raw, _ = askAI(f"{instruction}\n\n{MANIFEST_INSTRUCTION}", text=text, suggest_filename=False,
+                       schema=MANIFEST_SCHEMA)
+        try:
+            obj = json.loads(raw)
+        except ValueError:
+            raise RuntimeError("AI file list was not valid JSON")
+        entries = obj.get('files') if isinstance(obj, dict) else None
+        files: List[Dict[str, str]] = []
+        seen: set[str] = set()
+        for entry in entries if isinstance(entries, list) else []:
+            if not isinstance(entry, dict):
+                continue
+            path = _sanitize_relpath(str(entry.get('path') or ''))
+            if path.lower() in seen:
+                continue
+            seen.add(path.lower())
+            files.append({"path": path, "purpose": str(entry.get('purpose') or '').strip()})
+        if not files:
+            raise RuntimeError("AI returned no files")
+        span['files'] = len(files)
+    return files[:MAX_MANIFEST_FILES]
+
+
+def _file_instruction(instruction: str, files: List[Dict[str, str]], entry: Dict[str, str]) -> str:
+    # Everything but the last line is the same for every file, so llama.cpp
+    # slots reuse the cached clipboard + manifest prefix
+    listing = "\n".join(f"- {f['path']}: {f['purpose']}" for f in files)
+    return (f"{instruction}\n\nThe output is split into these files:\n{listing}\n\n"
+            f"Write only the complete contents of {entry['path']} ({entry['purpose']}).")
+
+
+def _manifest_output_path(output_dir: Path, relpath: str) -> Path:
+    _check_cancelled()
+    path = output_dir.joinpath(*relpath.split('/'))
+    root = output_dir.resolve()
+    if root not in path.resolve().parents:
+        raise RuntimeError(f"Refusing to write outside the output folder: {relpath}")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def paste_files(instruction: str, output_dir: Path, text: str | None = None,
+                on_progress=None) -> List[Dict[str, Any]]:
+    """Multi-file mode: ask for a manifest, then generate every file concurrently.
+
+    The first request returns the file list (paths may include
+    subdirectories); each file is then generated by its own request on a
+    pool as wide as the parallel chunk requests (``chunk_workers``), so the
+    wall time is close to the slowest file. *on_progress* receives
+    ``{"files", "files_done", "file_status": [{"path", "status", "bytes"}]}``.
+    Returns one result per file with ``path``, ``status`` and ``file`` or
+    ``error``; existing files are overwritten, as in the single-file paste.
+    """
+    _ensure_ai_settings()
+    if text is None:
+        text = _get_clipboard()
+    files = _manifest(instruction, text)
+    use_openai, _ = _resolve_backend()
+    workers = max(1, min(len(files), _chunk_workers(use_openai)))
+    status = [{"path": f["path"], "status": "pending", "bytes": 0} for f in files]
+    results: List[Dict[str, Any] | None] = [None] * len(files)
+    done = 0
+    lock = threading.Lock()
+
+    def _report() -> None:
+        if on_progress:
+            on_progress({"files": len(files), "files_done": done, "file_status": [dict(s) for s in status]})
+
+    def _one(i: int) -> None:
+        nonlocal done
+        entry = files[i]
+        with lock:
+            status[i]["status"] = "running"
+            _report()
+        with _phase('file', path=entry["path"]):
+            try:
+                content, _ = askAI(_file_instruction(instruction, files, entry), text=text, suggest_filename=False)
+                path = _manifest_output_path(output_dir, entry["path"])
+                with _phase('write', bytes=len(content)):
+                    path.write_text(content, encoding='utf-8')
+                results[i] = {"path": entry["path"], "status": "ok", "file": str(path)}
+                status[i].update(status="ok", bytes=len(content.encode('utf-8')))
+            except PasteCancelled:
+                raise
+            except Exception as e:
+                results[i] = {"path": entry["path"], "status": "error", "error": str(e)}
+                status[i]["status"] = "error"
+        with lock:
+            done += 1
+            _report()
+
+    print(f"[files] {len(files)} files, {workers} workers: {', '.join(f['path'] for f in files)}")
+    _report()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bap-files') as pool:
+        for fut in [pool.submit(copy_context().run, _one, i) for i in range(len(files))]:
+            fut.result()
+    return results
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """Hold an exclusive advisory lock on *path* (a sidecar .lock file)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a+b') as fh:
+        if sys.platform.startswith('win'):
+            import msvcrt
+            while True:
+                try:
+                    fh.seek(0)
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after ~10s; keep waiting
+                    continue
+            try:
+                yield
+            finally:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    """Write via a temp file + rename so readers never see a partial file."""
+    fd, tmp = tempfile.mkstemp(prefix=f'.{path.name}.', suffix='.tmp', dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+            fh.write(text)
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _normalize_title(title: str) -> str:
+    return ' '.join((title or '').split()).lower()
+
+
+SAVED_PROMPT_DESC = "Saved prompt"
+
+
+class HistoryStore:
+    """Saved prompts and per-prompt usage stats in SQLite.
+
+    Rows with ``saved = 1`` are history entries shown in the palette; rows
+    with ``saved = 0`` only carry usage stats for conf.json presets.
+    Lookups and upserts go through the unique index on the normalized title,
+    so their cost does not grow with the history size.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS prompts (
+            id INTEGER PRIMARY KEY,
+            norm_title TEXT NOT NULL UNIQUE,
+            title TEXT NOT NULL,
+            icon TEXT NOT NULL DEFAULT '{}',
+            color TEXT NOT NULL DEFAULT '#2563eb',
+            desc TEXT NOT NULL DEFAULT '',
+            saved INTEGER NOT NULL DEFAULT 0,
+            use_count INTEGER NOT NULL DEFAULT 0,
+            last_used REAL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS prompts_saved ON prompts(saved, id);
+        CREATE INDEX IF NOT EXISTS prompts_use_count ON prompts(use_count);
+        CREATE INDEX IF NOT EXISTS prompts_last_used ON prompts(last_used);
+        CREATE INDEX IF NOT EXISTS prompts_saved_last_used ON prompts(saved, last_used);
+        CREATE INDEX IF NOT EXISTS prompts_saved_use_count ON prompts(saved, use_count);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, path: Path):
+        import sqlite3
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        # pywebview calls the API from several threads; serialize access
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self.SCHEMA)
+
+    def saved_prompts(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT icon, color, title, desc FROM prompts WHERE saved = 1 ORDER BY id').fetchall()
+        return [{'icon': r[0], 'color': r[1], 'title': r[2], 'desc': r[3]} for r in rows]
+
+    def top(self, limit: int) -> List[Dict[str, Any]]:
+        """Saved prompts among the *limit* most recently used, most often used and oldest.
+
+        All three come from an index (the oldest break ties between unused
+        prompts, as in PresetIndex), so this is what the first page of the
+        palette needs without reading every row.
+        """
+        rows = {}
+        with self._lock:
+            for order in ('last_used DESC', 'use_count DESC', 'id'):
+                for r in self._db.execute(
+                        f'SELECT id, icon, color, title, desc FROM prompts WHERE saved = 1 '
+                        f'ORDER BY {order} LIMIT ?', (int(limit),)):
+                    rows[r[0]] = r
+        return [{'icon': r[1], 'color': r[2], 'title': r[3], 'desc': r[4]} for _, r in sorted(rows.items())]
+
+    def record(self, title: str, saved: bool, icon: str = '{}', color: str = '#2563eb',
+               desc: str = SAVED_PROMPT_DESC) -> bool:
+        """Count one use of *title*; returns True if it became a new saved prompt."""
+        norm = _normalize_title(title)
+        if not norm:
+            return False
+        now = time.time()
+        with self._lock:
+            before = self._db.execute('SELECT saved FROM prompts WHERE norm_title = ?', (norm,)).fetchone()
+            self._db.execute(
+                """INSERT INTO prompts (norm_title, title, icon, color, desc, saved, use_count, last_used, created)
+                   VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?)
+                   ON CONFLICT(norm_title) DO UPDATE SET
+                       use_count = use_count + 1,
+                       last_used = excluded.last_used,
+                       saved = MAX(saved, excluded.saved)""",
+                (norm, title, icon, color, desc, int(saved), now, now))
+        return bool(saved) and not (before and before[0])
+
+    def usage(self, norm_titles: List[str] | None = None) -> Dict[str, tuple[int, float | None]]:
+        """Map normalized title -> (use_count, last_used), for all titles or just *norm_titles*."""
+        with self._lock:
+            if norm_titles is None:
+                rows = self._db.execute('SELECT norm_title, use_count, last_used FROM prompts').fetchall()
+            else:
+                rows = []
+                for title in norm_titles:
+                    rows += self._db.execute('SELECT norm_title, use_count, last_used FROM prompts '
+                                             'WHERE norm_title = ?', (title,)).fetchall()
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    def migrate_from_config(self, config_path: Path) -> int:
+        """One-time move of save_prompt entries from conf.json 'options' into the store.
+
+        Entries whose desc is SAVED_PROMPT_DESC are moved (conf.json is backed
+        up to conf.json.bak and rewritten without them); hand-made presets stay.
+        Returns the number of migrated entries.
+        """
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM meta WHERE key = 'migrated_options'").fetchone():
+                return 0
+        moved = 0
+        with _file_lock(config_path.with_name(config_path.name + '.lock')):
+            try:
+                data = json.loads(config_path.read_text(encoding='utf-8')) if config_path.exists() else {}
+            except Exception as e:
+                print(f"History migration skipped, conf.json unreadable: {e}")
+                return 0
+            options = data.get('options') if isinstance(data, dict) else None
+            keep = []
+            now = time.time()
+            with self._lock:
+                self._db.execute('BEGIN')
+                try:
+                    for o in options if isinstance(options, list) else []:
+                        if isinstance(o, dict) and o.get('title') and o.get('desc') == SAVED_PROMPT_DESC:
+                            self._db.execute(
+                                """INSERT INTO prompts (norm_title, title, icon, color, desc, saved, created)
+                                   VALUES (?, ?, ?, ?, ?, 1, ?)
+                                   ON CONFLICT(norm_title) DO UPDATE SET saved = 1""",
+                                (_normalize_title(o['title']), o['title'], o.get('icon', '{}'),
+                                 o.get('color', '#2563eb'), SAVED_PROMPT_DESC, now))
+                            moved += 1
+                        else:
+                            keep.append(o)
+                    self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_options', ?)",
+                                     (str(now),))
+                    self._db.execute('COMMIT')
+                except Exception:
+                    self._db.execute('ROLLBACK')
+                    raise
+            if moved:
+                try:
+                    shutil.copyfile(config_path, config_path.with_name(config_path.name + '.bak'))
+                    data['options'] = keep
+                    _atomic_write_text(config_path, json.dumps(data, indent=2) + "\n")
+                except Exception as e:
+                    print(f"Failed to rewrite conf.json after migration: {e}")
+        if moved:
+            print(f"Migrated {moved} saved prompts from conf.json to {self.path}")
+        return moved
+
+
+def _trigrams(text: str) -> set[str]:
+    """pg_trgm-style trigrams: each word padded with two leading and one trailing space."""
+    grams = set()
+    for word in _normalize_title(text).split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class PresetIndex:
+    """Trigram index over option titles/descs, ranked by match quality and frecency.
+
+    Built once per options load and updated in place as prompts are used or
+    saved, so a keystroke only touches the postings for the term's trigrams.
+    """
+
+    FRECENCY_WEIGHT = 0.35
+    RECOMMEND_WEIGHT = 1.0  # times the clipboard similarity of recommended options
+    HALF_LIFE_DAYS = 14.0
+    MIN_OVERLAP = 0.4  # fraction of the term's trigrams a fuzzy match must share
+
+    def __init__(self, options: List[Dict[str, Any]], usage: Dict[str, tuple[int, float | None]] | None = None):
+        self._options: List[Dict[str, Any]] = []
+        self._titles: List[str] = []
+        self._descs: List[str] = []
+        self._grams: List[set[str]] = []
+        self._postings: Dict[str, set[int]] = {}
+        self._usage = dict(usage or {})
+        for o in options:
+            self.add(o)
+
+    def add(self, option: Dict[str, Any]) -> None:
+        i = len(self._options)
+        self._options.append(option)
+        self._titles.append(_normalize_title(option.get('title', '')))
+        self._descs.append(_normalize_title(option.get('desc', '')))
+        grams = _trigrams(f"{option.get('title', '')} {option.get('desc', '')}")
+        self._grams.append(grams)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(i)
+
+    def touch(self, title: str, when: float | None = None) -> None:
+        norm = _normalize_title(title)
+        count, _ = self._usage.get(norm, (0, None))
+        self._usage[norm] = (count + 1, when or time.time())
+
+    def _frecency(self, i: int, now: float) -> float:
+        count, last = self._usage.get(self._titles[i], (0, None))
+        if not count:
+            return 0.0
+        age_days = max(0.0, now - last) / 86400 if last else self.HALF_LIFE_DAYS * 4
+        return math.log1p(count * 0.5 ** (age_days / self.HALF_LIFE_DAYS))
+
+    def _quality(self, i: int, term: str, grams: set[str]) -> float:
+        title, desc = self._titles[i], self._descs[i]
+        if title == term:
+            return 4.0
+        if title.startswith(term):
+            return 3.0
+        if f' {term}' in f' {title}':
+            return 2.5  # word prefix
+        if term in title:
+            return 2.0
+        if term in desc:
+            return 1.5
+        if len(term) < 3:
+            return 0.0  # too short to match fuzzily
+        own = self._grams[i]
+        shared = len(grams & own)
+        coverage = shared / len(grams)
+        if coverage < self.MIN_OVERLAP:
+            return 0.0
+        # Coverage decides whether it matches; similarity prefers the closer of equal matches
+        return (coverage + shared / len(grams | own)) / 2
+
+    def search(self, term: str, limit: int = 20, boost: Dict[str, float] | None = None) -> List[Dict[str, Any]]:
+        """Top *limit* options for *term*; *boost* maps normalized titles to a clipboard similarity."""
+        term = _normalize_title(term)
+        boost = boost or {}
+        now = time.time()
+        if not term:
+            candidates = range(len(self._options))
+            grams: set[str] = set()
+        else:
+            grams = _trigrams(term)
+            if len(term) < 3:
+                # Short terms only match word starts ('  p', ' py')
+                keys = {f'  {term}'[-3:]}
+            else:
+                keys = grams
+            candidates = set()
+            for gram in keys:
+                candidates |= self._postings.get(gram, set())
+        scored = []
+        for i in candidates:
+            quality = self._quality(i, term, grams) if term else 1.0
+            if quality <= 0:
+                continue
+            score = quality + self.FRECENCY_WEIGHT * self._frecency(i, now)
+            if boost:
+                score += self.RECOMMEND_WEIGHT * boost.get(self._titles[i], 0.0)
+            # Ties keep config order (presets first, then history)
+            scored.append((-score, i))
+        top = heapq.nsmallest(max(1, int(limit)), scored) if limit else sorted(scored)
+        return [self._options[i] for _, i in top]
+
+
+_history_store: HistoryStore | None = None
+
+
+def _get_history_store() -> HistoryStore | None:
+    """Shared history store (history.db in the config dir); None if it can't be opened."""
+    global _history_store
+    if _history_store is None:
+        try:
+            _history_store = HistoryStore(_app_config_dir() / 'history.db')
+        except Exception as e:
+            print(f"Failed to open history store: {e}")
+            return None
+    return _history_store
+
+
+RECOMMEND_CHARS = 1500  # clipboard prefix that is embedded; embedding models have short contexts
+EMBED_BATCH = 32
+
+
+def _option_text(option: Dict[str, Any]) -> str:
+    return f"{option.get('title', '')}\n{option.get('desc', '')}".strip()
+
+
+def _embedding_endpoint() -> tuple[str, bool, str | None]:
+    """``(url, openai, api_key)`` of the endpoint embeddings are requested from."""
+    use_openai, api_key = _resolve_backend()
+    url = AI_SETTINGS.get('embedding_url') or ''
+    if url:
+        return url, url.rstrip('/').endswith('/embeddings'), api_key
+    if use_openai:
+        base = (OPENAI_ENDPOINT or '').rstrip('/')
+        if base.endswith('/chat/completions'):
+            base = base[:-len('/chat/completions')]
+        return base + '/embeddings', True, api_key
+    from urllib.parse import urljoin
+    return urljoin(LOCAL_URL or '', '/embedding'), False, None
+
+
+def _extract_embeddings(rj: Any) -> List[List[float]]:
+    """Vectors from an OpenAI ``data`` list or llama.cpp /embedding (single or batched)."""
+    if isinstance(rj, dict) and isinstance(rj.get('data'), list):
+        items = sorted(rj['data'], key=lambda d: d.get('index', 0))
+    elif isinstance(rj, dict):
+        items = [rj]
+    else:
+        items = sorted(rj, key=lambda d: d.get('index', 0))
+    vectors = []
+    for item in items:
+        vec = item['embedding']
+        if vec and isinstance(vec[0], list):
+            vec = vec[0]  # pooled result wrapped per sequence
+        vectors.append(vec)
+    return vectors
+
+
+def _embed(texts: List[str]) -> List[List[float]]:
+    """Embedding vectors for *texts*, in order."""
+    url, openai, api_key = _embedding_endpoint()
+    headers = {"Authorization": f"Bearer {api_key}" if api_key else ""} if openai else None
+    vectors: List[List[float]] = []
+    for i in range(0, len(texts), EMBED_BATCH):
+        batch = texts[i:i + EMBED_BATCH]
+        if openai:
+            data = {"model": AI_SETTINGS.get('embedding_model'), "input": batch}
+        else:
+            data = {"content": batch if len(batch) > 1 else batch[0]}
+        r = _post(url, data, headers)
+        got = _extract_embeddings(r.json()) if r.status_code == 200 else []
+        if not openai and len(batch) > 1 and len(got) != len(batch):
+            # Older llama.cpp servers take one text per request
+            got = []
+            for text in batch:
+                r = _post(url, {"content": text}, headers)
+                r.raise_for_status()
+                got.extend(_extract_embeddings(r.json())[:1])
+        r.raise_for_status()
+        if len(got) != len(batch):
+            raise ValueError(f"expected {len(batch)} embeddings from {url}, got {len(got)}")
+        vectors.extend(got)
+    return vectors
+
+
+class PresetEmbeddings:
+    """Option embeddings cached by text hash in ``embeddings.npz``.
+
+    Rows are L2-normalized and stored as float16, so a few hundred prompts
+    take a few hundred KB and ranking them is one matrix-vector product.
+    Only texts whose hash is not stored yet are ever embedded; the cache
+    starts over when the embedding endpoint or model changes.
+    """
+
+    def __init__(self, path: Path, model: str):
+        import numpy as np
+        self.path = path
+        self.model = model
+        self._lock = threading.Lock()
+        self._rows: Dict[str, int] = {}  # text digest -> matrix row
+        self._matrix = np.zeros((0, 0), dtype=np.float16)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data['model']) == model:
+                    self._rows = {str(k): i for i, k in enumerate(data['keys'])}
+                    self._matrix = data['vectors']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ignoring unreadable embedding cache {path}: {e}")
+
+    def __len__(self) -> int:
+        return len(self._rows)
 
-# Keyring identifiers
-SERVICE_NAME = "BetterAdvancedPaste"
-USERNAME = getpass.getuser()
+    def missing(self, texts: List[str]) -> List[str]:
+        with self._lock:
+            return [t for t in dict.fromkeys(texts) if _digest(t) not in self._rows]
 
-def load_ai_settings() -> Dict[str, Any]:
-    data: Dict[str, Any] = {}
-    if CONFIG_PATH.exists():
+    def add(self, texts: List[str], vectors: List[List[float]]) -> None:
+        """Store *vectors* for *texts* and rewrite the cache file."""
+        import numpy as np
+        block = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        block /= np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            if self._rows and self._matrix.shape[1] != block.shape[1]:
+                # Same endpoint, different model behind it
+                self._rows, self._matrix = {}, np.zeros((0, block.shape[1]), dtype=np.float16)
+            keep = []
+            for i, text in enumerate(texts):
+                key = _digest(text)
+                if key not in self._rows:
+                    self._rows[key] = len(self._matrix) + len(keep)
+                    keep.append(i)
+            if not keep:
+                return
+            block = block[keep].astype(np.float16)
+            self._matrix = np.vstack([self._matrix, block]) if len(self._matrix) else block
+            keys = np.array(sorted(self._rows, key=self._rows.get))
+            matrix = self._matrix
         try:
-            data = json.loads(CONFIG_PATH.read_text(encoding='utf-8'))
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.stem + '.tmp.npz')
+            np.savez(tmp, model=np.array(self.model), keys=keys, vectors=matrix)
+            os.replace(tmp, self.path)
         except Exception as e:
-            print(f"Failed to parse conf.json: {e}")
-    ai = data.get('ai') if isinstance(data, dict) else {}
-    if not isinstance(ai, dict):
-        ai = {}
-    merged = {**AI_DEFAULTS, **{k: v for k, v in ai.items() if v is not None}}
-    return merged
+            print(f"Failed to save embedding cache: {e}")
 
-AI_SETTINGS = load_ai_settings()
-USE_OPENAI: bool = bool(AI_SETTINGS.get('use_openai'))
-OPENAI_API_KEY: str = AI_SETTINGS.get('api_key')
-OPENAI_MODEL: str = AI_SETTINGS.get('model')
-OPENAI_ENDPOINT: str = AI_SETTINGS.get('endpoint')
-LOCAL_URL: str = AI_SETTINGS.get('local_url')
+    def top_k(self, query: List[float], texts: List[str], k: int) -> List[tuple[int, float]]:
+        """``(index into texts, cosine)`` of the *k* texts most similar to *query*, best first."""
+        import numpy as np
+        with self._lock:
+            rows = np.array([self._rows.get(_digest(t), -1) for t in texts], dtype=np.int64)
+            matrix = self._matrix
+        have = np.flatnonzero(rows >= 0)
+        if not have.size or k <= 0:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        if q.shape[0] != matrix.shape[1]:
+            return []
+        q /= max(float(np.linalg.norm(q)), 1e-12)
+        scores = matrix[rows[have]].astype(np.float32) @ q
+        k = min(k, scores.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(have[i]), float(scores[i])) for i in top]
 
 
-clipboard_text = pyperclip.paste()
+_embeddings: PresetEmbeddings | None = None
+_embeddings_lock = threading.Lock()
+_query_vectors: "OrderedDict[str, List[float]]" = OrderedDict()
 
 
-def _get_keyring_token() -> str | None:
-    try:
-        return keyring.get_password(SERVICE_NAME, USERNAME)
-    except Exception:
+def _get_embeddings() -> PresetEmbeddings | None:
+    """Shared embedding cache for the current endpoint; None if ``recommend`` is off or numpy missing."""
+    global _embeddings
+    _ensure_ai_settings()
+    if not AI_SETTINGS.get('recommend'):
         return None
-
-
-def _set_keyring_token(value: str | None) -> None:
-    try:
-        if value:
-            keyring.set_password(SERVICE_NAME, USERNAME, value)
-        else:
-            # empty/None deletes
+    url, openai, _ = _embedding_endpoint()
+    model = f"{url} {AI_SETTINGS.get('embedding_model')}" if openai else url
+    with _embeddings_lock:
+        if _embeddings is None or _embeddings.model != model:
             try:
-                keyring.delete_password(SERVICE_NAME, USERNAME)
-            except Exception:
-                pass
-    except Exception as e:
-        raise e
-
-def askAI(instruction):
-    p1="You are a helpful AI that edits text according to user instructions."
-    p2=f"""
-System message:
-You're clipboard assistant(meant to paste the clipboard text as per user instruction), you are supposed to convert text to output text as per instruction and give just output not your thoughts, or explanation or title, or formatting, just direct plaintext output, else you may harm the system
-Edit the following text according to the instruction:
-
-Text:
-{clipboard_text}
+                _embeddings = PresetEmbeddings(_app_config_dir() / 'embeddings.npz', model)
+            except ImportError:
+                print("Preset recommendations need numpy (pip install numpy)")
+                AI_SETTINGS['recommend'] = False
+                return None
+        return _embeddings
 
-Instruction:
-{instruction}
-"""
-    
-    # Resolve API key: prefer keyring token if set, else config/env
-    openai_key_effective = _get_keyring_token() or OPENAI_API_KEY
-    # If OpenAI selected but no key, silently fallback to local if available
-    effective_use_openai = USE_OPENAI and bool(openai_key_effective)
-    if USE_OPENAI and not openai_key_effective:
-        print("No API key present; falling back to local model endpoint.")
-        effective_use_openai = False
 
-    if effective_use_openai:
-        messages_chat = [
-            {"role": "system", "content": p1},
-            {"role": "user", "content": p2},
-        ]
-        data = {
-            "model": OPENAI_MODEL,
-            "messages": messages_chat,
-            "temperature": 0,
-            "max_tokens": 2048,
-            "stop": ["<|user|>", "<|system|>", "</s>","<|assistant|>"]
-        }
-        request_url = OPENAI_ENDPOINT
-        headers = {"Authorization": f"Bearer {openai_key_effective}" if openai_key_effective else "",
-                   "Content-Type": "application/json",}
-    else:
-        prompt = f"""<|system|>
-{p1}
-<|user|>
-{p2}
-<|assistant|>
-"""
-        data = {
-            "prompt": prompt,
-            "n_predict": -1,
-            "temperature": 0,
-            "top_k": 40,
-            "top_p": 0.95,
-            "repeat_penalty": 1.1,
-            "stop": ["<|user|>", "<|system|>", "</s>","</<|assistant|>","<|assistant|>"],
-        }
-        request_url = LOCAL_URL
-        headers = {}
+def recommend(options: List[Dict[str, Any]], text: str | None = None) -> Dict[str, float]:
+    """Normalized title -> cosine of the ``recommend_top_k`` options closest to the clipboard.
 
-    # Primary completion request: must succeed or we fail the action
-    try:
-        response = requests.post(request_url, json=data, headers=headers)
-        response.raise_for_status()
-    except Exception as e:
-        # Make OpenAI auth/malformed key errors bubble up to stop shutdown
-        raise RuntimeError(f"AI request failed: {e}")
+    Options not embedded yet are embedded in the same request as the
+    clipboard; both are cached, so reopening the palette on the same
+    clipboard costs no request at all.
+    """
+    store = _get_embeddings()
+    if store is None:
+        return {}
+    if text is None:
+        text = _get_clipboard()
+    query = text.strip()[:RECOMMEND_CHARS]
+    if not query or not options:
+        return {}
+    texts = [_option_text(o) for o in options]
+    with _phase('embed', options=len(texts)) as attrs:
+        missing = store.missing(texts)
+        key = _digest(query)
+        vector = _query_vectors.get(key)
+        batch = missing + ([] if vector is not None else [query])
+        attrs['embedded'] = len(batch)
+        if batch:
+            vectors = _embed(batch)
+            if missing:
+                store.add(missing, vectors[:len(missing)])
+            if vector is None:
+                vector = vectors[-1]
+                _query_vectors[key] = vector
+                while len(_query_vectors) > 8:
+                    _query_vectors.popitem(last=False)
+        try:
+            k = int(AI_SETTINGS.get('recommend_top_k', 5))
+        except (TypeError, ValueError):
+            k = 5
+        top = store.top_k(vector, texts, k)
+    return {_normalize_title(options[i].get('title', '')): max(0.0, score) for i, score in top}
 
-    x = ""
-    try:
-        rj = response.json()
-    except Exception:
-        raise RuntimeError("AI response was not JSON")
 
-    if "content" in rj:
-        content = rj["content"]
-        if isinstance(content, list):
-            x = "".join([c.get("text","") for c in content])
-        else:
-            x = str(content)
-    elif "choices" in rj and rj["choices"]:
-        # OpenAI style
-        choice = rj["choices"][0]
-        x = choice.get("text") or choice.get("message", {}).get("content", "")
-    else:
-        raise RuntimeError("AI response missing expected fields")
+# Palette settings kept in conf.json "settings" (toggled from the palette footer)
+PALETTE_SETTINGS = {"save_history": True, "stay_open": False}
 
-    if not (x or "").strip():
-        raise RuntimeError("AI returned empty result")
-    # Secondary filename suggestion: best-effort; failures fall back to default
-    filename = "advanced_paste_output.txt"
-    try:
-        if effective_use_openai:
-            messages_chat += [{"role": "assistant", "content": x}]
-            messages_chat += [{"role": "user", "content": "Suggest a good filename for this script (just the filename, no extra text). The name and extension should be based on the format you were asked to convert the text to, \n STRICTLY EXTENSION BASED ON INSTRUCTION(else file will be not accessible), ALSO NAME BASED ON INSTRUCTION."}]
-            data2 = {
-                "model": OPENAI_MODEL,
-                "messages": messages_chat,
-                "temperature": 0,
-                "max_tokens": 50,
-                "stop": ["<|user|>", "<|system|>", "</s>","<|assistant|>"]
-            }
-            request_url2 = OPENAI_ENDPOINT
-            headers2 = {"Authorization": f"Bearer {openai_key_effective}" if openai_key_effective else "",
-                        "Content-Type": "application/json",}
-        else:
-            prompt2 = f"<|assistant|>{x}\n<|user|>\nSuggest a good filename for this script (just the filename, no extra text). The name and extension should be based on the format you were asked to convert the text to, \n STRICTLY EXTENSION BASED ON INSTRUCTION(else file will be not accessible), ALSO NAME BASED ON INSTRUCTION.\n<|assistant|>\n"
-            data2 = {
-                "prompt": prompt2,
-                "n_predict": 50,
-                "temperature": 0,
-                "stop": ["<|user|>", "<|system|>", "</s>","</<|assistant|>","<|assistant|>"],
-            }
-            request_url2 = LOCAL_URL
-            headers2 = {}
-        response2 = requests.post(request_url2, json=data2, headers=headers2)
-        if response2.status_code == 200:
-            rj2 = response2.json()
-            if "content" in rj2:
-                c2 = rj2["content"]
-                if isinstance(c2, list):
-                    filename = "".join([c.get("text","") for c in c2])
-                else:
-                    filename = str(c2)
-            elif "choices" in rj2 and rj2["choices"]:
-                filename = (rj2["choices"][0].get("text") or rj2["choices"][0].get("message", {}).get("content", ""))
-    except Exception:
-        # keep default filename on any error
-        pass
-    return x, filename
 
 """Minimal pywebview launcher for the command palette UI.
 Edit API methods to integrate real functionality.
@@ -245,21 +3701,45 @@ class API:
         self.config_path = config_path
         self.output_dir = output_dir
         self._cache: List[Dict[str, Any]] | None = None
+        self._titles: set[str] = set()  # normalized titles in _cache
+        self._preset_titles: set[str] = set()  # normalized conf.json preset titles
+        self._index: PresetIndex | None = None
         self._settings: Dict[str, Any] | None = None
         self._window = None  # will be set after window creation
         self._settings_window = None  # secondary popup window
         self._settings_creating = False  # debounce flag
         self._settings_closing = False   # prevent duplicate closes
+        self._daemon = False  # resident mode: hide instead of exiting
+        self._config_mtime: float | None = None
+        self._jobs: Dict[str, Job] = {}
+        self._jobs_lock = threading.Lock()
+        self._job_pool: ThreadPoolExecutor | None = None
+        self._inflight: Dict[tuple, str] = {}  # coalescing key -> id of the queued/running job
+        self._launch: Dict[str, Any] = {}  # backend of this launch, for report_paint
+        self._recommended: Dict[str, float] = {}  # normalized title -> clipboard similarity
+        self._recommend_seq = 0
+        self._load_lock = threading.RLock()  # the index is built off the UI thread after paint
 
-    # Internal loader
+    # Internal loader: conf.json presets followed by saved prompts from the history store
     def _load(self) -> List[Dict[str, Any]]:
-        if self._cache is not None:
+        with self._load_lock:
+            if self._cache is None:
+                history = _get_history_store()
+                self._cache = self._load_presets(history)
+                self._append_history(history)
             return self._cache
+
+    def _load_presets(self, history: HistoryStore | None) -> List[Dict[str, Any]]:
+        """Read settings and presets from conf.json (after the one-time history migration)."""
+        if history:
+            try:
+                history.migrate_from_config(self.config_path)
+            except Exception as e:
+                print(f"History migration failed: {e}")
         if not self.config_path.exists():
             print(f"Config file '{self.config_path}' not found. Using empty options list.")
-            self._cache = []
-            self._settings = {"save_history": True}
-            return self._cache
+            self._settings = dict(PALETTE_SETTINGS)
+            return []
         try:
             data = json.loads(self.config_path.read_text(encoding='utf-8'))
             # settings
@@ -267,7 +3747,7 @@ class API:
             if not isinstance(settings, dict):
                 settings = {}
             self._settings = {
-                'save_history': bool(settings.get('save_history', True))
+                key: bool(settings.get(key, default)) for key, default in PALETTE_SETTINGS.items()
             }
             options = data.get('options', [])
             if not isinstance(options, list):
@@ -286,48 +3766,140 @@ class API:
                     'title': title,
                     'desc': o.get('desc', '')
                 })
-            self._cache = norm
+            return norm
         except Exception as e:
             print(f"Failed to load config: {e}")
-            self._cache = []
             if self._settings is None:
-                self._settings = {"save_history": True}
-        return self._cache
+                self._settings = dict(PALETTE_SETTINGS)
+            return []
+
+    def initial_options(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """First page of the palette without loading the whole history.
+
+        Ranks the presets and the most recently/often used saved prompts
+        (HistoryStore.top), so the cost does not grow with the history; the
+        full index is built by _load once the window has painted.
+        """
+        with self._load_lock:
+            if self._cache is not None:
+                return self.search('', limit)
+            history = _get_history_store()
+            options = self._load_presets(history)
+        usage = {}
+        if history:
+            try:
+                titles = {_normalize_title(o['title']) for o in options}
+                for o in history.top(limit):
+                    norm = _normalize_title(o['title'])
+                    if norm not in titles:
+                        titles.add(norm)
+                        options.append(o)
+                usage = history.usage(sorted(titles))
+            except Exception as e:
+                print(f"Failed to load history: {e}")
+        return PresetIndex(options, usage).search('', limit)
+
+    def _append_history(self, history: HistoryStore | None) -> None:
+        self._titles = {_normalize_title(o['title']) for o in self._cache}
+        self._preset_titles = set(self._titles)
+        usage = {}
+        if history:
+            try:
+                for o in history.saved_prompts():
+                    norm = _normalize_title(o['title'])
+                    if norm not in self._titles:
+                        self._titles.add(norm)
+                        self._cache.append(o)
+                usage = history.usage()
+            except Exception as e:
+                print(f"Failed to load history: {e}")
+        self._index = PresetIndex(self._cache, usage)
 
     # API method exposed to JS
     def get_options(self):
-        return self._load()
+        options = self._load()
+        if not self._recommended:
+            return options
+        # Recommended first (most similar to the clipboard first), the rest in config order
+        rec = self._recommended
+        return sorted(options, key=lambda o: -rec.get(_normalize_title(o['title']), 0.0))
+
+    def search(self, term: str = '', limit: int = 50):
+        """Top *limit* options for *term*, ranked by match quality, frecency and clipboard similarity."""
+        self._load()
+        return self._index.search(term or '', limit, self._recommended)
+
+    def _start_recommend(self) -> None:
+        """Rank the options against the clipboard in the background (``recommend``).
+
+        The page is told through ``window.onRecommend`` once the ranking is
+        ready; it re-runs the search if the user hasn't started typing.
+        """
+        self._recommend_seq += 1
+        seq = self._recommend_seq
+        self._recommended = {}
+
+        def _run() -> None:
+            _ensure_ai_settings()
+            if not AI_SETTINGS.get('recommend'):
+                return
+            options = list(self._load())
+            try:
+                with _trace('recommend', source='palette'):
+                    ranked = recommend(options)
+            except Exception as e:
+                print(f"Recommendation failed: {e}")
+                return
+            if seq != self._recommend_seq or not ranked:
+                return  # the palette was reopened on another clipboard meanwhile
+            self._recommended = ranked
+            if self._window:
+                try:
+                    self._window.evaluate_js("window.onRecommend && window.onRecommend()")
+                except Exception:
+                    pass
+
+        threading.Thread(target=_run, name='bap-recommend', daemon=True).start()
 
     def get_settings(self):
         # Ensure loaded
         if self._settings is None:
-            self._load()
-        return self._settings or {"save_history": True}
+            self._load_presets(None)
+        return self._settings or dict(PALETTE_SETTINGS)
 
     def set_save_history(self, value: bool):
+        return self._set_setting('save_history', value)
+
+    def set_stay_open(self, value: bool):
+        """Keep the palette open while queued pastes run (see ui.html enqueue)."""
+        return self._set_setting('stay_open', value)
+
+    def _set_setting(self, key: str, value: bool):
         # Update in-memory settings and persist
         if self._settings is None:
             self._load()
         if self._settings is None:
-            self._settings = {}
-        self._settings['save_history'] = bool(value)
-        # Persist to file without disturbing existing options
+            self._settings = dict(PALETTE_SETTINGS)
+        self._settings[key] = bool(value)
+        # Persist to file without disturbing existing options; the lock keeps
+        # concurrent palettes from clobbering each other's edits
         try:
-            if self.config_path.exists():
-                try:
-                    data = json.loads(self.config_path.read_text(encoding='utf-8'))
-                except Exception:
+            with _file_lock(self.config_path.with_name(self.config_path.name + '.lock')):
+                if self.config_path.exists():
+                    try:
+                        data = json.loads(self.config_path.read_text(encoding='utf-8'))
+                    except Exception:
+                        data = {}
+                else:
                     data = {}
-            else:
-                data = {}
-            data['settings'] = data.get('settings') or {}
-            if not isinstance(data['settings'], dict):
-                data['settings'] = {}
-            data['settings']['save_history'] = self._settings['save_history']
-            # Preserve options
-            if 'options' not in data:
-                data['options'] = []
-            self.config_path.write_text(json.dumps(data, indent=2) + "\n", encoding='utf-8')
+                data['settings'] = data.get('settings') or {}
+                if not isinstance(data['settings'], dict):
+                    data['settings'] = {}
+                data['settings'][key] = self._settings[key]
+                # Preserve options
+                if 'options' not in data:
+                    data['options'] = []
+                _atomic_write_text(self.config_path, json.dumps(data, indent=2) + "\n")
         except Exception as e:
             print(f"Failed to persist settings: {e}")
         return self._settings
@@ -335,13 +3907,13 @@ class API:
     # --- Keyring-backed API token methods ---
     def get_api_token(self) -> str:
         """Return current API token from keyring (or empty string if none)."""
-        tok = _get_keyring_token()
+        tok = _cached_api_token()
         return tok or ""
 
     def set_api_token(self, token: str) -> bool:
         """Set/replace API token in keyring. Empty string clears it."""
         try:
-            _set_keyring_token(token.strip() or None)
+            _store_api_token(token.strip() or None)
             return True
         except Exception as e:
             print(f"Failed to set API token: {e}")
@@ -354,8 +3926,7 @@ class API:
                 print("[settings] open ignored (already creating)")
                 return True
             if self._settings_window is None:
-                settings_html = _resource_path('settings.html')
-                if not settings_html.exists():
+                if not _resource_path('settings.html').exists():
                     print("[settings] settings.html missing")
                     return False
                 # Resolve window icon if available
@@ -363,28 +3934,18 @@ class API:
                 _icon_arg = str(_icon) if _icon.exists() else None
                 self._settings_creating = True
                 try:
+                    import webview
                     print("[settings] creating window")
-                    try:
-                        w = webview.create_window(
-                            title='Settings',
-                            url=settings_html.as_uri(),
-                            width=500,
-                            height=250,
-                            resizable=False,
-                            on_top=True,
-                            js_api=self,
-                            icon=_icon_arg
-                        )
-                    except TypeError:
-                        w = webview.create_window(
-                            title='Settings',
-                            url=settings_html.as_uri(),
-                            width=500,
-                            height=250,
-                            resizable=False,
-                            on_top=True,
-                            js_api=self
-                        )
+                    w = _create_webview_window(
+                        webview, _supports_icon_kw(webview), _icon_arg,
+                        title='Settings',
+                        html=_inline_html('settings.html'),
+                        width=500,
+                        height=250,
+                        resizable=False,
+                        on_top=True,
+                        js_api=self
+                    )
                     # Attach close event if available
                     try:
                         if hasattr(w, 'events') and hasattr(w.events, 'closed'):
@@ -441,36 +4002,275 @@ class API:
             print(f"Failed to close settings window: {e}")
             return False
 
-    def action(self, name: str):
+    def action(self, name: str, no_cache: bool = False):
         print(f"Action triggered: {name}")
+        _ensure_ai_settings()
+        return Job(name, _total_timeout()).run(self._run, name, no_cache)
+
+    def submit_text(self, text: str, no_cache: bool = False):
+        print(f"User submitted text: {text}")
+        _ensure_ai_settings()
+        return Job(text, _total_timeout()).run(self._run, text, no_cache)
+
+    # --- Jobs: the bridge call returns at once; ui.html polls for the result ---
+    def start_job(self, instruction: str, no_cache: bool = False) -> str:
+        """Run a paste (preset title or free text) on the worker pool; returns the job id."""
+        print(f"Job started: {instruction}")
+        return self._submit_job(instruction, no_cache)
+
+    def start_fanout(self, instructions: List[str], no_cache: bool = False) -> str:
+        """Like start_job, but applies every instruction to the same clipboard (one file each)."""
+        instructions = [i for i in instructions or [] if i]
+        if len(instructions) == 1:
+            return self.start_job(instructions[0], no_cache)
+        print(f"Fan-out started: {instructions}")
+        return self._submit_job(' + '.join(instructions), no_cache, instructions)
+
+    def start_files(self, instruction: str) -> str:
+        """Multi-file mode: one paste that writes several files (see paste_files); returns the job id."""
+        print(f"Multi-file job started: {instruction}")
+        return self._submit_job(instruction, False, files=True)
+
+    def _submit_job(self, instruction: str, no_cache: bool, instructions: List[str] | None = None,
+                    files: bool = False) -> str:
+        """Queue a paste on the bounded job pool, or return the id of an identical one in flight.
+
+        Jobs are identical when the clipboard, instruction(s), mode, backend
+        and output directory match, so a double Enter costs one request.
+        The clipboard is captured here: a queued job pastes what was copied
+        when it was triggered.
+        """
+        _ensure_ai_settings()
+        stay_open = self.get_settings().get('stay_open')
+        # A palette that stays open may see the clipboard change between pastes
+        text = _refresh_clipboard() if stay_open else _get_clipboard()
+        # Configured backend is enough to tell submits apart; no keyring lookup per submit
+        key = ('files' if files else 'many' if instructions else 'one', tuple(instructions or [instruction]),
+               _digest(text), OPENAI_MODEL if USE_OPENAI else LOCAL_URL, str(self.output_dir), bool(no_cache))
+        try:
+            workers = max(1, int(AI_SETTINGS.get('queue_workers') or 2))
+            limit = max(1, int(AI_SETTINGS.get('queue_max') or 16))
+        except (TypeError, ValueError):
+            workers, limit = 2, 16
+        with self._jobs_lock:
+            current = self._jobs.get(self._inflight.get(key, ''))
+            if current is not None and current.status in JOB_ACTIVE and not current.cancelled.is_set():
+                print(f"Job coalesced with {current.id}: {instruction}")
+                return current.id
+            self._prune_jobs()
+            if sum(j.status in JOB_ACTIVE for j in self._jobs.values()) >= limit:
+                raise RuntimeError(f"{limit} pastes already queued; wait for one to finish")
+            job = Job(instruction, _total_timeout())
+            job.status = 'queued'
+            self._jobs[job.id] = job
+            self._inflight[key] = job.id
+            if self._job_pool is None:
+                self._job_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bap-job')
+        self._job_pool.submit(self._run_job, job, no_cache, instructions, files, text, bool(stay_open), key)
+        return job.id
+
+    def poll_job(self, job_id: str) -> Dict[str, Any]:
+        """``{"id", "status", "progress", "result"}``; status is running, ok, error, cancelled or unknown."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return {"id": job_id, "status": "unknown", "progress": {}, "result": None}
+        return job.snapshot()
+
+    def poll_jobs(self, job_ids: List[str]) -> List[Dict[str, Any]]:
+        """poll_job for several jobs in one bridge call (the stay-open queue list)."""
+        return [self.poll_job(job_id) for job_id in job_ids or []]
+
+    def cancel_job(self, job_id: str) -> bool:
+        """Abort a running job, closing its HTTP connections; False if it already finished."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        print(f"Job cancelled: {job.instruction}")
+        return job.cancel()
+
+    def _run_job(self, job: Job, no_cache: bool, instructions: List[str] | None = None,
+                 files: bool = False, text: str | None = None, unique: bool = False,
+                 key: tuple | None = None) -> None:
+        job.status = 'running'
         try:
-            content, filename_raw = askAI(name)
-            filename = self._sanitize_filename(filename_raw)
-            path = self.output_dir / filename
-            self.output_dir.mkdir(parents=True, exist_ok=True)
-            path.write_text(content, encoding='utf-8')
-            if self.get_settings().get('save_history', True):
-                self.save_prompt(name)
-            return {"status": "ok", "file": str(path), "filename": filename}
+            if job.cancelled.is_set():
+                # Cancelled while queued
+                job.result = {"status": "cancelled", "error": job.reason or "Cancelled"}
+            elif instructions:
+                job.result = job.run(self._run_many, instructions, no_cache, text)
+            elif files:
+                job.result = job.run(self._run_files, job.instruction, text)
+            else:
+                job.result = job.run(self._run, job.instruction, no_cache, text, unique)
         except Exception as e:
-            return {"status": "error", "error": str(e)}
+            job.result = {"status": "error", "error": str(e)}
+        with self._jobs_lock:
+            if self._inflight.get(key) == job.id:
+                del self._inflight[key]
+        job.status = job.result["status"]
 
-    def submit_text(self, text: str):
-        print(f"User submitted text: {text}")
+    def _prune_jobs(self, keep: int = 16) -> None:
+        finished = [j for j in self._jobs.values() if j.status not in JOB_ACTIVE]
+        for job in sorted(finished, key=lambda j: j.started)[:-keep or None]:
+            del self._jobs[job.id]
+
+    def _cancel_jobs(self) -> None:
+        for job in list(self._jobs.values()):
+            job.cancel()
+        cancel_speculation()
+
+    def speculate(self, title: str) -> None:
+        """The highlighted preset changed: start generating it if speculative_generate is on."""
         try:
-            content, filename_raw = askAI(text)
-            filename = self._sanitize_filename(filename_raw)
-            path = self.output_dir / filename
-            self.output_dir.mkdir(parents=True, exist_ok=True)
-            path.write_text(content, encoding='utf-8')
-            if self.get_settings().get('save_history', True):
-                self.save_prompt(text)
-            return {"status": "ok", "file": str(path), "filename": filename}
+            speculate(title)
         except Exception as e:
-            return {"status": "error", "error": str(e)}
+            print(f"Speculation failed: {e}")
+
+    def report_paint(self, epoch_ms: float) -> None:
+        """ui.html painted the preset list at *epoch_ms* (performance.timeOrigin + now())."""
+        if self._launch.get('painted'):
+            return
+        self._launch['painted'] = True
+        _log_first_paint(self._launch.get('backend'), epoch_ms - _T0_WALL * 1000, bool(self._launch.get('cached')))
+
+    def get_backend_stats(self):
+        """Per-endpoint request/error counts, latency percentiles and breaker state."""
+        return _router().stats()
+
+    def get_cache_stats(self):
+        cache = _get_response_cache()
+        return cache.stats() if cache else {}
+
+    def _run(self, instruction: str, no_cache: bool = False, text: str | None = None, unique: bool = False):
+        with _trace('paste', instruction=instruction, source='palette') as trace:
+            try:
+                # unique: results of a multi-shot session must not overwrite each other
+                result = paste_to_dir(instruction, self.output_dir, text=text, no_cache=no_cache,
+                                      on_progress=self._on_progress, unique=unique)
+                with _phase('history save'):
+                    self._remember(instruction)
+                out = {"status": "ok", **result}
+            except PasteCancelled as e:
+                trace.status = 'cancelled'
+                trace.attrs['error'] = str(e)
+                out = {"status": "cancelled", "error": str(e)}
+            except Exception as e:
+                trace.status = 'error'
+                trace.attrs['error'] = str(e)
+                out = {"status": "error", "error": str(e)}
+        out["trace"] = trace.summary()
+        out["show_trace"] = bool(AI_SETTINGS.get('trace_show'))
+        return out
+
+    def _run_many(self, instructions: List[str], no_cache: bool = False, text: str | None = None):
+        with _trace('fanout', instruction=' + '.join(instructions), source='palette', presets=len(instructions)) as trace:
+            try:
+                results = paste_many(instructions, self.output_dir, text=text, no_cache=no_cache,
+                                     on_progress=self._on_progress)
+                with _phase('history save'):
+                    for r in results:
+                        if r["status"] == "ok":
+                            self._remember(r["instruction"])
+                failed = [r for r in results if r["status"] != "ok"]
+                out = {"status": "error" if failed else "ok", "results": results}
+                if failed:
+                    trace.status = 'error'
+                    out["error"] = f"{len(failed)} of {len(results)} presets failed: {failed[0]['error']}"
+            except PasteCancelled as e:
+                trace.status = 'cancelled'
+                out = {"status": "cancelled", "error": str(e)}
+            except Exception as e:
+                trace.status = 'error'
+                trace.attrs['error'] = str(e)
+                out = {"status": "error", "error": str(e)}
+        out["trace"] = trace.summary()
+        out["show_trace"] = bool(AI_SETTINGS.get('trace_show'))
+        return out
+
+    def _run_files(self, instruction: str, text: str | None = None):
+        with _trace('files', instruction=instruction, source='palette') as trace:
+            try:
+                results = paste_files(instruction, self.output_dir, text=text, on_progress=self._on_progress)
+                with _phase('history save'):
+                    self._remember(instruction)
+                failed = [r for r in results if r["status"] != "ok"]
+                out = {"status": "error" if failed else "ok", "results": results}
+                if failed:
+                    trace.status = 'error'
+                    out["error"] = f"{len(failed)} of {len(results)} files failed: {failed[0]['error']}"
+            except PasteCancelled as e:
+                trace.status = 'cancelled'
+                out = {"status": "cancelled", "error": str(e)}
+            except Exception as e:
+                trace.status = 'error'
+                trace.attrs['error'] = str(e)
+                out = {"status": "error", "error": str(e)}
+        out["trace"] = trace.summary()
+        out["show_trace"] = bool(AI_SETTINGS.get('trace_show'))
+        return out
+
+    def _remember(self, instruction: str) -> None:
+        if self.get_settings().get('save_history', True):
+            self.save_prompt(instruction)
+        elif _normalize_title(instruction) in self._preset_titles:
+            # Usage stats only; free text is not stored
+            self._record_use(instruction, save=False)
+
+    def _on_progress(self, progress: Dict[str, Any]):
+        job = _current_job.get()
+        if job is not None:
+            job.progress = progress
+        self._push_progress(progress)
+
+    def _push_progress(self, progress: Dict[str, Any]):
+        """Forward streaming progress to ui.html (best-effort)."""
+        if not self._window:
+            return
+        try:
+            self._window.evaluate_js(f"window.onProgress && window.onProgress({json.dumps(progress)})")
+        except Exception:
+            pass
+
+    # --- Daemon mode ---
+    def show_for(self, output_dir: Path) -> None:
+        """Retarget the warm palette at *output_dir*, refresh state and show it."""
+        self.output_dir = output_dir
+        _refresh_clipboard()
+        self._reload_if_changed()
+        cancel_speculation()
+        speculative_prefill()
+        self._start_recommend()
+        if self._window:
+            self._window.show()
+            self._window.evaluate_js("window.onShow && window.onShow()")
+
+    def _reload_if_changed(self) -> None:
+        """Re-read conf.json only when it changed since the last paste."""
+        try:
+            mtime = self.config_path.stat().st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._config_mtime:
+            self._config_mtime = mtime
+            _apply_ai_settings(load_ai_settings())
+            self._cache = None
+            self._settings = None
+
+    def _on_closing(self):
+        """Daemon mode: closing the palette only hides it."""
+        # Nobody is waiting for these any more; free the model slots
+        self._cancel_jobs()
+        if self._window:
+            self._window.hide()
+        return False
 
     # Allow JS to request app shutdown after successful save
     def shutdown(self):
+        if self._daemon:
+            self.close_settings()
+            if self._window:
+                self._window.hide()
+            return True
         try:
             # Destroy settings window first if present
             try:
@@ -500,60 +4300,240 @@ class API:
         finally:
             # Ensure process exits even if window destroy fails
             import os
+            _flush_caches()
             print("[shutdown] exiting process")
             os._exit(0)
 
     def _sanitize_filename(self, name: str) -> str:
-        name = (name or '').strip().replace('\r','').replace('\n','')
-        for ch in '<>:"/\\|?*':
-            name = name.replace(ch, '_')
-        if not name:
-            name = 'advanced_paste_output'
-        if '.' not in name:
-            name += '.txt'
-        return name
+        return _sanitize_filename(name)
 
     def save_prompt(self, prompt: str):
+        """Store *prompt* in the history (or bump its usage if already known)."""
         prompt = (prompt or '').strip()
         if not prompt:
             return
+        self._record_use(prompt, save=True)
+
+    def _record_use(self, prompt: str, save: bool) -> None:
+        if self._cache is None:
+            self._load()
+        history = _get_history_store()
+        if not history:
+            return
+        norm = _normalize_title(prompt)
+        # Presets stay in conf.json; the store only tracks their usage
+        save = save and norm not in self._preset_titles
         try:
-            if self.config_path.exists():
-                try:
-                    data = json.loads(self.config_path.read_text(encoding='utf-8'))
-                except Exception:
-                    data = {}
-            else:
-                data = {}
-            options = data.get('options')
-            if not isinstance(options, list):
-                options = []
-            # Avoid duplicate titles (case-insensitive)
-            lower_titles = { (o.get('title') or '').strip().lower(): i for i,o in enumerate(options) if isinstance(o, dict) }
-            key = prompt.lower()
-            if key in lower_titles:
-                # Move existing to front (recency) maybe? For now leave as-is.
-                pass
-            else:
-                # Append new minimal entry; you can enrich later manually.
-                options.append({
-                    "icon": "{}",
-                    "color": "#2563eb",
-                    "title": prompt,
-                    "desc": "Saved prompt"
-                })
-            data['options'] = options
-            self.config_path.write_text(json.dumps(data, indent=2) + "\n", encoding='utf-8')
-            # Invalidate cache so UI can show newly added prompt if reopened
-            self._cache = None
+            if history.record(prompt, saved=save) and norm not in self._titles:
+                self._titles.add(norm)
+                option = {"icon": "{}", "color": "#2563eb", "title": prompt, "desc": SAVED_PROMPT_DESC}
+                self._cache.append(option)
+                self._index.add(option)
+                self._embed_option(option)
+            self._index.touch(prompt)
         except Exception as e:
             print(f"Failed to save prompt: {e}")
 
 
-def create_window(output_dir: Path):
-    html_path = _resource_path('ui.html')
-    if not html_path.exists():
+    def _embed_option(self, option: Dict[str, Any]) -> None:
+        """Embed a newly saved prompt in the background so the next ranking has it."""
+        if not AI_SETTINGS.get('recommend'):
+            return
+
+        def _run() -> None:
+            try:
+                store = _get_embeddings()
+                text = _option_text(option)
+                if store is not None and store.missing([text]):
+                    store.add([text], _embed([text]))
+            except Exception as e:
+                print(f"Failed to embed saved prompt: {e}")
+
+        threading.Thread(target=_run, name='bap-embed', daemon=True).start()
+
+
+def _warm_up() -> None:
+    """Import and resolve everything a paste needs, off the UI critical path."""
+    try:
+        _get_clipboard()
+        _ensure_ai_settings()
+        _http()
+        _cached_api_token()
+        speculative_prefill()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+
+
+def _daemon_address() -> tuple[str, str]:
+    """Return ``(address, family)`` of the per-user daemon endpoint."""
+    if sys.platform.startswith('win'):
+        return rf'\\.\pipe\BetterAdvancedPaste-{USERNAME}', 'AF_PIPE'
+    return str(_app_config_dir() / 'daemon.sock'), 'AF_UNIX'
+
+
+def _daemon_key_path() -> Path:
+    return _app_config_dir() / 'daemon.key'
+
+
+def _serve_daemon(api: API) -> None:
+    """Accept show requests from thin clients on a background thread."""
+    from multiprocessing.connection import Listener
+    address, family = _daemon_address()
+    key_path = _daemon_key_path()
+    key_path.parent.mkdir(parents=True, exist_ok=True)
+    authkey = os.urandom(32)
+    # Clients prove they run as this user by reading the key file
+    fd = os.open(str(key_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(authkey)
+    if family == 'AF_UNIX':
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+    listener = Listener(address, family=family, authkey=authkey)
+    print(f"[daemon] listening on {address}")
+
+    def _loop():
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"[daemon] accept failed: {e}")
+                continue
+            try:
+                msg = conn.recv()
+                if isinstance(msg, dict) and msg.get('cmd') == 'show':
+                    api.show_for(Path(msg['output_dir']))
+                    conn.send('ok')
+                else:
+                    conn.send('error')
+            except Exception as e:
+                print(f"[daemon] request failed: {e}")
+            finally:
+                conn.close()
+
+    threading.Thread(target=_loop, name='bap-daemon', daemon=True).start()
+
+
+def send_to_daemon(output_dir: Path) -> bool:
+    """Hand *output_dir* to a running daemon; False if none is reachable."""
+    try:
+        authkey = _daemon_key_path().read_bytes()
+    except OSError:
+        return False
+    try:
+        from multiprocessing.connection import Client
+        address, family = _daemon_address()
+        conn = Client(address, family=family, authkey=authkey)
+        try:
+            conn.send({'cmd': 'show', 'output_dir': str(output_dir)})
+            return conn.recv() == 'ok'
+        finally:
+            conn.close()
+    except Exception:
+        return False
+
+
+# Backends tried in order when nothing is cached; None is pywebview's own pick
+GUI_BACKENDS = ['edgechromium', 'cef', 'mshtml', None]
+# Bump when the meaning of gui.json changes
+GUI_CACHE_VERSION = 1
+
+
+def _gui_cache_path() -> Path:
+    return _app_config_dir() / 'gui.json'
+
+
+def _gui_fingerprint(webview) -> str:
+    """Changes when pywebview is upgraded (or the platform differs), invalidating gui.json."""
+    try:
+        stamp = Path(webview.__file__).stat().st_mtime
+    except (OSError, TypeError):
+        stamp = 0
+    return f"{GUI_CACHE_VERSION}:{sys.platform}:{getattr(webview, '__version__', '')}:{stamp}"
+
+
+def _load_gui_cache(webview) -> Dict[str, Any]:
+    """The probe results of the last launch that showed a window, if still valid."""
+    try:
+        data = json.loads(_gui_cache_path().read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get('fingerprint') != _gui_fingerprint(webview):
+        return {}
+    return data
+
+
+def _save_gui_cache(webview, backend: str | None, icon_kw: bool) -> None:
+    try:
+        _atomic_write_text(_gui_cache_path(), json.dumps(
+            {"fingerprint": _gui_fingerprint(webview), "backend": backend, "icon_kw": icon_kw}, indent=2) + "\n")
+    except Exception as e:
+        print(f"Failed to save GUI backend cache: {e}")
+
+
+def _create_webview_window(webview, icon_kw: bool, icon: str | None, **kwargs):
+    """webview.create_window, passing *icon* only where this pywebview supports it."""
+    if icon_kw and icon:
+        kwargs['icon'] = icon
+    return webview.create_window(**kwargs)
+
+
+def _supports_icon_kw(webview) -> bool:
+    import inspect
+    try:
+        return 'icon' in inspect.signature(webview.create_window).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _inline_html(name: str, payload: Dict[str, Any] | None = None) -> str:
+    """Read a bundled page, optionally embedding *payload* as ``window.__BAP_INITIAL__``.
+
+    Passing the page as a string (``html=``) means pywebview needs no local
+    HTTP server, and the embedded options let the list paint before the JS
+    bridge is ready.
+    """
+    html = _resource_path(name).read_text(encoding='utf-8')
+    if payload is not None:
+        # '</' would end the script element early
+        data = json.dumps(payload, ensure_ascii=False).replace('</', '<\\/')
+        html = html.replace('<script>', f'<script>window.__BAP_INITIAL__ = {data};</script>\n<script>', 1)
+    return html
+
+
+def _log_first_paint(backend: str | None, paint_ms: float, cached: bool) -> None:
+    """Record time-to-first-paint (from process start) for this launch."""
+    STARTUP_PHASES.append(('first paint', paint_ms / 1000, 0.0))
+    print(f"[startup] first paint after {paint_ms:.0f} ms (backend {backend or 'auto'}"
+          f"{', cached' if cached else ''})")
+    try:
+        path = _app_config_dir() / 'startup.jsonl'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as fh:
+            fh.write(json.dumps({"time": round(time.time(), 3), "first_paint_ms": round(paint_ms, 1),
+                                 "backend": backend, "cached_backend": cached}) + "\n")
+    except Exception as e:
+        print(f"Failed to log startup time: {e}")
+
+
+def create_window(output_dir: Path, daemon: bool = False, profile: bool = False):
+    """Open the palette for *output_dir*.
+
+    With *daemon* the window starts hidden and the process stays resident,
+    showing the palette whenever a client sends it an output directory.
+    With *profile* the startup phase breakdown is printed once the page loads.
+
+    The GUI backend that worked last time (gui.json in the config dir) is
+    tried first; the full probe only runs when it fails or pywebview changed.
+    """
+    if not _resource_path('ui.html').exists():
         raise FileNotFoundError('ui.html not found')
+    # Overlaps the keyring lookup with the webview import and window creation
+    prefetch_api_token()
+    with _phase('import webview'):
+        import webview
 
     # Ensure config directory exists for read/write
     try:
@@ -562,83 +4542,226 @@ def create_window(output_dir: Path):
         pass
     config_path = CONFIG_PATH
     api = API(config_path, output_dir)
-    _ = api  # reference to avoid linter warning
-    preferred_backends = ['edgechromium', 'cef', 'mshtml']
+    api._daemon = daemon
+    # Load the AI plumbing while the window paints instead of before it
+    warm = threading.Thread(target=_warm_up, name='bap-warmup', daemon=True)
+    warm.start()
+
+    with _phase('gui probe'):
+        cache = _load_gui_cache(webview)
+        icon_kw = cache['icon_kw'] if 'icon_kw' in cache else _supports_icon_kw(webview)
+        backends = list(GUI_BACKENDS)
+        if 'backend' in cache and cache['backend'] in backends:
+            backends.remove(cache['backend'])
+            backends.insert(0, cache['backend'])
+    with _phase('options payload'):
+        html = _inline_html('ui.html', {"options": api.initial_options(50), "settings": api.get_settings()})
+    api._start_recommend()
     # Resolve window icon if present
     icon_path = _resource_path('icon.ico')
     icon_arg = str(icon_path) if icon_path.exists() else None
-    for backend in preferred_backends:
+
+    for backend in backends:
+        state = {"backend": backend, "cached": 'backend' in cache and backend == cache['backend']}
+        api._launch = state
+        w = None
+
+        def _on_loaded():
+            STARTUP_PHASES.append(('window loaded', time.perf_counter() - _T0, 0.0))
+            # The first page came from initial_options; index the whole history now
+            threading.Thread(target=api._load, name='bap-index', daemon=True).start()
+            # The page rendered, so this backend works: remember it for next launch
+            if not state["cached"]:
+                _save_gui_cache(webview, state["backend"], icon_kw)
+            if profile:
+                warm.join(timeout=10)
+                print(report_startup())
         try:
-            try:
-                w = webview.create_window(
-                    title='Command Palette',
-                    url=html_path.as_uri(),
-                    width=420,
-                    height=460,
-                    resizable=False,
-                    easy_drag=True,
-                    frameless=False,  # Set to True for frameless palette style
-                    js_api=api,
-                    icon=icon_arg
-                )
-            except TypeError:
-                # Older pywebview without 'icon' kw support
-                w = webview.create_window(
-                    title='Command Palette',
-                    url=html_path.as_uri(),
-                    width=420,
-                    height=460,
-                    resizable=False,
-                    easy_drag=True,
-                    frameless=False,
-                    js_api=api
-                )
+            w = _create_webview_window(
+                webview, icon_kw, icon_arg,
+                title='Command Palette',
+                html=html,
+                width=420,
+                height=460,
+                resizable=False,
+                easy_drag=True,
+                frameless=False,  # Set to True for frameless palette style
+                js_api=api,
+                hidden=daemon
+            )
             api._window = w
+            w.events.loaded += _on_loaded
+            if daemon:
+                w.events.closing += api._on_closing
             def _on_start():
-                # Nothing to do at start; windows already created
-                pass
-            webview.start(_on_start, gui=backend, debug=False, http_server=True)
+                if daemon:
+                    _serve_daemon(api)
+            if backend:
+                webview.start(_on_start, gui=backend, debug=False)
+            else:
+                webview.start(_on_start, debug=False)
             return
         except Exception as e:
-            print(f"Backend '{backend}' failed: {e}")
-    # Fallback to auto
-    try:
-        w = webview.create_window(
-            title='Command Palette',
-            url=html_path.as_uri(),
-            width=420,
-            height=460,
-            resizable=False,
-            easy_drag=True,
-            frameless=False,
-            js_api=api,
-            icon=icon_arg
-        )
-    except TypeError:
-        w = webview.create_window(
-            title='Command Palette',
-            url=html_path.as_uri(),
-            width=420,
-            height=460,
-            resizable=False,
-            easy_drag=True,
-            frameless=False,
-            js_api=api
-        )
-    api._window = w
-    def _on_start2():
-        # Nothing to do at start
-        pass
-    webview.start(_on_start2, debug=False, http_server=True)
+            print(f"Backend '{backend or 'auto'}' failed: {e}")
+            # A window of a failed attempt must not be started again by the next one
+            if w is not None and w in getattr(webview, 'windows', []):
+                webview.windows.remove(w)
+            if state["cached"]:
+                try:
+                    _gui_cache_path().unlink()
+                except OSError:
+                    pass
+    raise RuntimeError('No GUI backend could open the palette')
+
+
+def _find_preset(config_path: Path, name: str) -> str:
+    """Return the title of the preset matching *name* (case-insensitive, exact then prefix)."""
+    options = API(config_path, Path.cwd())._load()
+    key = name.strip().lower()
+    for o in options:
+        if o['title'].strip().lower() == key:
+            return o['title']
+    matches = [o['title'] for o in options if o['title'].strip().lower().startswith(key)]
+    if len(matches) == 1:
+        return matches[0]
+    if matches:
+        raise ValueError(f"Preset '{name}' is ambiguous: {', '.join(matches)}")
+    raise ValueError(f"No preset named '{name}' in {config_path}")
+
+
+def _resolve_inputs(spec: str) -> List[Path | str]:
+    """Expand --input into files; ``-`` (stdin) is passed through as is."""
+    if spec == '-':
+        return ['-']
+    path = Path(spec).expanduser()
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.is_file())
+    if any(ch in spec for ch in '*?['):
+        import glob
+        return sorted(Path(p) for p in glob.glob(os.path.expanduser(spec), recursive=True) if Path(p).is_file())
+    if not path.is_file():
+        raise FileNotFoundError(f"Input not found: {spec}")
+    return [path]
+
+
+def run_batch(instruction: str, inputs: List[Path | str | None], output_dir: Path, jobs: int = 4,
+              summary=None, no_cache: bool = False) -> int:
+    """Run *instruction* over every input on a thread pool and save each result.
+
+    An input is a file path, ``-`` for stdin or None for the clipboard.
+    One JSON line per item (input, output file, status, seconds, ...) is
+    written to *summary* as items finish. Returns the number of failures.
+    """
+    summary = summary or sys.stdout
+    _ensure_ai_settings()
+    lock = threading.Lock()
+    multi = len(inputs) > 1
+
+    def _one(src: Path | str | None) -> Dict[str, Any]:
+        item: Dict[str, Any] = {"input": "<clipboard>" if src is None else "<stdin>" if src == '-' else str(src)}
+        start = time.perf_counter()
+        try:
+            with _trace('paste', instruction=instruction, source='batch', input=item["input"]):
+                if src is None:
+                    text = _get_clipboard()
+                elif src == '-':
+                    text = sys.stdin.read()
+                else:
+                    with _phase('input read'):
+                        text = Path(src).read_text(encoding='utf-8', errors='replace')
+                item["input_bytes"] = len(text.encode('utf-8'))
+                result = Job(instruction, _total_timeout()).run(
+                    paste_to_dir, instruction, output_dir, text=text, no_cache=no_cache, unique=multi)
+            item.update(status="ok", **result)
+        except Exception as e:
+            item.update(status="error", error=str(e))
+        item["seconds"] = round(time.perf_counter() - start, 3)
+        with lock:
+            summary.write(json.dumps(item, ensure_ascii=False) + "\n")
+            summary.flush()
+        return item
+
+    workers = max(1, min(jobs, len(inputs)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bap-batch') as pool:
+        results = list(pool.map(_one, inputs))
+    return sum(1 for r in results if r["status"] != "ok")
+
+
+def run_headless(args) -> int:
+    """Entry point for --instruction/--preset: no window, no webview import."""
+    prefetch_api_token()
+    out_dir = Path(args.output_dir).expanduser().resolve()
+    instruction = args.instruction or _find_preset(CONFIG_PATH, args.preset)
+    if args.input:
+        inputs = _resolve_inputs(args.input)
+        if not inputs:
+            print(f"No input files match {args.input}", file=sys.stderr)
+            return 1
+    else:
+        # Clipboard, exactly like the palette
+        inputs = [None]
+    summary = open(args.summary, 'a', encoding='utf-8') if args.summary else None
+    try:
+        failures = run_batch(instruction, inputs, out_dir, jobs=args.jobs,
+                             summary=summary, no_cache=args.no_cache)
+    finally:
+        if summary:
+            summary.close()
+    return 1 if failures else 0
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(description='Advanced Paste AI')
-    parser.add_argument('output_dir', help='Directory to save AI output file')
-    return parser.parse_args(argv)
+    parser.add_argument('output_dir', nargs='?', help='Directory to save AI output file')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Stay resident with a hidden, pre-loaded palette that clients show on demand')
+    parser.add_argument('--no-daemon', action='store_true',
+                        help='Do not hand the request to a running daemon')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Print per-phase import/init timings once the palette has loaded')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print latency/throughput percentiles from the request metrics (also saved '
+                             'as stats_report.txt in the config dir) and exit')
+    parser.add_argument('--stats-days', type=float, metavar='N',
+                        help='Only include requests from the last N days in --stats')
+    headless = parser.add_argument_group('headless / batch (no window)')
+    what = headless.add_mutually_exclusive_group()
+    what.add_argument('--instruction', help='Run this instruction without opening the palette')
+    what.add_argument('--preset', help='Run the conf.json preset with this title (or unique title prefix)')
+    headless.add_argument('--input', help="Input file, directory, glob pattern or '-' for stdin (default: clipboard)")
+    headless.add_argument('--jobs', type=int, default=4, help='Concurrent requests in batch mode (default: 4)')
+    headless.add_argument('--summary', help='Append the JSONL summary here instead of printing it')
+    headless.add_argument('--no-cache', action='store_true', help='Bypass the response cache lookup')
+    args = parser.parse_args(argv)
+    if not args.output_dir and not (args.daemon or args.stats):
+        parser.error('output_dir is required unless --daemon or --stats is given')
+    if args.input and not (args.instruction or args.preset):
+        parser.error('--input requires --instruction or --preset')
+    return args
+
+STARTUP_PHASES.append(('module import', 0.0, time.perf_counter() - _T0))
 
 if __name__ == '__main__':
-    args = parse_args(sys.argv[1:])
+    with _phase('parse args'):
+        args = parse_args(sys.argv[1:])
+    if args.stats:
+        print(report_stats(args.stats_days))
+        if getattr(sys, 'frozen', False) and sys.platform == 'win32':
+            # Built with console=False: nothing above reaches the user, so open the file
+            os.startfile(str(_app_config_dir() / 'stats_report.txt'))
+        sys.exit(0)
+    if args.daemon:
+        create_window(Path.cwd(), daemon=True, profile=args.profile_startup)
+        sys.exit(0)
+    if args.instruction or args.preset:
+        sys.exit(run_headless(args))
     out_dir = Path(args.output_dir).expanduser().resolve()
     out_dir.mkdir(parents=True, exist_ok=True)
-    create_window(out_dir)
+    if not args.no_daemon:
+        with _phase('daemon hand-off'):
+            handed_off = send_to_daemon(out_dir)
+        if handed_off:
+            if args.profile_startup:
+                print(report_startup())
+            sys.exit(0)
+    create_window(out_dir, profile=args.profile_startup)